@@ -0,0 +1,199 @@
+"""Compiled keyword analyzers for topics, vague responses and repeated questions.
+
+Keyword dictionaries are compiled once into lookup tables. Each message is
+tokenized in a single regex pass into whole words, so "class" no longer
+matches "classic". Single-word keywords and their inflections (plural, -ing,
+-ed, -er: "learning", "coding") are then found by set intersection. A
+multi-word phrase's compiled pattern only runs when every word of the phrase
+is in the message.
+
+Words are runs of Unicode letters and digits, so accented and non-Latin text
+tokenizes into words instead of being dropped or split at every non-ASCII
+character.
+
+The result of that pass (topics, vague-phrase hits, word set, word count) is
+cached per message text in an LRU bounded by the approximate bytes it holds
+(the text plus its word set), like the embedding cache. The conversation
+endpoints re-analyze the same history on every turn, so after the first call
+only the new messages cost anything.
+"""
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+import json
+import logging
+import re
+import sys
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOPIC_KEYWORDS: Dict[str, List[str]] = {
+    "programming": ["code", "function", "variable", "class", "method", "python", "javascript", "bug", "error", "api", "database", "algorithm"],
+    "writing": ["write", "essay", "article", "content", "blog", "story", "draft", "edit", "grammar", "style"],
+    "business": ["strategy", "market", "analysis", "revenue", "customer", "business", "plan", "growth", "competition"],
+    "learning": ["explain", "understand", "learn", "concept", "theory", "definition", "example", "teach"],
+    "creative": ["design", "creative", "art", "brainstorm", "idea", "innovation", "inspiration"],
+    "health": ["health", "medical", "fitness", "wellness", "nutrition", "exercise", "symptoms"],
+    "finance": ["investment", "money", "budget", "financial", "trading", "economics", "profit"],
+    "travel": ["travel", "trip", "vacation", "hotel", "flight", "tourism", "destination"]
+}
+
+DEFAULT_VAGUE_PHRASES: List[str] = [
+    "it depends", "maybe", "possibly", "perhaps", "i'm not sure",
+    "that's a good question", "there are many ways", "it varies"
+]
+
+_WORD = re.compile(r"[^\W_]+(?:['\u2019][^\W_]+)?")
+# Same tokens for lowercased ASCII text, and markedly faster; str.isascii() is O(1)
+_ASCII_WORD = re.compile(r"[a-z0-9]+(?:'[a-z0-9]+)?")
+
+
+def _words(lowered: str) -> List[str]:
+    return (_ASCII_WORD if lowered.isascii() else _WORD).findall(lowered)
+
+
+_VOWELS = frozenset("aeiou")
+
+
+def _inflections(keyword: str) -> Tuple[str, ...]:
+    """The keyword plus its plural, -ing, -ed and -er forms, so whole-word matching still finds
+    "learning", "coding" or "planned" the way the old substring scan found the stem"""
+    forms = {keyword}
+    if keyword.endswith("e") and len(keyword) > 2:
+        # code -> codes, coded, coder, coding
+        stem = keyword[:-1]
+        forms.update((keyword + "s", keyword + "d", keyword + "r", keyword + "rs", stem + "ing", stem + "ings"))
+    elif keyword.endswith("y") and len(keyword) > 2 and keyword[-2] not in _VOWELS:
+        # study -> studies, studied, studying
+        stem = keyword[:-1]
+        forms.update((stem + "ies", stem + "ied", keyword + "ing"))
+    else:
+        forms.update((keyword + "s", keyword + "es"))
+        stems = [keyword]
+        if (len(keyword) > 2 and keyword[-1] not in _VOWELS and keyword[-1] not in "wxy"
+                and keyword[-2] in _VOWELS and keyword[-3] not in _VOWELS):
+            # plan -> planned, planning; both spellings are kept since stress decides (editing, not editting)
+            stems.append(keyword + keyword[-1])
+        for stem in stems:
+            forms.update((stem + "ing", stem + "ings", stem + "ed", stem + "er", stem + "ers"))
+    return tuple(sorted(forms))
+
+
+class MessageProfile(NamedTuple):
+    topics: Tuple[str, ...]
+    vague_hits: int
+    words: FrozenSet[str]
+    word_count: int
+
+
+_STR_HEADER_BYTES = sys.getsizeof("")
+
+
+def _profile_bytes(text: str, profile: MessageProfile) -> int:
+    """Approximate memory held by one cache entry: the key text, the word set and its strings.
+
+    The distinct words never hold more characters than the text, so their strings are
+    bounded by the text's size plus one object header each, without walking the set.
+    """
+    return 2 * sys.getsizeof(text) + sys.getsizeof(profile.words) + _STR_HEADER_BYTES * len(profile.words)
+
+
+class TextAnalyzer:
+    """Compiled keyword dictionaries plus a byte-bounded LRU of per-message profiles"""
+
+    def __init__(self, topic_keywords: Optional[Dict[str, List[str]]] = None,
+                 vague_phrases: Optional[List[str]] = None, max_cache_bytes: int = 32 * 1024 * 1024):
+        topic_keywords = topic_keywords or DEFAULT_TOPIC_KEYWORDS
+        vague_phrases = vague_phrases or DEFAULT_VAGUE_PHRASES
+        self.topic_order = list(topic_keywords)
+        self.max_cache_bytes = max_cache_bytes
+        self._cache: "OrderedDict[str, Tuple[MessageProfile, int]]" = OrderedDict()
+        self._cache_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+        # keyword form -> topics; multi-word keywords are matched as phrases instead
+        topic_words: Dict[str, set] = {}
+        self._phrase_topics: Dict[str, Tuple[str, ...]] = {}
+        for topic, keywords in topic_keywords.items():
+            for keyword in keywords:
+                keyword = keyword.lower().strip()
+                if " " in keyword:
+                    self._phrase_topics[keyword] = self._phrase_topics.get(keyword, ()) + (topic,)
+                else:
+                    for form in _inflections(keyword):
+                        topic_words.setdefault(form, set()).add(topic)
+        self._topic_words = {form: frozenset(topics) for form, topics in topic_words.items()}
+        self._topic_word_set = frozenset(self._topic_words)
+
+        phrases = [p.lower().strip() for p in vague_phrases]
+        self._vague_word_set = frozenset(p for p in phrases if " " not in p)
+        self._vague_phrases = frozenset(p for p in phrases if " " in p)
+
+        # A phrase is only searched for when every one of its words is in the message
+        self._phrases = [
+            (phrase, frozenset(_words(phrase)), re.compile(r"\b" + re.escape(phrase) + r"\b"))
+            for phrase in sorted(set(self._phrase_topics) | self._vague_phrases)
+        ]
+
+    @classmethod
+    def from_file(cls, path: Optional[str], **kwargs) -> "TextAnalyzer":
+        """Load ``{"topics": {topic: [keywords]}, "vague_phrases": [...]}``; defaults for missing keys"""
+        if not path:
+            return cls(**kwargs)
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        logger.info(f"Loaded analyzer keyword dictionaries from {path}")
+        return cls(config.get("topics"), config.get("vague_phrases"), **kwargs)
+
+    def analyze(self, text: str) -> MessageProfile:
+        text = text or ""
+        cached = self._cache.get(text)
+        if cached is not None:
+            self._cache.move_to_end(text)
+            self.stats["hits"] += 1
+            return cached[0]
+
+        self.stats["misses"] += 1
+        lowered = text.lower()
+        tokens = _words(lowered)
+        words = frozenset(tokens)
+
+        found = frozenset().union(*map(self._topic_words.__getitem__, words & self._topic_word_set))
+        vague_hits = len(words & self._vague_word_set)
+        for phrase, phrase_words, pattern in self._phrases:
+            if phrase_words <= words and pattern.search(lowered):
+                found = found.union(self._phrase_topics.get(phrase, ()))
+                vague_hits += phrase in self._vague_phrases
+
+        profile = MessageProfile(
+            topics=tuple(topic for topic in self.topic_order if topic in found) or ("general",),
+            vague_hits=vague_hits,
+            words=words,
+            word_count=len(tokens)
+        )
+        size = _profile_bytes(text, profile)
+        self._cache[text] = (profile, size)
+        self._cache_bytes += size
+        while self._cache_bytes > self.max_cache_bytes and self._cache:
+            _, (_, evicted) = self._cache.popitem(last=False)
+            self._cache_bytes -= evicted
+            self.stats["evictions"] += 1
+        return profile
+
+    def topics(self, text: str) -> List[str]:
+        return list(self.analyze(text).topics)
+
+    def is_vague(self, text: str) -> bool:
+        profile = self.analyze(text)
+        return profile.vague_hits >= 2 or profile.word_count < 20
+
+    def is_similar(self, first: str, second: str, threshold: float = 0.6) -> bool:
+        """Jaccard similarity of the two messages' word sets above ``threshold``"""
+        a, b = self.analyze(first).words, self.analyze(second).words
+        if not a or not b:
+            return False
+        return len(a & b) / len(a | b) > threshold
+
+    def snapshot(self) -> Dict:
+        return {**self.stats, "cached_messages": len(self._cache), "bytes": self._cache_bytes,
+                "max_bytes": self.max_cache_bytes}
+
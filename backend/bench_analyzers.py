@@ -0,0 +1,111 @@
+"""Micro-benchmark: conversation analysis with the compiled analyzers vs the old substring scans.
+
+Builds a synthetic conversation and times ``analyze_conversation_coherence``
+with the substring-scan analyzers main.py used to have and with the
+compiled, cached ones it uses now. "cold" starts from an empty per-message
+cache. "warm" re-analyzes the same history, which is what happens on every
+new turn. Only the warm path is an order of magnitude faster than the
+old scans; a cold pass is roughly 1.5-2x.
+
+Usage: python bench_analyzers.py [messages] [repeats]
+"""
+import random
+import statistics
+import sys
+import time
+
+import main
+from analyzers import DEFAULT_TOPIC_KEYWORDS, DEFAULT_VAGUE_PHRASES, TextAnalyzer
+
+MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+REPEATS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+
+def legacy_extract_topics(text):
+    text_lower = text.lower()
+    topics = [topic for topic, keywords in DEFAULT_TOPIC_KEYWORDS.items()
+              if any(keyword in text_lower for keyword in keywords)]
+    return topics or ["general"]
+
+
+def legacy_is_similar(q1, q2):
+    q1_words, q2_words = set(q1.lower().split()), set(q2.lower().split())
+    if not q1_words or not q2_words:
+        return False
+    return len(q1_words & q2_words) / len(q1_words | q2_words) > 0.6
+
+
+def legacy_is_vague(response):
+    response_lower = response.lower()
+    vague_count = sum(1 for indicator in DEFAULT_VAGUE_PHRASES if indicator in response_lower)
+    return vague_count >= 2 or len(response.split()) < 20
+
+
+def legacy_topic_coherence(topics_per_turn):
+    overlap_scores = []
+    for i in range(1, len(topics_per_turn)):
+        current, previous = set(topics_per_turn[i]), set(topics_per_turn[i - 1])
+        overlap_scores.append(len(current & previous) / len(current | previous))
+    return min(10.0, max(0.0, 10 * statistics.mean(overlap_scores) + 3))
+
+
+def legacy_analysis(history):
+    """The old per-call path: topics per user message twice (coherence, then issues), no caching"""
+    user_messages = [msg["content"] for msg in history if msg["role"] == "user"]
+    topics_per_turn = [legacy_extract_topics(msg) for msg in user_messages]
+    legacy_topic_coherence(topics_per_turn)
+    len(set(sum(topics_per_turn, []))) / len(topics_per_turn)
+    recent = user_messages[-3:]
+    any(legacy_is_similar(recent[0], msg) for msg in recent[1:])
+    legacy_is_vague([msg["content"] for msg in history if msg["role"] == "assistant"][-1])
+    [topic for msg in user_messages for topic in legacy_extract_topics(msg)]
+
+
+def conversation(n, seed=0):
+    """Alternating turns of random words, about 5% of them topic keywords"""
+    rng = random.Random(seed)
+    keywords = [word for words in DEFAULT_TOPIC_KEYWORDS.values() for word in words]
+    filler = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 9))) for _ in range(3000)]
+    filler += "the a of to and in is it you that for on with as this be are or at classic artistic".split()
+
+    def word():
+        return rng.choice(keywords) if rng.random() < 0.05 else rng.choice(filler)
+
+    history = []
+    for i in range(n):
+        role = "user" if i % 2 == 0 else "assistant"
+        length = rng.randint(15, 60) if role == "user" else rng.randint(150, 450)
+        history.append({"role": role, "content": " ".join(word() for _ in range(length))})
+    return history
+
+
+def timed(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench():
+    history = conversation(MESSAGES)
+    legacy = timed(lambda: legacy_analysis(history), REPEATS)
+
+    def cold():
+        main.text_analyzer = TextAnalyzer()
+        main.analyze_conversation_coherence(history)
+
+    compiled_cold = timed(cold, REPEATS)
+    main.text_analyzer = TextAnalyzer()
+    main.analyze_conversation_coherence(history)
+    compiled_warm = timed(lambda: main.analyze_conversation_coherence(history), REPEATS)
+
+    print(f"messages={MESSAGES} repeats={REPEATS} (best of)")
+    print(f"legacy substring scans   {legacy * 1000:8.2f} ms")
+    print(f"compiled, cold cache     {compiled_cold * 1000:8.2f} ms  {legacy / compiled_cold:5.1f}x")
+    print(f"compiled, warm cache     {compiled_warm * 1000:8.2f} ms  {legacy / compiled_warm:5.1f}x")
+
+
+if __name__ == "__main__":
+    bench()
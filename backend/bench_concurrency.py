@@ -0,0 +1,86 @@
+"""Load benchmark: do concurrent requests on one worker overlap?
+
+Replaces the OpenAI and Supabase clients with fakes that take a fixed time to
+answer, then fires concurrent requests at the ASGI app in-process. With
+non-blocking upstream I/O the wall time stays close to one upstream call; if a
+route blocked the event loop it would grow with the number of requests.
+
+Usage: python bench_concurrency.py [concurrency] [upstream_latency_seconds]
+"""
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+
+import httpx
+
+import main
+
+CONCURRENCY = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+UPSTREAM_LATENCY = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+
+
+class FakeCompletions:
+    async def create(self, **kwargs):
+        await asyncio.sleep(UPSTREAM_LATENCY)
+        content = '{"score": 7, "context": "general", "strengths": [], "suggestions": [], "analysis": "ok"}'
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class FakeEmbeddings:
+    async def create(self, **kwargs):
+        await asyncio.sleep(UPSTREAM_LATENCY)
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[0.0] * 1536)])
+
+
+class FakeQuery:
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    async def execute(self):
+        await asyncio.sleep(UPSTREAM_LATENCY)
+        return SimpleNamespace(data=[])
+
+
+class FakeSupabase:
+    def table(self, table_name):
+        return FakeQuery()
+
+    def rpc(self, func, params):
+        return FakeQuery()
+
+    async def aclose(self):
+        pass
+
+
+async def run(path, payload, concurrency):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+        headers = {"X-User-ID": "bench-user"}
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[
+            http.post(path, json=payload, headers=headers)
+            for _ in range(concurrency)
+        ])
+        elapsed = time.perf_counter() - start
+    assert all(r.status_code == 200 for r in responses), [r.status_code for r in responses]
+    return elapsed
+
+
+async def bench():
+    main.client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions()), embeddings=FakeEmbeddings())
+    main.supabase = FakeSupabase()
+
+    cases = [
+        ("/analyze_prompt", {"prompt": "How do I reverse a linked list in Python?"}),
+        ("/search_memory", {"query": "linked lists", "limit": 5}),
+    ]
+    print(f"concurrency={CONCURRENCY} upstream_latency={UPSTREAM_LATENCY:.2f}s")
+    for path, payload in cases:
+        elapsed = await run(path, payload, CONCURRENCY)
+        serial = CONCURRENCY * UPSTREAM_LATENCY
+        print(f"{path:<20} wall={elapsed:.2f}s  serial_estimate>={serial:.2f}s  overlap={serial / elapsed:.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
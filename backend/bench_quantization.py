@@ -0,0 +1,82 @@
+"""Benchmark: recall@k and memory of quantized local vector search against exact float search.
+
+Builds the same synthetic user (clustered unit vectors, like real embeddings)
+into LocalVectorIndex with float32, int8 and PQ codes. The same queries are
+run against each. recall@k is the fraction of the exact float top-k that a
+configuration returns. "rescore" is how many times k approximate hits are
+re-scored at full precision; rescore=1 shows the raw quantizer.
+
+Usage: python bench_quantization.py [vectors] [dim] [queries] [k]
+"""
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from vector_index import LocalVectorIndex
+
+VECTORS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+DIM = int(sys.argv[2]) if len(sys.argv) > 2 else 1536
+QUERIES = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+K = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+
+
+def dataset(seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(8, VECTORS // 100), DIM))
+    vectors = centers[rng.integers(0, len(centers), VECTORS)] + 0.8 * rng.normal(size=(VECTORS, DIM))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    # Queries near stored memories, off by noise of norm ~0.5
+    queries = vectors[rng.choice(VECTORS, QUERIES, replace=False)] + 0.5 * rng.normal(size=(QUERIES, DIM)) / np.sqrt(DIM)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return vectors.astype(np.float32), queries.astype(np.float32)
+
+
+def build(base_dir, rows, **options):
+    index = LocalVectorIndex(base_dir, ivf_min_vectors=10 ** 9, **options)
+    start = time.perf_counter()
+    index.build("bench", rows)
+    return index, time.perf_counter() - start
+
+
+def run(index, queries):
+    results, start = [], time.perf_counter()
+    for query in queries:
+        results.append([row["id"] for row in index.search("bench", query.tolist(), -1.0, K)])
+    return results, (time.perf_counter() - start) / len(queries)
+
+
+def bench():
+    vectors, queries = dataset()
+    rows = [{"id": str(i), "embedding": vector} for i, vector in enumerate(vectors)]
+    configs = [
+        ("float32", {"quantize_min_vectors": 0}),
+        ("int8, rescore 1", {"rescore": 1}),
+        ("int8, rescore 4", {"rescore": 4}),
+        ("pq, rescore 1", {"pq_min_vectors": 1, "pq_rescore": 1}),
+        ("pq, rescore 4", {"pq_min_vectors": 1, "pq_rescore": 4}),
+        ("pq, rescore 16", {"pq_min_vectors": 1, "pq_rescore": 16}),
+    ]
+
+    print(f"vectors={VECTORS} dim={DIM} queries={QUERIES} k={K}")
+    print(f"{'config':18} {'recall@k':>9} {'bytes/vec':>10} {'ms/query':>9} {'build s':>8}")
+    exact = None
+    for name, options in configs:
+        base_dir = tempfile.mkdtemp()
+        try:
+            index, build_seconds = build(base_dir, rows, **{"quantize_min_vectors": 1, **options})
+            results, seconds = run(index, queries)
+            quantizer = index._loaded["bench"].quantizer
+            per_vector = quantizer.bytes_per_vector if quantizer else 4 * DIM
+        finally:
+            shutil.rmtree(base_dir)
+        if exact is None:
+            exact = results
+        recall = np.mean([len(set(a) & set(b)) / K for a, b in zip(results, exact)])
+        print(f"{name:18} {recall:9.3f} {per_vector:10.0f} {seconds * 1000:9.2f} {build_seconds:8.1f}")
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,104 @@
+"""Turn-aligned passages for embedding long conversations.
+
+A memory's own embedding covers its summary and the first 1000 characters of
+the conversation, so anything said later in a long session cannot be found by
+vector search. ``chunk_turns`` splits the stored conversation text, one
+``"role: content"`` line per message, into passages of at most ``max_tokens``.
+Each passage is embedded separately.
+
+Passages follow message boundaries: consecutive messages are packed together
+until the budget is reached. A single message over the budget is split at
+paragraph, sentence, line and then word breaks, and hard-cut only as a
+last resort. A passage is stored as character offsets into the memory's
+``content``, along with the range of messages it spans, so search results can
+point back into the conversation without keeping a second copy of the text.
+"""
+from typing import Callable, List, NamedTuple, Optional, Tuple
+import re
+
+_BOUNDARIES = [re.compile(r"\n\s*\n"), re.compile(r"(?<=[.!?])\s+"), re.compile(r"\n"), re.compile(r"\s+")]
+
+
+class Passage(NamedTuple):
+    index: int
+    start: int
+    end: int
+    message_start: int
+    message_end: int
+
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // 4
+
+
+def _trim(text: str, start: int, end: int) -> Tuple[int, int]:
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def _split(text: str, start: int, end: int, max_tokens: int, count: Callable[[str], int],
+           level: int = 0) -> List[Tuple[int, int]]:
+    """(start, end) pieces of text[start:end], each within max_tokens where a boundary allows"""
+    if count(text[start:end]) <= max_tokens:
+        return [(start, end)]
+    if level == len(_BOUNDARIES):
+        # No boundary left: cut to length, sized from this span's own characters per token
+        step = max(1, (end - start) * max_tokens // max(1, count(text[start:end])))
+        return [(i, min(i + step, end)) for i in range(start, end, step)]
+
+    cuts = [match.end() for match in _BOUNDARIES[level].finditer(text, start, end)]
+    pieces = [(a, b) for a, b in zip([start] + cuts, cuts + [end]) if b > a]
+    if len(pieces) == 1:
+        return _split(text, start, end, max_tokens, count, level + 1)
+
+    # Pack adjacent pieces greedily; a piece still over the budget goes one level finer
+    spans: List[Tuple[int, int]] = []
+    current: Optional[Tuple[int, int]] = None
+    for a, b in pieces:
+        if current is not None and count(text[current[0]:b]) <= max_tokens:
+            current = (current[0], b)
+            continue
+        if current is not None:
+            spans.append(current)
+        if count(text[a:b]) > max_tokens:
+            spans.extend(_split(text, a, b, max_tokens, count, level + 1))
+            current = None
+        else:
+            current = (a, b)
+    if current is not None:
+        spans.append(current)
+    return spans
+
+
+def chunk_turns(turns: List[str], max_tokens: int = 400,
+                count_tokens: Optional[Callable[[str], int]] = None) -> List[Passage]:
+    """Passages over ``"\\n".join(turns)``, packing whole turns up to max_tokens each"""
+    count = count_tokens or _estimate_tokens
+    text = "\n".join(turns)
+
+    # (start, end, message index, tokens) units: whole turns, or pieces of an oversized one
+    units = []
+    offset = 0
+    for message, turn in enumerate(turns):
+        start, end = offset, offset + len(turn)
+        offset = end + 1
+        for a, b in _split(text, start, end, max_tokens, count):
+            a, b = _trim(text, a, b)
+            if b > a:
+                units.append((a, b, message, count(text[a:b])))
+
+    passages: List[Passage] = []
+    current = None
+    for a, b, message, tokens in units:
+        if current is not None and current[3] + 1 + tokens <= max_tokens:
+            current = (current[0], b, current[2], current[3] + 1 + tokens, message)
+            continue
+        if current is not None:
+            passages.append(Passage(len(passages), current[0], current[1], current[2], current[4]))
+        current = (a, b, message, tokens, message)
+    if current is not None:
+        passages.append(Passage(len(passages), current[0], current[1], current[2], current[4]))
+    return passages
@@ -0,0 +1,235 @@
+"""Async upstream clients shared by all routes.
+
+The routes in main.py are ``async def``, so every call they make to OpenAI or
+Supabase has to be awaitable. Blocking calls would freeze the event loop and
+queue every other user's request behind them.
+
+Each upstream gets one ``UpstreamPool``: a single httpx transport with
+explicit connection limits, keep-alive expiry and per-phase timeouts, shared
+by every request to that host. HTTP/2 is used when the ``h2`` package is
+installed. The transport counts requests in flight, from send until the
+response body is closed, so ``snapshot()`` shows how close the pool is to
+its connection limit. An optional ``observer`` is called with each request,
+its status (None if it raised) and its duration, over the same span.
+"""
+from typing import Any, Callable, Dict, Optional
+import logging
+import time
+
+import httpx
+import openai
+from postgrest import AsyncPostgrestClient
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_HEADERS
+
+logger = logging.getLogger(__name__)
+
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class _MeteredStream(httpx.AsyncByteStream):
+    """Response body wrapper that reports when the connection is handed back"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._on_close is not None:
+                self._on_close()
+                self._on_close = None
+
+
+class MeteredTransport(httpx.AsyncBaseTransport):
+    """AsyncHTTPTransport that tracks in-flight requests, queueing and latency"""
+
+    def __init__(self, limits: httpx.Limits, http2: bool = False, retries: int = 0,
+                 observer: Optional[Callable[[httpx.Request, Optional[int], float], None]] = None):
+        self.limits = limits
+        self.http2 = http2
+        self.observer = observer
+        self._transport = httpx.AsyncHTTPTransport(limits=limits, http2=http2, retries=retries)
+        self.in_flight = 0
+        self.stats = {"requests": 0, "errors": 0, "peak_in_flight": 0, "queued_requests": 0, "total_seconds": 0.0}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.stats["requests"] += 1
+        if self.limits.max_connections is not None and self.in_flight >= self.limits.max_connections:
+            self.stats["queued_requests"] += 1
+        self.in_flight += 1
+        self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.in_flight)
+        started = time.perf_counter()
+
+        def release(status: Optional[int] = None):
+            seconds = time.perf_counter() - started
+            self.in_flight -= 1
+            self.stats["total_seconds"] += seconds
+            if self.observer is not None:
+                try:
+                    self.observer(request, status, seconds)
+                except Exception as e:
+                    logger.warning(f"Upstream request observer failed: {e}")
+
+        try:
+            response = await self._transport.handle_async_request(request)
+        except Exception:
+            self.stats["errors"] += 1
+            release()
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_MeteredStream(response.stream, lambda: release(response.status_code)),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+    def snapshot(self) -> Dict[str, Any]:
+        # httpcore's pool is not public API; report connection counts when it is reachable
+        pool = getattr(self._transport, "_pool", None)
+        connections = list(getattr(pool, "connections", []) or [])
+        idle = sum(1 for connection in connections if connection.is_idle())
+        max_connections = self.limits.max_connections
+        return {
+            **self.stats,
+            "total_seconds": round(self.stats["total_seconds"], 3),
+            "in_flight": self.in_flight,
+            "max_connections": max_connections,
+            "saturation": round(self.in_flight / max_connections, 3) if max_connections else None,
+            "open_connections": len(connections),
+            "idle_connections": idle,
+            "http2": self.http2,
+        }
+
+
+class UpstreamPool:
+    """Connection pool and timeouts for one upstream, shared by all clients that call it"""
+
+    def __init__(self, name: str, max_connections: int = 100, max_keepalive_connections: int = 20,
+                 keepalive_expiry: float = 30.0, connect_timeout: float = 5.0, read_timeout: float = 60.0,
+                 write_timeout: float = 10.0, pool_timeout: float = 10.0, http2: bool = True,
+                 observer: Optional[Callable[[httpx.Request, Optional[int], float], None]] = None):
+        self.name = name
+        if http2 and not http2_available():
+            logger.warning(f"HTTP/2 requested for {name} but the h2 package is not installed; using HTTP/1.1")
+            http2 = False
+        self.timeout = httpx.Timeout(connect=connect_timeout, read=read_timeout, write=write_timeout, pool=pool_timeout)
+        self.transport = MeteredTransport(
+            httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            http2=http2,
+            observer=observer,
+        )
+
+    def client(self, **kwargs) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=self.transport, timeout=self.timeout, **kwargs)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return self.transport.snapshot()
+
+
+class PooledPostgrestClient(AsyncPostgrestClient):
+    """AsyncPostgrestClient whose session runs on an UpstreamPool"""
+
+    def __init__(self, base_url: str, pool: UpstreamPool, **kwargs):
+        self._pool = pool
+        super().__init__(base_url, timeout=pool.timeout, **kwargs)
+
+    def create_session(self, base_url: str, headers: Dict[str, str], timeout) -> httpx.AsyncClient:
+        return self._pool.client(base_url=base_url, headers=headers)
+
+
+class AsyncRPCCall:
+    """Deferred PostgREST RPC so call sites read ``await db.rpc(...).execute()``"""
+
+    def __init__(self, postgrest: AsyncPostgrestClient, func: str, params: Dict[str, Any]):
+        self._postgrest = postgrest
+        self._func = func
+        self._params = params
+
+    async def execute(self):
+        builder = await self._postgrest.rpc(self._func, self._params)
+        return await builder.execute()
+
+
+class AsyncSupabaseClient:
+    """Async PostgREST client exposing the ``table``/``rpc`` subset of supabase.Client"""
+
+    def __init__(self, supabase_url: str, supabase_key: str, pool: Optional[UpstreamPool] = None):
+        self.rest_url = f"{supabase_url}/rest/v1"
+        headers = {
+            **DEFAULT_POSTGREST_CLIENT_HEADERS,
+            "apiKey": supabase_key,
+            "Authorization": f"Bearer {supabase_key}",
+        }
+        if pool is not None:
+            self.postgrest = PooledPostgrestClient(self.rest_url, pool, headers=headers)
+        else:
+            self.postgrest = AsyncPostgrestClient(self.rest_url, headers=headers)
+
+    def table(self, table_name: str):
+        return self.postgrest.from_(table_name)
+
+    def rpc(self, func: str, params: Dict[str, Any]) -> AsyncRPCCall:
+        return AsyncRPCCall(self.postgrest, func, params)
+
+    async def aclose(self):
+        await self.postgrest.aclose()
+
+
+def order_by(query, *columns: str):
+    """Multi-column ordering, e.g. ``order_by(q, "created_at.desc", "id.desc")``; ``.order()`` takes one column"""
+    if not hasattr(query, "params"):
+        # LocalQuery (local_store.py) builds SQL and accepts repeated .order() calls
+        for column in columns:
+            name, _, direction = column.partition(".")
+            query = query.order(name, desc=direction == "desc")
+        return query
+    query.params = query.params.add("order", ",".join(columns))
+    return query
+
+
+def keyset_after(query, created_at: str, row_id: str):
+    """Rows strictly after ``(created_at, id)`` when ordered by both descending"""
+    if not hasattr(query, "params"):
+        return query.after(created_at, row_id)
+    query.params = query.params.add(
+        "or", f'(created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt."{row_id}"))'
+    )
+    return query
+
+
+def create_supabase_client(supabase_url: Optional[str], supabase_key: Optional[str],
+                           pool: Optional[UpstreamPool] = None) -> AsyncSupabaseClient:
+    if not supabase_url or not supabase_key:
+        raise ValueError("Supabase credentials not found in environment variables")
+    return AsyncSupabaseClient(supabase_url, supabase_key, pool)
+
+
+def create_openai_client(api_key: Optional[str], pool: Optional[UpstreamPool] = None,
+                         max_retries: int = 2) -> openai.AsyncOpenAI:
+    if not api_key:
+        raise ValueError("OpenAI API key not found")
+    if pool is None:
+        return openai.AsyncOpenAI(api_key=api_key, max_retries=max_retries)
+    return openai.AsyncOpenAI(api_key=api_key, http_client=pool.client(), timeout=pool.timeout, max_retries=max_retries)
@@ -0,0 +1,392 @@
+"""Persistent per-user clustering of memory embeddings.
+
+Clusters are fitted with spherical mini-batch k-means over the stored
+embeddings and saved to SQLite. Each cluster is stored with its centroid,
+member count and topic counts, and each memory with its assignment, so
+reads never recompute anything.
+
+New memories are placed incrementally. A memory joins its nearest cluster
+and that centroid takes a 1/count step toward it, the online mini-batch
+k-means update. If it is too far from every centroid, it starts a new
+cluster. A full refit is flagged once a user's memory count has doubled
+since the last fit. A user with nothing to cluster yet is stored as an
+empty fit, so later memories are placed incrementally and no refit runs
+until there are at least two. Memories placed or removed while a fit reads
+the user's rows (``begin_fit``) are replayed onto the new clusters.
+
+Names come from the most common topic among a cluster's members, so
+near-synonyms merge whenever their embeddings do. Colours are derived from
+the persisted cluster number, so they stay the same across processes.
+"""
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _unit_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+def cluster_color(cluster_id: int) -> str:
+    # Golden-angle hue steps keep neighbouring cluster numbers visually distinct
+    return f"hsl({round(cluster_id * 137.508) % 360}, 70%, 50%)"
+
+
+def cluster_name(topic_counts: Dict[str, int]) -> str:
+    if not topic_counts:
+        return "General"
+    return max(topic_counts.items(), key=lambda item: (item[1], item[0]))[0].capitalize()
+
+
+def _topic_keys(topics: Optional[List[str]]) -> List[str]:
+    return sorted({t.strip().casefold() for t in (topics or []) if t and t.strip()})
+
+
+def minibatch_kmeans(vectors: np.ndarray, k: int, batch_size: int = 256, iterations: int = 100,
+                     seed: int = 0) -> np.ndarray:
+    """Spherical mini-batch k-means (Sculley 2010) with k-means++ seeding; returns unit centroids"""
+    rng = np.random.default_rng(seed)
+    n = len(vectors)
+    k = min(k, n)
+
+    # k-means++ seeding on cosine distance, over a sample for large n
+    sample = vectors[rng.choice(n, size=min(n, 20 * k + 1000), replace=False)]
+    centroids = [sample[rng.integers(len(sample))]]
+    closest = 1 - sample @ centroids[0]
+    for _ in range(1, k):
+        weights = np.clip(closest, 0, None) ** 2
+        total = weights.sum()
+        choice = rng.choice(len(sample), p=weights / total) if total > 0 else rng.integers(len(sample))
+        centroids.append(sample[choice])
+        closest = np.minimum(closest, 1 - sample @ sample[choice])
+    centroids = np.array(centroids, dtype=np.float32)
+
+    counts = np.zeros(k, dtype=np.float64)
+    for _ in range(iterations):
+        batch = vectors[rng.choice(n, size=min(batch_size, n), replace=False)]
+        nearest = np.argmax(batch @ centroids.T, axis=1)
+        for cluster in np.unique(nearest):
+            members = batch[nearest == cluster]
+            counts[cluster] += len(members)
+            rate = len(members) / counts[cluster]
+            centroids[cluster] = (1 - rate) * centroids[cluster] + rate * members.mean(axis=0)
+        centroids = _unit_rows(centroids)
+    return centroids
+
+
+def refine(vectors: np.ndarray, centroids: np.ndarray, merge_similarity: float,
+           passes: int = 3) -> Tuple[np.ndarray, np.ndarray]:
+    """Full Lloyd passes, then merge clusters whose centroids are near-identical.
+
+    Returns (centroids, assignment) with clusters numbered densely.
+    """
+    for _ in range(passes):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        used = np.unique(assignment)
+        centroids = _unit_rows(np.stack([vectors[assignment == c].mean(axis=0) for c in used]))
+
+    # Union clusters pairwise above merge_similarity, then recompute their centroids
+    similarity = centroids @ centroids.T
+    parent = list(range(len(centroids)))
+
+    def root(c: int) -> int:
+        while parent[c] != c:
+            parent[c] = parent[parent[c]]
+            c = parent[c]
+        return c
+
+    for a, b in zip(*np.nonzero(np.triu(similarity, 1) >= merge_similarity)):
+        parent[root(int(a))] = root(int(b))
+    groups = {}
+    for c in range(len(centroids)):
+        groups.setdefault(root(c), len(groups))
+    merged = np.array([groups[root(c)] for c in range(len(centroids))])
+
+    assignment = merged[np.argmax(vectors @ centroids.T, axis=1)]
+    centroids = _unit_rows(np.stack([vectors[assignment == c].mean(axis=0) for c in range(len(groups))]))
+    return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+
+class ClusterStore:
+    """SQLite-persisted clusters and assignments per user"""
+
+    def __init__(self, db_path: str, max_clusters: int = 40, new_cluster_similarity: float = 0.5,
+                 merge_similarity: float = 0.9, refit_growth: float = 2.0):
+        self.max_clusters = max_clusters
+        self.new_cluster_similarity = new_cluster_similarity
+        self.merge_similarity = merge_similarity
+        self.refit_growth = refit_growth
+        self._lock = threading.Lock()
+        self._centroids: Dict[str, Dict[int, np.ndarray]] = {}
+        # Assignments and removals recorded while a fit is reading rows: (method name, args)
+        self._pending: Dict[str, List[Tuple[str, tuple]]] = {}
+
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """CREATE TABLE IF NOT EXISTS cluster_users (
+                user_id TEXT PRIMARY KEY,
+                dim INTEGER NOT NULL,
+                fitted_count INTEGER NOT NULL,
+                next_cluster_id INTEGER NOT NULL,
+                fitted_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS clusters (
+                user_id TEXT NOT NULL,
+                cluster_id INTEGER NOT NULL,
+                centroid BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                topic_counts TEXT NOT NULL,
+                PRIMARY KEY (user_id, cluster_id)
+            );
+            CREATE TABLE IF NOT EXISTS cluster_members (
+                user_id TEXT NOT NULL,
+                memory_id TEXT NOT NULL,
+                cluster_id INTEGER NOT NULL,
+                topics TEXT NOT NULL,
+                PRIMARY KEY (user_id, memory_id)
+            );"""
+        )
+        self._db.commit()
+
+    def has_user(self, user_id: str) -> bool:
+        with self._lock:
+            return self._db.execute(
+                "SELECT 1 FROM cluster_users WHERE user_id = ?", (user_id,)
+            ).fetchone() is not None
+
+    def needs_refit(self, user_id: str) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT fitted_count FROM cluster_users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                return True
+            members = self._db.execute(
+                "SELECT COUNT(*) FROM cluster_members WHERE user_id = ?", (user_id,)
+            ).fetchone()[0]
+        return members >= max(2, self.refit_growth * row[0])
+
+    def begin_fit(self, user_id: str):
+        """Record the user's assignments from now on, for ``fit`` to replay over rows read after this call"""
+        with self._lock:
+            self._pending.setdefault(user_id, [])
+
+    def abort_fit(self, user_id: str):
+        with self._lock:
+            self._pending.pop(user_id, None)
+
+    def _record(self, user_id: str, method: str, *args):
+        pending = self._pending.get(user_id)
+        if pending is not None:
+            pending.append((method, args))
+
+    def fit(self, user_id: str, memory_ids: List[str], vectors: np.ndarray, topic_lists: List[List[str]],
+            dim: Optional[int] = None):
+        """Replace a user's clusters with a fresh fit over all their memories; none gives an empty fit at ``dim``"""
+        if len(memory_ids) == 0:
+            self._replace(user_id, dim, {}, [], [])
+            logger.info(f"Fitted no clusters for user {user_id} (no embeddings yet)")
+            return
+        vectors = _unit_rows(np.asarray(vectors, dtype=np.float32))
+        k = int(np.clip(round(np.sqrt(len(vectors) / 2)), 1, self.max_clusters))
+        centroids, assignment = refine(vectors, minibatch_kmeans(vectors, k), self.merge_similarity)
+
+        # Drop clusters nothing was assigned to and renumber densely
+        used = sorted(set(assignment.tolist()))
+        renumber = {old: new for new, old in enumerate(used)}
+        topic_counts: Dict[int, Counter] = {new: Counter() for new in renumber.values()}
+        sizes: Counter = Counter()
+        members = []
+        for memory_id, cluster, topics in zip(memory_ids, assignment.tolist(), topic_lists):
+            cluster = renumber[cluster]
+            keys = _topic_keys(topics)
+            topic_counts[cluster].update(keys)
+            sizes[cluster] += 1
+            members.append((user_id, memory_id, cluster, json.dumps(keys)))
+
+        self._replace(user_id, vectors.shape[1], {
+            renumber[old]: (centroids[old].astype(np.float32), sizes[renumber[old]], topic_counts[renumber[old]])
+            for old in used
+        }, members, memory_ids)
+        logger.info(f"Fitted {len(used)} clusters over {len(memory_ids)} memories for user {user_id}")
+
+    def _replace(self, user_id: str, dim: Optional[int], clusters: Dict[int, Tuple[np.ndarray, int, Counter]],
+                 members: List[Tuple[str, str, int, str]], memory_ids: List[str]):
+        with self._lock:
+            pending = self._pending.pop(user_id, [])
+            if dim is None:
+                row = self._db.execute("SELECT dim FROM cluster_users WHERE user_id = ?", (user_id,)).fetchone()
+                dim = row[0] if row else 0
+            self._db.execute("DELETE FROM clusters WHERE user_id = ?", (user_id,))
+            self._db.execute("DELETE FROM cluster_members WHERE user_id = ?", (user_id,))
+            self._db.execute(
+                "INSERT OR REPLACE INTO cluster_users (user_id, dim, fitted_count, next_cluster_id, fitted_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (user_id, dim, len(memory_ids), len(clusters), time.time()),
+            )
+            self._db.executemany(
+                "INSERT INTO clusters (user_id, cluster_id, centroid, size, topic_counts) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (user_id, cluster_id, centroid.tobytes(), size, json.dumps(counts))
+                    for cluster_id, (centroid, size, counts) in clusters.items()
+                ],
+            )
+            self._db.executemany(
+                "INSERT INTO cluster_members (user_id, memory_id, cluster_id, topics) VALUES (?, ?, ?, ?)", members
+            )
+            self._centroids.pop(user_id, None)
+            # Memories saved or deleted while the fit was reading rows; the fit may not have seen them
+            for method, args in pending:
+                getattr(self, method)(user_id, *args)
+            self._db.commit()
+
+    def _load_centroids(self, user_id: str) -> Dict[int, np.ndarray]:
+        centroids = self._centroids.get(user_id)
+        if centroids is None:
+            centroids = {
+                cluster_id: np.frombuffer(blob, dtype=np.float32).copy()
+                for cluster_id, blob in self._db.execute(
+                    "SELECT cluster_id, centroid FROM clusters WHERE user_id = ?", (user_id,)
+                )
+            }
+            self._centroids[user_id] = centroids
+        return centroids
+
+    def assign(self, user_id: str, memory_id: str, vector: List[float], topics: Optional[List[str]]) -> Optional[int]:
+        """Place one new memory; None until the user has been fitted"""
+        with self._lock:
+            self._record(user_id, "_assign", memory_id, vector, topics)
+            best = self._assign(user_id, memory_id, vector, topics)
+            self._db.commit()
+            return best
+
+    def _assign(self, user_id: str, memory_id: str, vector: List[float], topics: Optional[List[str]]) -> Optional[int]:
+        user = self._db.execute(
+            "SELECT dim, next_cluster_id FROM cluster_users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if user is None or vector is None:
+            return None
+        vector = np.asarray(vector, dtype=np.float32)
+        if len(vector) != user[0]:
+            return None
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+
+        self._remove_member(user_id, memory_id)
+        centroids = self._load_centroids(user_id)
+        keys = _topic_keys(topics)
+
+        best, best_similarity = None, -1.0
+        for cluster_id, centroid in centroids.items():
+            similarity = float(centroid @ vector)
+            if similarity > best_similarity:
+                best, best_similarity = cluster_id, similarity
+
+        if best is None or (best_similarity < self.new_cluster_similarity and len(centroids) < self.max_clusters):
+            best = user[1]
+            centroids[best] = vector
+            self._db.execute(
+                "INSERT INTO clusters (user_id, cluster_id, centroid, size, topic_counts) VALUES (?, ?, ?, 1, ?)",
+                (user_id, best, vector.tobytes(), json.dumps(Counter(keys))),
+            )
+            self._db.execute(
+                "UPDATE cluster_users SET next_cluster_id = ? WHERE user_id = ?", (best + 1, user_id)
+            )
+        else:
+            size, topic_counts = self._db.execute(
+                "SELECT size, topic_counts FROM clusters WHERE user_id = ? AND cluster_id = ?", (user_id, best)
+            ).fetchone()
+            size += 1
+            centroid = centroids[best] + (vector - centroids[best]) / size
+            centroid /= np.linalg.norm(centroid) or 1.0
+            centroids[best] = centroid.astype(np.float32)
+            counts = Counter(json.loads(topic_counts))
+            counts.update(keys)
+            self._db.execute(
+                "UPDATE clusters SET centroid = ?, size = ?, topic_counts = ? WHERE user_id = ? AND cluster_id = ?",
+                (centroids[best].tobytes(), size, json.dumps(counts), user_id, best),
+            )
+
+        self._db.execute(
+            "INSERT INTO cluster_members (user_id, memory_id, cluster_id, topics) VALUES (?, ?, ?, ?)",
+            (user_id, memory_id, best, json.dumps(keys)),
+        )
+        return best
+
+    def remove(self, user_id: str, memory_id: str):
+        with self._lock:
+            self._record(user_id, "_remove_member", memory_id)
+            self._remove_member(user_id, memory_id)
+            self._db.commit()
+
+    def _remove_member(self, user_id: str, memory_id: str):
+        member = self._db.execute(
+            "SELECT cluster_id, topics FROM cluster_members WHERE user_id = ? AND memory_id = ?", (user_id, memory_id)
+        ).fetchone()
+        if member is None:
+            return
+        cluster_id, topics = member
+        self._db.execute("DELETE FROM cluster_members WHERE user_id = ? AND memory_id = ?", (user_id, memory_id))
+        row = self._db.execute(
+            "SELECT size, topic_counts FROM clusters WHERE user_id = ? AND cluster_id = ?", (user_id, cluster_id)
+        ).fetchone()
+        if row is None:
+            return
+        if row[0] <= 1:
+            self._db.execute("DELETE FROM clusters WHERE user_id = ? AND cluster_id = ?", (user_id, cluster_id))
+            self._load_centroids(user_id).pop(cluster_id, None)
+            return
+        counts = Counter(json.loads(row[1]))
+        counts.subtract(json.loads(topics))
+        self._db.execute(
+            "UPDATE clusters SET size = ?, topic_counts = ? WHERE user_id = ? AND cluster_id = ?",
+            (row[0] - 1, json.dumps(+counts), user_id, cluster_id),
+        )
+
+    def clusters(self, user_id: str, memory_ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Persisted clusters in the graph response shape, optionally limited to some memories"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT cluster_id, size, topic_counts FROM clusters WHERE user_id = ? ORDER BY cluster_id", (user_id,)
+            ).fetchall()
+            members: Dict[int, List[str]] = {}
+            for memory_id, cluster_id in self._db.execute(
+                "SELECT memory_id, cluster_id FROM cluster_members WHERE user_id = ?", (user_id,)
+            ):
+                members.setdefault(cluster_id, []).append(memory_id)
+
+        wanted = set(memory_ids) if memory_ids is not None else None
+        result = []
+        for cluster_id, size, topic_counts in rows:
+            nodes = members.get(cluster_id, [])
+            if wanted is not None:
+                nodes = [memory_id for memory_id in nodes if memory_id in wanted]
+            if not nodes:
+                continue
+            counts = json.loads(topic_counts)
+            result.append({
+                "id": f"cluster-{cluster_id}",
+                "name": cluster_name(counts),
+                "nodes": nodes,
+                "color": cluster_color(cluster_id),
+                "size": size,
+                "top_topics": [topic for topic, _ in Counter(counts).most_common(3)]
+            })
+        return result
+
+    def forget(self, user_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM clusters WHERE user_id = ?", (user_id,))
+            self._db.execute("DELETE FROM cluster_members WHERE user_id = ?", (user_id,))
+            self._db.execute("DELETE FROM cluster_users WHERE user_id = ?", (user_id,))
+            self._db.commit()
+            self._centroids.pop(user_id, None)
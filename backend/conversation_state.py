@@ -0,0 +1,188 @@
+"""Incremental per-conversation analysis state.
+
+The extension keeps re-sending a conversation's history, so analysis that
+starts from scratch on every call costs O(history). This module keeps running
+aggregates per ``conversation_id``: topic overlap sums, distinct topics,
+recent messages and token counts. Each call then only processes the
+messages added since the last one. The aggregates reproduce what
+``analyze_conversation_coherence`` computes over the full history.
+
+State is keyed by the caller's user id as well as ``conversation_id``: the
+id comes from the client, so two users' conversations must never share (or
+read) one state. Conversations are held in an LRU with a TTL. A state that is evicted, or that
+no longer lines up with the client's cursor, is rebuilt from a full history.
+"""
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional, Set
+import hashlib
+import time
+
+
+def _fingerprint(messages: List[Dict]) -> str:
+    digest = hashlib.sha1()
+    for msg in messages:
+        digest.update(f"{msg.get('role')}\x00{msg.get('content', '')}\x01".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ConversationState:
+    """Running aggregates for one conversation"""
+
+    def __init__(self, extract_topics: Callable[[str], List[str]],
+                 is_similar_question: Callable[[str, str], bool],
+                 is_vague_response: Callable[[str], bool],
+                 count_tokens: Callable[[Dict], int]):
+        self._extract_topics = extract_topics
+        self._is_similar_question = is_similar_question
+        self._is_vague_response = is_vague_response
+        self._count_tokens = count_tokens
+
+        self.message_count = 0
+        self.content_tokens = 0
+        self.user_turns = 0
+        self.overlap_sum = 0.0
+        self.topics_seen: Set[str] = set()
+        self.topic_sequence_length = 0
+        self.last_user_topics: Optional[List[str]] = None
+        self.recent_user_messages: deque = deque(maxlen=3)
+        self.last_assistant_message: Optional[str] = None
+        self.recent_messages: deque = deque(maxlen=8)
+        self.tail_fingerprint: Optional[str] = None
+        self.updated_at = time.time()
+
+    def append(self, messages: List[Dict]):
+        for msg in messages:
+            content = msg.get("content", "")
+            self.message_count += 1
+            self.content_tokens += self._count_tokens(msg)
+            self.recent_messages.append(msg)
+
+            if msg.get("role") == "user":
+                topics = self._extract_topics(content)
+                if self.last_user_topics is not None:
+                    self.overlap_sum += self._overlap(self.last_user_topics, topics)
+                self.last_user_topics = topics
+                self.user_turns += 1
+                self.topics_seen.update(topics)
+                self.topic_sequence_length += len(topics)
+                self.recent_user_messages.append(content)
+            elif msg.get("role") == "assistant":
+                self.last_assistant_message = content
+
+        self.tail_fingerprint = _fingerprint(list(self.recent_messages)[-2:])
+        self.updated_at = time.time()
+
+    @staticmethod
+    def _overlap(previous: List[str], current: List[str]) -> float:
+        previous_topics, current_topics = set(previous), set(current)
+        if not current_topics or not previous_topics:
+            return 0.5
+        union = len(current_topics | previous_topics)
+        return len(current_topics & previous_topics) / union if union > 0 else 0
+
+    def issues(self) -> List[str]:
+        issues = []
+        if self.message_count < 2:
+            return issues
+
+        if len(self.recent_user_messages) >= 3:
+            recent = list(self.recent_user_messages)
+            if any(self._is_similar_question(recent[0], msg) for msg in recent[1:]):
+                issues.append("repetitive_questions")
+
+        if self.last_assistant_message is not None and self._is_vague_response(self.last_assistant_message):
+            issues.append("vague_response")
+
+        if self.message_count > 10:
+            issues.append("potentially_stuck")
+
+        if len(self.topics_seen) > self.topic_sequence_length * 0.8:
+            issues.append("topic_jumping")
+
+        return issues
+
+    def coherence(self) -> Dict:
+        """Same result as analyze_conversation_coherence over the full history"""
+        if self.message_count < 4 or self.user_turns < 2:
+            return {"coherence_score": 8.0, "issues": []}
+
+        avg_overlap = self.overlap_sum / (self.user_turns - 1)
+        return {
+            "coherence_score": min(10.0, max(0.0, 10 * avg_overlap + 3)),
+            "issues": self.issues(),
+            "topic_drift": len(self.topics_seen) / self.user_turns,
+            "conversation_depth": {"depth_score": 5.0, "progression": "stable"}
+        }
+
+
+class ConversationStateStore:
+    """LRU of ConversationState keyed by (namespace, user_id, conversation_id, token encoding)"""
+
+    def __init__(self, extract_topics: Callable[[str], List[str]],
+                 is_similar_question: Callable[[str, str], bool],
+                 is_vague_response: Callable[[str], bool],
+                 count_tokens: Optional[Callable[[Dict, Optional[str]], int]] = None,
+                 max_conversations: int = 10000, ttl_seconds: float = 6 * 3600):
+        # count_tokens(message, encoding); states counted with different encodings are kept apart
+        self._count_tokens = count_tokens or (lambda msg, encoding=None: len(msg.get("content", "")) // 4)
+        self._analyzers = (extract_topics, is_similar_question, is_vague_response)
+        self.max_conversations = max_conversations
+        self.ttl_seconds = ttl_seconds
+        self._states: "OrderedDict[tuple, ConversationState]" = OrderedDict()
+        self.stats = {"incremental": 0, "rebuilt": 0, "resync_required": 0}
+
+    def _get(self, key: tuple) -> Optional[ConversationState]:
+        state = self._states.get(key)
+        if state is None:
+            return None
+        if time.time() - state.updated_at > self.ttl_seconds:
+            del self._states[key]
+            return None
+        self._states.move_to_end(key)
+        return state
+
+    def _new(self, key: tuple, encoding: Optional[str]) -> ConversationState:
+        state = ConversationState(*self._analyzers, lambda msg: self._count_tokens(msg, encoding))
+        self._states[key] = state
+        while len(self._states) > self.max_conversations:
+            self._states.popitem(last=False)
+        return state
+
+    def apply_delta(self, namespace: str, user_id: str, conversation_id: str, cursor: int,
+                    new_messages: List[Dict], encoding: Optional[str] = None) -> Optional[ConversationState]:
+        """Append messages sent after ``cursor``; None means the client must resend the full history"""
+        key = (namespace, user_id, conversation_id, encoding)
+        state = self._get(key)
+        if state is None and cursor == 0:
+            state = self._new(key, encoding)
+        if state is None or state.message_count != cursor:
+            self.stats["resync_required"] += 1
+            return None
+        state.append(new_messages)
+        self.stats["incremental"] += 1
+        return state
+
+    def sync(self, namespace: str, user_id: str, conversation_id: str, history: List[Dict],
+             encoding: Optional[str] = None) -> ConversationState:
+        """Bring state up to date from a full (or trailing-window) history.
+
+        The tail of what was already seen is located in ``history`` so only the
+        messages after it are processed. If it cannot be found, the state is
+        rebuilt from ``history``.
+        """
+        key = (namespace, user_id, conversation_id, encoding)
+        state = self._get(key)
+        if state is not None and state.tail_fingerprint is not None:
+            for end in range(len(history), 1, -1):
+                if _fingerprint(history[end - 2:end]) == state.tail_fingerprint:
+                    state.append(history[end:])
+                    self.stats["incremental"] += 1
+                    return state
+
+        state = self._new(key, encoding)
+        state.append(history)
+        self.stats["rebuilt"] += 1
+        return state
+
+    def snapshot(self) -> Dict:
+        return {**self.stats, "conversations": len(self._states)}
@@ -0,0 +1,125 @@
+"""Content-addressed cache for OpenAI embeddings.
+
+Entries are keyed by a hash of (model, normalized text). Lookups check an
+in-process LRU first, bounded by the total size of the stored vectors, and then
+an optional SQLite file that survives restarts.
+"""
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import asyncio
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Normalize unicode and collapse whitespace so trivially different inputs share a key"""
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def cache_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Two-tier embedding cache: byte-bounded LRU in memory, optional SQLite on disk"""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, db_path: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.db_path = db_path
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._bytes = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    dim INTEGER NOT NULL,
+                    vector BLOB NOT NULL,
+                    created_at REAL NOT NULL
+                )"""
+            )
+            self._db.commit()
+
+    async def get(self, model: str, text: str) -> Optional[List[float]]:
+        key = cache_key(model, text)
+
+        vector = self._entries.get(key)
+        if vector is not None:
+            self._entries.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return vector.tolist()
+
+        if self._db is not None:
+            vector = await asyncio.to_thread(self._disk_get, key)
+            if vector is not None:
+                self._remember(key, vector)
+                self.stats["disk_hits"] += 1
+                return vector.tolist()
+
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, model: str, text: str, embedding: List[float]):
+        key = cache_key(model, text)
+        vector = np.asarray(embedding, dtype=np.float32)
+        self._remember(key, vector)
+        if self._db is not None:
+            await asyncio.to_thread(self._disk_put, key, model, vector)
+
+    def _remember(self, key: str, vector: np.ndarray):
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key).nbytes
+        self._entries[key] = vector
+        self._bytes += vector.nbytes
+
+        while self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self.stats["evictions"] += 1
+
+    def _disk_get(self, key: str) -> Optional[np.ndarray]:
+        with self._db_lock:
+            row = self._db.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32).copy()
+
+    def _disk_put(self, key: str, model: str, vector: np.ndarray):
+        try:
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, model, dim, vector, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, model, int(vector.shape[0]), vector.tobytes(), time.time()),
+                )
+                self._db.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Embedding cache disk write failed: {e}")
+
+    def snapshot(self) -> Dict:
+        lookups = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["misses"]
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+            "persistent": self._db is not None,
+        }
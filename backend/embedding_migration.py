@@ -0,0 +1,91 @@
+"""Checkpointed progress of re-embedding a user's memories at a new model and dimension.
+
+The migration job walks a user's memories newest first, in batches
+keyset-paged on ``(created_at, id)``. After each batch it records the last key
+here. A retried or re-requested job therefore resumes after the last finished
+batch instead of re-embedding from the start. Once a user's record for the
+current target is ``done``, none of their rows are at another dimension, and
+search stops querying the old ones.
+"""
+from typing import Dict, Optional, Set, Tuple
+import sqlite3
+import threading
+import time
+
+
+class EmbeddingMigrations:
+    """SQLite progress records keyed by (user, target tag), with completed pairs cached in memory"""
+
+    def __init__(self, db_path: str):
+        self._lock = threading.Lock()
+        self._done: Set[Tuple[str, str]] = set()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS embedding_migrations (
+                user_id TEXT NOT NULL,
+                target TEXT NOT NULL,
+                status TEXT NOT NULL,
+                cursor_created_at TEXT,
+                cursor_id TEXT,
+                migrated INTEGER NOT NULL DEFAULT 0,
+                skipped INTEGER NOT NULL DEFAULT 0,
+                started_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (user_id, target)
+            )"""
+        )
+        self._db.commit()
+        self._done.update(
+            (row["user_id"], row["target"])
+            for row in self._db.execute("SELECT user_id, target FROM embedding_migrations WHERE status = 'done'")
+        )
+
+    def get(self, user_id: str, target: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM embedding_migrations WHERE user_id = ? AND target = ?", (user_id, target)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "target": row["target"],
+            "status": row["status"],
+            "cursor": (row["cursor_created_at"], row["cursor_id"]) if row["cursor_id"] else None,
+            "migrated": row["migrated"],
+            "skipped": row["skipped"],
+            "started_at": row["started_at"],
+            "updated_at": row["updated_at"]
+        }
+
+    def is_done(self, user_id: str, target: str) -> bool:
+        return (user_id, target) in self._done
+
+    def _save(self, user_id: str, target: str, status: str, cursor: Optional[Tuple[str, str]],
+              migrated: int, skipped: int):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO embedding_migrations "
+                "(user_id, target, status, cursor_created_at, cursor_id, migrated, skipped, started_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id, target) DO UPDATE SET status = excluded.status, "
+                "cursor_created_at = excluded.cursor_created_at, cursor_id = excluded.cursor_id, "
+                "migrated = excluded.migrated, skipped = excluded.skipped, updated_at = excluded.updated_at",
+                (user_id, target, status, cursor[0] if cursor else None, cursor[1] if cursor else None,
+                 migrated, skipped, now, now),
+            )
+            self._db.commit()
+
+    def checkpoint(self, user_id: str, target: str, cursor: Tuple[str, str], migrated: int, skipped: int):
+        self._save(user_id, target, "running", cursor, migrated, skipped)
+
+    def finish(self, user_id: str, target: str, migrated: int, skipped: int):
+        self._save(user_id, target, "done", None, migrated, skipped)
+        self._done.add((user_id, target))
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM embedding_migrations GROUP BY status").fetchall()
+        return {row[0]: row[1] for row in rows}
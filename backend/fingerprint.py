@@ -0,0 +1,220 @@
+"""MinHash fingerprints for spotting re-saved conversations.
+
+The extension saves a ChatGPT thread again every time the user clicks save, so
+one conversation can arrive many times, each copy a little longer. Saves that
+carry a thread's URL (``thread_url``: ``/c/<id>``, not the bare site or a
+temporary chat) are matched on the URL. Other saves are matched here, on
+content. A conversation's text is cut into overlapping 5-word
+shingles, and ``signature`` keeps the minimum of each of 64 universal hashes
+over those shingles (Broder 1997). The share of positions where two
+signatures agree estimates the Jaccard similarity of the two shingle sets, to
+within about +-0.06 at 64 hashes.
+
+A signature is 256 bytes and is stored base64-encoded in the memory's
+``fingerprint`` column. ``FingerprintIndex`` keeps each active user's
+signatures in one matrix, so a save compares against all of that user's
+memories in a single vectorized pass.
+
+A match only says which memory a save would update. Unless the save just
+extends the stored text, it replaces it only if ``shingle_overlap`` shows the
+two texts are mostly the same conversation.
+"""
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+import base64
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+
+NUM_HASHES = 64
+SHINGLE_WORDS = 5
+
+# Largest prime below 2^32: a, b and x mod p all fit in 32 bits, so a * x + b fits in 64
+_PRIME = np.uint64(4294967291)
+_rng = np.random.default_rng(0x5EED)
+_A = _rng.integers(1, int(_PRIME), NUM_HASHES, dtype=np.uint64)
+_B = _rng.integers(0, int(_PRIME), NUM_HASHES, dtype=np.uint64)
+_TOKEN = re.compile(r"\w+")
+_BLOCK = 4096
+# ChatGPT thread paths, optionally inside a custom GPT: /c/<id>, /g/<gpt>/c/<id>
+_THREAD_PATH = re.compile(r"^(?:/g/[^/]+)?/c/[A-Za-z0-9-]+/?$")
+
+
+def thread_url(url: Optional[str]) -> Optional[str]:
+    """The URL without query or fragment if it names one conversation thread, else None"""
+    if not url:
+        return None
+    parts = urlsplit(url.strip())
+    if not parts.netloc or not _THREAD_PATH.match(parts.path):
+        return None
+    return f"{parts.scheme}://{parts.netloc}{parts.path.rstrip('/')}"
+
+
+def shingle_hashes(text: str, size: int = SHINGLE_WORDS) -> np.ndarray:
+    """crc32 of every run of ``size`` consecutive lowercased words"""
+    words = _TOKEN.findall((text or "").lower())
+    if len(words) <= size:
+        return np.array([zlib.crc32(" ".join(words).encode("utf-8"))], dtype=np.uint64)
+    return np.unique(np.fromiter(
+        (zlib.crc32(" ".join(words[i:i + size]).encode("utf-8")) for i in range(len(words) - size + 1)),
+        dtype=np.uint64, count=len(words) - size + 1
+    ))
+
+
+def signature(text: str) -> np.ndarray:
+    """MinHash signature: per hash function, the minimum of (a * x + b) mod p over the shingles"""
+    hashes = shingle_hashes(text) % _PRIME
+    mins = np.full(NUM_HASHES, _PRIME, dtype=np.uint64)
+    for start in range(0, len(hashes), _BLOCK):
+        block = hashes[start:start + _BLOCK]
+        mins = np.minimum(mins, ((_A[:, None] * block[None, :] + _B[:, None]) % _PRIME).min(axis=1))
+    return mins.astype(np.uint32)
+
+
+def encode(sig: np.ndarray) -> str:
+    return base64.b64encode(sig.astype("<u4").tobytes()).decode("ascii")
+
+
+def decode(value: Optional[str]) -> Optional[np.ndarray]:
+    if not value:
+        return None
+    try:
+        sig = np.frombuffer(base64.b64decode(value), dtype="<u4")
+    except (ValueError, TypeError):
+        return None
+    return sig.astype(np.uint32) if len(sig) == NUM_HASHES else None
+
+
+def text_fingerprint(text: str) -> str:
+    """Encoded signature of text, as stored in the ``fingerprint`` column"""
+    return encode(signature(text))
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Estimated Jaccard similarity of the two shingle sets"""
+    return float(np.mean(a == b))
+
+
+def shingle_overlap(previous_text: str, text: str) -> float:
+    """Share of the previous text's shingles that still occur in the new one; 1.0 when it only grew"""
+    previous = shingle_hashes(previous_text)
+    return float(np.isin(previous, shingle_hashes(text), assume_unique=True).mean())
+
+
+def appended_turns(previous_content: str, turns: List[str]) -> Optional[int]:
+    """Number of leading turns that reproduce ``previous_content`` exactly, if the conversation only grew
+
+    None when the stored text is not a whole-turn prefix of the new one
+    (an edited or regenerated message, or a different conversation).
+    """
+    if not previous_content:
+        return None
+    length = -1
+    for count, turn in enumerate(turns, 1):
+        length += len(turn) + 1
+        if length == len(previous_content):
+            return count if "\n".join(turns[:count]) == previous_content else None
+        if length > len(previous_content):
+            return None
+    return None
+
+
+class _UserFingerprints:
+    def __init__(self):
+        self.signatures: Dict[str, np.ndarray] = {}
+        self._ids: List[str] = []
+        self._matrix: Optional[np.ndarray] = None
+        self.built_at = time.time()
+
+    def set(self, memory_id: str, sig: Optional[np.ndarray]):
+        if sig is None:
+            self.signatures.pop(memory_id, None)
+        else:
+            self.signatures[memory_id] = sig
+        self._matrix = None
+
+    def nearest(self, sig: np.ndarray) -> Optional[Tuple[str, float]]:
+        if not self.signatures:
+            return None
+        if self._matrix is None:
+            self._ids = list(self.signatures)
+            self._matrix = np.stack([self.signatures[memory_id] for memory_id in self._ids])
+        scores = (self._matrix == sig).mean(axis=1)
+        best = int(np.argmax(scores))
+        return self._ids[best], float(scores[best])
+
+
+class FingerprintIndex:
+    """Per-user MinHash signatures, LRU-bounded and rebuilt after ``max_age_seconds``"""
+
+    def __init__(self, max_users: int = 500, max_age_seconds: float = 600):
+        self.max_users = max_users
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._users: "OrderedDict[str, _UserFingerprints]" = OrderedDict()
+        self.stats = {"builds": 0, "lookups": 0, "matches": 0}
+
+    def has_user(self, user_id: str) -> bool:
+        with self._lock:
+            index = self._users.get(user_id)
+            if index is None:
+                return False
+            if time.time() - index.built_at > self.max_age_seconds:
+                del self._users[user_id]
+                return False
+            return True
+
+    def build(self, user_id: str, rows: List[Dict[str, Any]]):
+        """Replace a user's signatures with the given rows (id, fingerprint); rows without one are skipped"""
+        index = _UserFingerprints()
+        for row in rows:
+            index.set(str(row["id"]), decode(row.get("fingerprint")))
+        with self._lock:
+            self._users[user_id] = index
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+            self.stats["builds"] += 1
+
+    def add(self, user_id: str, memory_id: str, fingerprint: Optional[str]):
+        """Insert or replace one memory's signature; no-op until the user's index has been built"""
+        with self._lock:
+            index = self._users.get(user_id)
+            if index is not None:
+                index.set(str(memory_id), decode(fingerprint))
+
+    def remove(self, user_id: str, memory_id: str):
+        self.add(user_id, memory_id, None)
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def nearest(self, user_id: str, fingerprint: str, threshold: float) -> Optional[Tuple[str, float]]:
+        """The user's most similar memory as (memory_id, similarity) if it reaches threshold"""
+        sig = decode(fingerprint)
+        if sig is None:
+            return None
+        with self._lock:
+            index = self._users.get(user_id)
+            if index is None:
+                return None
+            self._users.move_to_end(user_id)
+            self.stats["lookups"] += 1
+            best = index.nearest(sig)
+            if best is None or best[1] < threshold:
+                return None
+            self.stats["matches"] += 1
+            return best
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                **self.stats,
+                "users": len(self._users),
+                "signatures": sum(len(index.signatures) for index in self._users.values())
+            }
@@ -0,0 +1,219 @@
+"""Durable background job queue backed by SQLite.
+
+Jobs are rows in a local SQLite file, so they survive restarts. A fixed pool of
+asyncio workers claims due jobs, caps concurrency at the pool size, and
+reschedules failed jobs with exponential backoff until ``max_attempts``.
+
+A claim counts as an attempt and takes a lease of ``lease_seconds`` that the
+running worker renews as a heartbeat. A job whose lease has run out belonged
+to a worker that died, and any process sharing the file claims it again. Jobs
+that other live workers hold are left alone. A job that keeps killing its
+worker uses up its attempts like one that raises, and then it is failed.
+"""
+from typing import Any, Awaitable, Callable, Dict, Optional
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+JobHandler = Callable[[Dict[str, Any]], Awaitable[Optional[Dict[str, Any]]]]
+
+
+class JobQueue:
+    """SQLite-backed queue with a bounded asyncio worker pool"""
+
+    def __init__(self, db_path: str, workers: int = 4, max_attempts: int = 5,
+                 backoff_base: float = 2.0, backoff_max: float = 300.0, poll_interval: float = 1.0,
+                 lease_seconds: float = 60.0):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self._handlers: Dict[str, JobHandler] = {}
+        self._tasks = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                user_id TEXT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                run_at REAL NOT NULL,
+                last_error TEXT,
+                result TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                lease_owner TEXT,
+                lease_until REAL
+            )"""
+        )
+        # Files created before leases existed
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        for column, column_type in (("lease_owner", "TEXT"), ("lease_until", "REAL")):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, run_at)")
+        self._db.commit()
+
+    def register(self, kind: str, handler: JobHandler):
+        self._handlers[kind] = handler
+
+    async def enqueue(self, kind: str, payload: Dict[str, Any], user_id: Optional[str] = None) -> str:
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO jobs (id, kind, user_id, payload, status, run_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+            (job_id, kind, user_id, json.dumps(payload), now, now, now),
+        )
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = await asyncio.to_thread(self._fetchone, "SELECT * FROM jobs WHERE id = ?", (job_id,))
+        if row is None:
+            return None
+        return {
+            "id": row["id"],
+            "kind": row["kind"],
+            "user_id": row["user_id"],
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "next_attempt_at": row["run_at"] if row["status"] == "queued" else None,
+            "last_error": row["last_error"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"]
+        }
+
+    def start(self):
+        # Jobs left running by a dead worker are reclaimed by _claim once their lease expires
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Job queue started with {self.workers} workers")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    async def _worker(self, worker_id: int):
+        while True:
+            job = await asyncio.to_thread(self._claim)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _heartbeat(self, job_id: str, owner: str):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            await asyncio.to_thread(
+                self._execute,
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND lease_owner = ?",
+                (time.time() + self.lease_seconds, job_id, owner),
+            )
+
+    async def _run(self, job: Dict[str, Any]):
+        handler = self._handlers.get(job["kind"])
+        attempts, owner = job["attempts"], job["lease_owner"]
+        heartbeat = asyncio.create_task(self._heartbeat(job["id"], owner))
+        try:
+            if handler is None:
+                raise RuntimeError(f"No handler registered for job kind {job['kind']}")
+            result = await handler(json.loads(job["payload"]))
+            outcome = (
+                "UPDATE jobs SET status = 'done', result = ?, last_error = NULL, lease_owner = NULL, "
+                "lease_until = NULL, updated_at = ? WHERE id = ? AND lease_owner = ?",
+                (json.dumps(result or {}, default=str), time.time(), job["id"], owner),
+            )
+        except Exception as e:
+            if attempts >= self.max_attempts:
+                status, run_at = "failed", time.time()
+                logger.error(f"Job {job['id']} ({job['kind']}) failed permanently after {attempts} attempts: {e}")
+            else:
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+                status, run_at = "queued", time.time() + delay * random.uniform(0.8, 1.2)
+                logger.warning(f"Job {job['id']} ({job['kind']}) attempt {attempts} failed, retrying in {delay:.0f}s: {e}")
+            outcome = (
+                "UPDATE jobs SET status = ?, run_at = ?, last_error = ?, lease_owner = NULL, lease_until = NULL, "
+                "updated_at = ? WHERE id = ? AND lease_owner = ?",
+                (status, run_at, str(e), time.time(), job["id"], owner),
+            )
+        finally:
+            heartbeat.cancel()
+        # Guarded by the lease owner: if our lease lapsed and another worker reclaimed the job, its outcome wins
+        await asyncio.to_thread(self._execute, *outcome)
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            while True:
+                now = time.time()
+                row = self._db.execute(
+                    "SELECT * FROM jobs WHERE (status = 'queued' AND run_at <= ?) "
+                    "OR (status = 'running' AND (lease_until IS NULL OR lease_until < ?)) ORDER BY run_at LIMIT 1",
+                    (now, now),
+                ).fetchone()
+                if row is None:
+                    return None
+
+                # The attempt count is the compare-and-swap guard, so two processes sharing the file cannot claim the same job
+                if row["status"] == "running" and row["attempts"] >= self.max_attempts:
+                    # Its worker died on the last allowed attempt: don't let a crashing job loop forever
+                    self._db.execute(
+                        "UPDATE jobs SET status = 'failed', last_error = ?, lease_owner = NULL, lease_until = NULL, "
+                        "updated_at = ? WHERE id = ? AND attempts = ? AND status = 'running'",
+                        (f"Worker lost during attempt {row['attempts']}", now, row["id"], row["attempts"]),
+                    )
+                    self._db.commit()
+                    logger.error(f"Job {row['id']} ({row['kind']}) failed permanently: worker lost on every attempt")
+                    continue
+
+                owner = str(uuid.uuid4())
+                claimed = self._db.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_owner = ?, lease_until = ?, "
+                    "updated_at = ? WHERE id = ? AND status = ? AND attempts = ?",
+                    (owner, now + self.lease_seconds, now, row["id"], row["status"], row["attempts"]),
+                ).rowcount
+                self._db.commit()
+                if not claimed:
+                    return None
+                if row["status"] == "running":
+                    logger.warning(f"Job {row['id']} ({row['kind']}) lease expired, reclaiming it")
+                return {**dict(row), "attempts": row["attempts"] + 1, "lease_owner": owner}
+
+    def _execute(self, sql: str, params: tuple):
+        with self._lock:
+            self._db.execute(sql, params)
+            self._db.commit()
+
+    def _fetchone(self, sql: str, params: tuple) -> Optional[sqlite3.Row]:
+        with self._lock:
+            return self._db.execute(sql, params).fetchone()
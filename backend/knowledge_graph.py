@@ -0,0 +1,237 @@
+"""Knowledge graph construction for /generate_knowledge_graph.
+
+Edges come from two row-normalized matrices, each multiplied by its own
+transpose in row blocks:
+
+* topic edges: an IDF-weighted memory x topic incidence matrix. Only topics
+  shared by at least two memories get a column, because a topic held by one
+  memory cannot connect anything. That keeps the matrix small even when
+  topics are free text. The edge weight is the cosine of the two memories'
+  topic vectors, so a shared rare topic counts for more than a shared
+  "general".
+* similarity edges: unit embeddings, where the edge weight is cosine
+  similarity.
+
+Each node keeps only its ``top_k`` strongest neighbours (argpartition per
+block). The edge count is therefore O(n * k), not O(n^2) per topic. Results
+are cached per user under a signature of the memory set: ids, ``updated_at``
+and message counts. A graph is therefore rebuilt only after a memory is
+added, edited or removed, and checking it never reads memory content. A
+rebuild reuses the embeddings of memories whose ``updated_at`` is unchanged
+since the last build, and fetches only the rest.
+"""
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import hashlib
+import json
+import math
+
+import numpy as np
+
+
+def top_k_pairs(matrix: np.ndarray, top_k: int, min_weight: float,
+                block_elements: int = 4_000_000) -> List[Tuple[int, int, float]]:
+    """Undirected (i, j, weight) edges, i < j, keeping each row's top_k entries of matrix @ matrix.T"""
+    n = len(matrix)
+    if n < 2 or top_k <= 0:
+        return []
+    k = min(top_k, n - 1)
+    # Score blocks are block_size x n; bound them to ~16MB of float32
+    block_size = max(64, block_elements // n)
+
+    sources, targets, weights = [], [], []
+    for start in range(0, n, block_size):
+        scores = matrix[start:start + block_size] @ matrix.T
+        rows = np.arange(len(scores))
+        scores[rows, start + rows] = -np.inf  # no self loops
+
+        neighbours = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        neighbour_weights = np.take_along_axis(scores, neighbours, axis=1)
+        keep = (neighbour_weights >= min_weight) & (neighbour_weights > 0)
+
+        sources.append(np.broadcast_to((start + rows)[:, None], neighbours.shape)[keep])
+        targets.append(neighbours[keep])
+        weights.append(neighbour_weights[keep])
+
+    src, dst, weight = np.concatenate(sources), np.concatenate(targets), np.concatenate(weights)
+    low, high = np.minimum(src, dst), np.maximum(src, dst)
+    # i->j and j->i both survive when each is in the other's top k; keep one
+    _, first = np.unique(low.astype(np.int64) * n + high, return_index=True)
+    return list(zip(low[first].tolist(), high[first].tolist(), weight[first].astype(float).tolist()))
+
+
+def topic_matrix(topic_lists: List[List[str]]) -> Tuple[np.ndarray, List[str], np.ndarray]:
+    """Row-normalized IDF incidence matrix over topics shared by two or more memories"""
+    n = len(topic_lists)
+    document_frequency = Counter(topic for topics in topic_lists for topic in set(topics))
+    vocabulary = sorted(topic for topic, df in document_frequency.items() if df >= 2)
+    columns = {topic: column for column, topic in enumerate(vocabulary)}
+    idf = np.array([math.log(1 + n / document_frequency[topic]) for topic in vocabulary], dtype=np.float32)
+
+    matrix = np.zeros((n, len(vocabulary)), dtype=np.float32)
+    rows = [i for i, topics in enumerate(topic_lists) for topic in set(topics) if topic in columns]
+    cols = [columns[topic] for topics in topic_lists for topic in set(topics) if topic in columns]
+    if rows:
+        matrix[rows, cols] = idf[cols]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix, vocabulary, idf
+
+
+def content_length(memory: Dict[str, Any]) -> int:
+    """Stored at save time; rows saved before the column existed fall back to their content"""
+    if memory.get('content_length') is not None:
+        return memory['content_length']
+    return len(memory.get('content') or '')
+
+
+def build_graph(memories: List[Dict[str, Any]], vectors: Optional[Dict[str, np.ndarray]] = None,
+                topic_top_k: int = 8, similarity_top_k: int = 5,
+                similarity_threshold: float = 0.75) -> Dict[str, Any]:
+    """Nodes, weighted edges and topic clusters for a list of memory rows"""
+    topic_lists = [mem['topics'] if mem.get('topics') is not None else ['general'] for mem in memories]
+    ids = [mem['id'] for mem in memories]
+
+    nodes = [
+        {
+            "id": mem['id'],
+            "label": mem['title'][:30] + "..." if len(mem['title']) > 30 else mem['title'],
+            "title": mem['title'],
+            "summary": (mem.get('summary') or '')[:100] + "...",
+            "topics": mem.get('topics', []),
+            "created_at": mem['created_at'],
+            "size": min(50, 10 + content_length(mem) / 100)  # Node size based on content
+        }
+        for mem in memories
+    ]
+
+    edges = []
+    matrix, vocabulary, idf = topic_matrix(topic_lists)
+    if vocabulary:
+        topic_idf = dict(zip(vocabulary, idf.tolist()))
+        for i, j, weight in top_k_pairs(matrix, topic_top_k, 0.0):
+            shared = set(topic_lists[i]) & set(topic_lists[j])
+            edges.append({
+                "source": ids[i],
+                "target": ids[j],
+                "weight": round(weight, 3),
+                "topic": max(shared, key=lambda topic: (topic_idf.get(topic, 0), topic)) if shared else None,
+                "shared_topics": len(shared),
+                "type": "topic"
+            })
+
+    if vectors:
+        present = [i for i, memory_id in enumerate(ids) if memory_id in vectors]
+        if len(present) >= 2:
+            embedding_matrix = np.stack([vectors[ids[i]] for i in present]).astype(np.float32)
+            norms = np.linalg.norm(embedding_matrix, axis=1, keepdims=True)
+            np.divide(embedding_matrix, norms, out=embedding_matrix, where=norms > 0)
+            for a, b, weight in top_k_pairs(embedding_matrix, similarity_top_k, similarity_threshold):
+                edges.append({
+                    "source": ids[present[a]],
+                    "target": ids[present[b]],
+                    "weight": round(weight, 3),
+                    "topic": None,
+                    "type": "similarity"
+                })
+
+    topic_members: Dict[str, List[str]] = {}
+    for memory_id, topics in zip(ids, topic_lists):
+        for topic in topics:
+            topic_members.setdefault(topic, []).append(memory_id)
+
+    clusters = [
+        {
+            "id": topic,
+            "name": topic.capitalize(),
+            "nodes": memory_ids,
+            # hash() is salted per process; a digest gives the same colour everywhere
+            "color": f"hsl({int(hashlib.md5(topic.encode('utf-8')).hexdigest(), 16) % 360}, 70%, 50%)"
+        }
+        for topic, memory_ids in topic_members.items()
+        if len(memory_ids) > 1
+    ]
+
+    return {
+        "nodes": nodes,
+        "edges": edges,
+        "clusters": clusters,
+        "stats": {
+            "total_memories": len(memories),
+            "total_topics": len(topic_members),
+            "most_common_topic": max(topic_members.items(), key=lambda x: len(x[1]))[0] if topic_members else None,
+            "connections": len(edges),
+            "topic_edges": sum(1 for edge in edges if edge["type"] == "topic"),
+            "similarity_edges": sum(1 for edge in edges if edge["type"] == "similarity")
+        }
+    }
+
+
+def memory_set_signature(memories: Iterable[Dict[str, Any]], params: Dict[str, Any]) -> str:
+    """Changes whenever a memory in the set is added, removed or edited, or the build params change"""
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8"))
+    for mem in memories:
+        digest.update(json.dumps(
+            [mem['id'], mem.get('updated_at'), mem.get('message_count'), mem.get('title'), mem.get('summary'),
+             mem.get('topics')],
+            default=str
+        ).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class KnowledgeGraphCache:
+    """Last graph per user, valid while the memory-set signature matches, plus the embeddings it used
+
+    Embeddings are kept as ``{memory_id: (updated_at, vector)}`` within ``max_vector_bytes``
+    overall; the least recently used users lose theirs first.
+    """
+
+    def __init__(self, max_users: int = 500, max_vector_bytes: int = 64 * 1024 * 1024):
+        self.max_users = max_users
+        self.max_vector_bytes = max_vector_bytes
+        self._graphs: "OrderedDict[str, Tuple[str, Dict[str, Any]]]" = OrderedDict()
+        self._vectors: "OrderedDict[str, Dict[str, Tuple[Any, np.ndarray]]]" = OrderedDict()
+        self._vector_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "vectors_reused": 0}
+
+    def get(self, user_id: str, signature: str) -> Optional[Dict[str, Any]]:
+        entry = self._graphs.get(user_id)
+        if entry is None or entry[0] != signature:
+            self.stats["misses"] += 1
+            return None
+        self._graphs.move_to_end(user_id)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def reusable_vectors(self, user_id: str, memories: Iterable[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+        """Embeddings from the last build of memories not written to since"""
+        stored = self._vectors.get(user_id) or {}
+        reused = {}
+        for mem in memories:
+            entry = stored.get(mem['id'])
+            if entry is not None and entry[0] == mem.get('updated_at'):
+                reused[mem['id']] = entry[1]
+        self.stats["vectors_reused"] += len(reused)
+        return reused
+
+    def put(self, user_id: str, signature: str, graph: Dict[str, Any],
+            vectors: Optional[Dict[str, Tuple[Any, np.ndarray]]] = None):
+        self._graphs[user_id] = (signature, graph)
+        self._graphs.move_to_end(user_id)
+        while len(self._graphs) > self.max_users:
+            evicted, _ = self._graphs.popitem(last=False)
+            self._drop_vectors(evicted)
+        if vectors is not None:
+            self._drop_vectors(user_id)
+            self._vectors[user_id] = vectors
+            self._vector_bytes += sum(vector.nbytes for _, vector in vectors.values())
+            while self._vector_bytes > self.max_vector_bytes and self._vectors:
+                self._drop_vectors(next(iter(self._vectors)))
+
+    def _drop_vectors(self, user_id: str):
+        vectors = self._vectors.pop(user_id, None)
+        if vectors:
+            self._vector_bytes -= sum(vector.nbytes for _, vector in vectors.values())
+
+    def snapshot(self) -> Dict:
+        return {**self.stats, "users": len(self._graphs), "vector_bytes": self._vector_bytes}
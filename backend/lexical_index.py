@@ -0,0 +1,275 @@
+"""In-process BM25 index over memory titles, summaries and content.
+
+Each user gets an inverted index (``term -> {memory_id: weighted tf}``) built
+from Supabase on first use and kept in step as memories are saved, updated and
+deleted. Fields are weighted BM25F-style: a term in the title counts more
+than one in the content, and document length is the weighted token count.
+
+Only title and summary term counts are kept per memory, next to the list of
+terms the memory contributed. That is enough to re-index an edited title or
+summary without holding the content, and enough to drop a deleted memory
+from every posting list it is in.
+
+An index is built once and then only patched. Writes served by another worker
+process are picked up by a periodic catch-up (``claim_check`` every
+``check_seconds``): the caller probes the user's row count and newest
+``updated_at``, re-reads only rows changed since ``synced_until`` and drops ids
+that no longer exist, then hands them to ``catch_up``. Writes made in this
+process while a build or catch-up is reading from Supabase are recorded and
+replayed on top of the fetched rows, so they are not lost to the race.
+"""
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import math
+import re
+import threading
+import time
+
+FIELD_WEIGHTS = {"title": 3.0, "summary": 2.0, "content": 1.0}
+
+_TOKEN = re.compile(r"[^\W_]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from had has have how i if in into is it its "
+    "me my no not of on or our so than that the their them then there these they this to was we "
+    "were what when where which who why will with you your".split()
+)
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Lowercased word tokens, stopwords dropped, plurals folded ("lists" -> "list")"""
+    tokens = []
+    for token in _TOKEN.findall((text or "").lower()):
+        if token in _STOPWORDS:
+            continue
+        if len(token) > 4 and token.endswith("ies"):
+            token = token[:-3] + "y"
+        elif len(token) > 3 and token.endswith("s") and not token.endswith(("ss", "us", "is")):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class _UserLexicalIndex:
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, float]] = {}
+        self.lengths: Dict[str, float] = {}
+        self.terms: Dict[str, Tuple[str, ...]] = {}
+        self.field_counts: Dict[str, Dict[str, Counter]] = {}
+        self.total_length = 0.0
+        self.synced_until: Optional[str] = None
+        self.checked_at = time.time()
+
+    def _write(self, memory_id: str, weighted: Dict[str, float], length: float, fields: Dict[str, Counter]):
+        for term, tf in weighted.items():
+            self.postings.setdefault(term, {})[memory_id] = tf
+        self.terms[memory_id] = tuple(weighted)
+        self.lengths[memory_id] = length
+        self.total_length += length
+        self.field_counts[memory_id] = fields
+
+    def add(self, memory_id: str, row: Dict[str, Any]):
+        self.remove(memory_id)
+        fields = {field: Counter(tokenize(row.get(field))) for field in FIELD_WEIGHTS}
+        weighted: Counter = Counter()
+        for field, counts in fields.items():
+            for term, tf in counts.items():
+                weighted[term] += FIELD_WEIGHTS[field] * tf
+        length = sum(FIELD_WEIGHTS[field] * sum(counts.values()) for field, counts in fields.items())
+        self._write(memory_id, weighted, length, {"title": fields["title"], "summary": fields["summary"]})
+
+    def update(self, memory_id: str, changed: Dict[str, Any]):
+        """Re-index changed title/summary; the content contribution is recovered from the postings"""
+        if memory_id not in self.terms:
+            return
+        old_fields = self.field_counts[memory_id]
+        weighted = Counter({term: self.postings[term][memory_id] for term in self.terms[memory_id]})
+        length = self.lengths[memory_id]
+        new_fields = dict(old_fields)
+        for field in ("title", "summary"):
+            if field not in changed:
+                continue
+            for term, tf in old_fields[field].items():
+                weighted[term] -= FIELD_WEIGHTS[field] * tf
+            length -= FIELD_WEIGHTS[field] * sum(old_fields[field].values())
+            new_fields[field] = Counter(tokenize(changed[field]))
+            for term, tf in new_fields[field].items():
+                weighted[term] += FIELD_WEIGHTS[field] * tf
+            length += FIELD_WEIGHTS[field] * sum(new_fields[field].values())
+
+        self.remove(memory_id)
+        self._write(memory_id, {t: tf for t, tf in weighted.items() if tf > 1e-9}, length, new_fields)
+
+    def remove(self, memory_id: str):
+        terms = self.terms.pop(memory_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(memory_id, None)
+                if not posting:
+                    del self.postings[term]
+        self.total_length -= self.lengths.pop(memory_id)
+        self.field_counts.pop(memory_id, None)
+
+    def search(self, query_terms: Iterable[str], limit: int, k1: float, b: float) -> List[Tuple[str, float]]:
+        count = len(self.lengths)
+        if count == 0 or limit <= 0:
+            return []
+        average_length = self.total_length / count or 1.0
+        scores: Counter = Counter()
+        for term in set(query_terms):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for memory_id, tf in posting.items():
+                norm = k1 * (1 - b + b * self.lengths[memory_id] / average_length)
+                scores[memory_id] += idf * tf * (k1 + 1) / (tf + norm)
+        return scores.most_common(limit)
+
+
+class LexicalIndex:
+    """Per-user BM25 indexes, LRU-bounded and caught up with other workers every ``check_seconds``"""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, max_users: int = 200, check_seconds: float = 60):
+        self.k1 = k1
+        self.b = b
+        self.max_users = max_users
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._users: "OrderedDict[str, _UserLexicalIndex]" = OrderedDict()
+        # user_id -> writes seen while a build/catch-up is reading from Supabase
+        self._pending: Dict[str, List[Tuple[str, tuple]]] = {}
+        self.stats = {"builds": 0, "searches": 0, "checks": 0, "caught_up_rows": 0}
+
+    def has_user(self, user_id: str) -> bool:
+        with self._lock:
+            return user_id in self._users
+
+    def claim_check(self, user_id: str) -> bool:
+        """True (once per window) when the user's index is due a cross-worker drift check"""
+        with self._lock:
+            index = self._users.get(user_id)
+            if index is None or time.time() - index.checked_at < self.check_seconds:
+                return False
+            index.checked_at = time.time()
+            self.stats["checks"] += 1
+            return True
+
+    def sync_state(self, user_id: str) -> Optional[Tuple[int, Optional[str]]]:
+        """(documents indexed, newest updated_at seen) for a built index"""
+        with self._lock:
+            index = self._users.get(user_id)
+            return None if index is None else (len(index.lengths), index.synced_until)
+
+    def document_ids(self, user_id: str) -> List[str]:
+        with self._lock:
+            index = self._users.get(user_id)
+            return [] if index is None else list(index.lengths)
+
+    def begin_sync(self, user_id: str):
+        """Start recording writes before a build or catch-up starts reading rows"""
+        with self._lock:
+            self._pending.setdefault(user_id, [])
+
+    def abort_sync(self, user_id: str):
+        with self._lock:
+            self._pending.pop(user_id, None)
+
+    def _record(self, user_id: str, method: str, *args):
+        # Caller holds the lock
+        if user_id in self._pending:
+            self._pending[user_id].append((method, args))
+
+    def _replay(self, user_id: str, index: _UserLexicalIndex):
+        # Caller holds the lock
+        for method, args in self._pending.pop(user_id, []):
+            getattr(index, method)(*args)
+
+    def build(self, user_id: str, rows: List[Dict[str, Any]]):
+        """Replace a user's index with the given rows (id, title, summary, content, updated_at)"""
+        index = _UserLexicalIndex()
+        for row in rows:
+            index.add(str(row["id"]), row)
+        index.synced_until = max((row["updated_at"] for row in rows if row.get("updated_at")), default=None)
+        with self._lock:
+            self._replay(user_id, index)
+            self._users[user_id] = index
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+            self.stats["builds"] += 1
+
+    def catch_up(self, user_id: str, rows: List[Dict[str, Any]], removed_ids: Iterable[str], synced_until: Optional[str]):
+        """Apply rows changed and ids deleted by other workers, then replay this worker's own writes"""
+        with self._lock:
+            index = self._users.get(user_id)
+            if index is None:
+                self._pending.pop(user_id, None)
+                return
+            for row in rows:
+                index.add(str(row["id"]), row)
+            for memory_id in removed_ids:
+                index.remove(str(memory_id))
+            self._replay(user_id, index)
+            if synced_until is not None:
+                index.synced_until = synced_until
+            self.stats["caught_up_rows"] += len(rows)
+
+    def add(self, user_id: str, row: Dict[str, Any]):
+        """Insert or replace one memory; no-op until the user's index has been built"""
+        with self._lock:
+            self._record(user_id, "add", str(row["id"]), row)
+            index = self._users.get(user_id)
+            if index is not None:
+                index.add(str(row["id"]), row)
+
+    def update(self, user_id: str, memory_id: str, fields: Dict[str, Any]):
+        with self._lock:
+            self._record(user_id, "update", str(memory_id), fields)
+            index = self._users.get(user_id)
+            if index is not None:
+                index.update(str(memory_id), fields)
+
+    def remove(self, user_id: str, memory_id: str):
+        with self._lock:
+            self._record(user_id, "remove", str(memory_id))
+            index = self._users.get(user_id)
+            if index is not None:
+                index.remove(str(memory_id))
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def search(self, user_id: str, query: str, limit: int) -> Optional[List[Tuple[str, float]]]:
+        """Top ``(memory_id, bm25)`` pairs; None when the user has no index yet"""
+        terms = tokenize(query)
+        with self._lock:
+            index = self._users.get(user_id)
+            if index is None:
+                return None
+            self._users.move_to_end(user_id)
+            self.stats["searches"] += 1
+            return index.search(terms, limit, self.k1, self.b)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                **self.stats,
+                "users": len(self._users),
+                "documents": sum(len(index.lengths) for index in self._users.values()),
+                "terms": sum(len(index.postings) for index in self._users.values())
+            }
+
+
+def reciprocal_rank_fusion(rankings: Dict[str, List[str]], k: int = 60) -> List[Tuple[str, float, Dict[str, int]]]:
+    """Fuse ranked id lists (Cormack et al. 2009); returns (id, score, {list name: 1-based rank})"""
+    scores: Counter = Counter()
+    ranks: Dict[str, Dict[str, int]] = {}
+    for name, ranked_ids in rankings.items():
+        for rank, memory_id in enumerate(ranked_ids, start=1):
+            scores[memory_id] += 1.0 / (k + rank)
+            ranks.setdefault(memory_id, {})[name] = rank
+    return [(memory_id, score, ranks[memory_id]) for memory_id, score in scores.most_common()]
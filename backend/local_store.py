@@ -0,0 +1,562 @@
+"""Embedded storage backend: SQLite rows plus memory-mapped float32 embeddings.
+
+``LocalStore`` exposes the slice of the Supabase client that main.py uses:
+``table("memories")`` with select (optionally with ``count``)/insert/update/delete, the filters
+``eq``/``in_``/``gt``/``gte``/``lt``/``lte``/``contains``, ``order``/``range``/``limit`` and
+``await ... .execute()``, plus ``rpc("search_memories" | "text_search_memories")``
+with the same parameters and row shapes as the Postgres functions.
+``table("memory_passages")`` and ``rpc("search_memory_passages")`` mirror
+schema/memory_passages.sql. With
+``STORAGE_BACKEND=local`` a single node runs with no database server, and the
+service can be exercised fully offline.
+
+Rows live in a WAL-mode SQLite table with an FTS5 index over title, summary
+and content, which serves text search. Embeddings are kept out of the row
+table, in one memory-mapped float32 file per dimension. A row records only
+its dimension and slot, so vector search is one matrix-vector product over
+the user's slots.
+"""
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import threading
+import uuid
+
+import numpy as np
+
+from vector_index import parse_embedding
+
+COLUMNS = ["id", "user_id", "title", "summary", "content", "topics", "url", "message_count", "created_at", "embedding",
+           "embedding_model", "fingerprint", "updated_at", "content_length"]
+PASSAGE_COLUMNS = [
+    "id", "memory_id", "user_id", "passage_index", "start_offset", "end_offset",
+    "message_start", "message_end", "created_at", "embedding", "embedding_model"
+]
+TABLES = {"memories": COLUMNS, "memory_passages": PASSAGE_COLUMNS}
+_SEARCH_FIELDS = ["id", "title", "summary", "topics", "created_at", "content"]
+_PASSAGE_SEARCH_FIELDS = [
+    "id", "memory_id", "passage_index", "start_offset", "end_offset", "message_start", "message_end"
+]
+_SEARCH_TOKEN = re.compile(r"\w+")
+
+
+class LocalResult:
+    """Mirrors the ``.data`` and ``.count`` attributes of a postgrest APIResponse"""
+
+    def __init__(self, data: List[Dict[str, Any]], count: Optional[int] = None):
+        self.data = data
+        self.count = count
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="microseconds")
+
+
+class _VectorFile:
+    """Growable memory-mapped float32 matrix of one dimension; rows are addressed by slot.
+
+    Slots are handed out by ``LocalStore._allocate_slot`` from SQLite, not from this
+    object, so processes sharing the store directory each map the same file and
+    remap it when another process has grown it past their view.
+    """
+
+    def __init__(self, path: str, dim: int):
+        self.path = path
+        self.dim = dim
+        self.vectors = self._open(64)
+
+    def _open(self, capacity: int) -> np.memmap:
+        size = capacity * 4 * self.dim
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < size:
+            with open(self.path, "ab") as f:
+                f.truncate(size)
+        capacity = os.path.getsize(self.path) // (4 * self.dim)
+        return np.memmap(self.path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    def view(self, max_slot: int) -> np.memmap:
+        """The mapped matrix, remapped first if ``max_slot`` lies past it"""
+        if max_slot >= self.vectors.shape[0]:
+            self.vectors.flush()
+            self.vectors = self._open(max(self.vectors.shape[0] * 2, max_slot + 1))
+        return self.vectors
+
+    def write(self, slot: int, vector: np.ndarray):
+        self.view(slot)[slot] = vector
+
+
+class LocalStore:
+    """SQLite + vector-file implementation of the ``table``/``rpc`` client surface"""
+
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+        os.makedirs(base_dir, exist_ok=True)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(os.path.join(base_dir, "memories.sqlite"), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS memories (
+                rowid INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                user_id TEXT NOT NULL,
+                title TEXT,
+                summary TEXT,
+                content TEXT,
+                topics TEXT,
+                url TEXT,
+                message_count INTEGER,
+                created_at TEXT NOT NULL,
+                embedding_model TEXT,
+                fingerprint TEXT,
+                updated_at TEXT,
+                content_length INTEGER,
+                embedding_dim INTEGER,
+                embedding_slot INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS memories_user_created ON memories (user_id, created_at DESC, id DESC);
+            CREATE INDEX IF NOT EXISTS memories_user_url ON memories (user_id, url, created_at DESC);
+            CREATE TABLE IF NOT EXISTS vector_files (
+                dim INTEGER PRIMARY KEY,
+                used INTEGER NOT NULL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts USING fts5(
+                title, summary, content, content='memories', content_rowid='rowid'
+            );
+            CREATE TRIGGER IF NOT EXISTS memories_fts_insert AFTER INSERT ON memories BEGIN
+                INSERT INTO memories_fts (rowid, title, summary, content)
+                VALUES (new.rowid, new.title, new.summary, new.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS memories_fts_delete AFTER DELETE ON memories BEGIN
+                INSERT INTO memories_fts (memories_fts, rowid, title, summary, content)
+                VALUES ('delete', old.rowid, old.title, old.summary, old.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS memories_fts_update AFTER UPDATE OF title, summary, content ON memories BEGIN
+                INSERT INTO memories_fts (memories_fts, rowid, title, summary, content)
+                VALUES ('delete', old.rowid, old.title, old.summary, old.content);
+                INSERT INTO memories_fts (rowid, title, summary, content)
+                VALUES (new.rowid, new.title, new.summary, new.content);
+            END;
+            CREATE TABLE IF NOT EXISTS memory_passages (
+                rowid INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                memory_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                passage_index INTEGER NOT NULL,
+                start_offset INTEGER NOT NULL,
+                end_offset INTEGER NOT NULL,
+                message_start INTEGER,
+                message_end INTEGER,
+                created_at TEXT NOT NULL,
+                embedding_model TEXT,
+                embedding_dim INTEGER,
+                embedding_slot INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS memory_passages_user ON memory_passages (user_id);
+            CREATE INDEX IF NOT EXISTS memory_passages_memory ON memory_passages (memory_id, passage_index);
+            """
+        )
+        # Columns added after the first release, for stores created before them
+        for table, column, column_type in [("memories", "embedding_model", "TEXT"),
+                                           ("memory_passages", "embedding_model", "TEXT"),
+                                           ("memories", "fingerprint", "TEXT"),
+                                           ("memories", "updated_at", "TEXT"),
+                                           ("memories", "content_length", "INTEGER")]:
+            columns = {row["name"] for row in self._db.execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        # Backfill as schema/memory_updated_at.sql does
+        self._db.execute("UPDATE memories SET updated_at = created_at WHERE updated_at IS NULL")
+        self._db.execute(
+            "UPDATE memories SET content_length = COALESCE(LENGTH(content), 0) WHERE content_length IS NULL"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS memories_user_updated ON memories (user_id, updated_at DESC)")
+        self._db.commit()
+        self._vector_files: Dict[int, _VectorFile] = {}
+
+    def table(self, table_name: str) -> "LocalQuery":
+        if table_name not in TABLES:
+            raise ValueError(f"Local storage has no table {table_name!r}")
+        return LocalQuery(self, table_name)
+
+    def rpc(self, func: str, params: Dict[str, Any]) -> "LocalRPCCall":
+        if func not in ("search_memories", "text_search_memories", "search_memory_passages"):
+            raise ValueError(f"Local storage has no function {func!r}")
+        return LocalRPCCall(self, func, params)
+
+    async def aclose(self):
+        with self._lock:
+            for vector_file in self._vector_files.values():
+                vector_file.vectors.flush()
+            self._db.close()
+
+    # Vectors
+
+    def _vector_path(self, dim: int) -> str:
+        return os.path.join(self.base_dir, f"embeddings_{dim}.f32")
+
+    def _vector_file(self, dim: int) -> _VectorFile:
+        vector_file = self._vector_files.get(dim)
+        if vector_file is None:
+            vector_file = self._vector_files[dim] = _VectorFile(self._vector_path(dim), dim)
+        return vector_file
+
+    def _allocate_slot(self, dim: int) -> int:
+        # The counter lives in SQLite and the UPDATE takes the database write lock until the
+        # caller commits, so processes sharing the store never hand out the same slot
+        self._db.execute("INSERT OR IGNORE INTO vector_files (dim, used) VALUES (?, 0)", (dim,))
+        (used,) = self._db.execute(
+            "UPDATE vector_files SET used = used + 1 WHERE dim = ? RETURNING used", (dim,)
+        ).fetchone()
+        return used - 1
+
+    def _write_vector(self, value: Any, current: Optional[sqlite3.Row]) -> Tuple[Optional[int], Optional[int]]:
+        vector = parse_embedding(value)
+        if vector is None:
+            return None, None
+        dim = len(vector)
+        # Rewrite in place when the dimension is unchanged; otherwise take a fresh slot
+        slot = current["embedding_slot"] if current is not None and current["embedding_dim"] == dim else None
+        if slot is None:
+            slot = self._allocate_slot(dim)
+        self._vector_file(dim).write(slot, vector)
+        return dim, slot
+
+    def _read_vector(self, row: sqlite3.Row) -> Optional[List[float]]:
+        if row["embedding_dim"] is None:
+            return None
+        slot = row["embedding_slot"]
+        return self._vector_file(row["embedding_dim"]).view(slot)[slot].tolist()
+
+    # Rows
+
+    def _to_dict(self, row: sqlite3.Row, columns: List[str]) -> Dict[str, Any]:
+        result = {}
+        for column in columns:
+            if column == "embedding":
+                result[column] = self._read_vector(row)
+            elif column == "topics":
+                result[column] = json.loads(row["topics"]) if row["topics"] is not None else None
+            else:
+                result[column] = row[column]
+        return result
+
+    def _select(self, query: "LocalQuery") -> List[Dict[str, Any]]:
+        where, params = query._where_sql()
+        sql = f"SELECT * FROM {query._table}{where}"
+        if query._order:
+            sql += " ORDER BY " + ", ".join(f"{column} {'DESC' if desc else 'ASC'}" for column, desc in query._order)
+        if query._limit is not None or query._offset:
+            sql += " LIMIT ? OFFSET ?"
+            params += [query._limit if query._limit is not None else -1, query._offset]
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+            return [self._to_dict(row, query._columns) for row in rows]
+
+    def _count(self, query: "LocalQuery") -> int:
+        where, params = query._where_sql()
+        with self._lock:
+            return self._db.execute(f"SELECT COUNT(*) FROM {query._table}{where}", params).fetchone()[0]
+
+    def _insert(self, table: str, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        columns = TABLES[table]
+        stored = [column for column in columns if column != "embedding"]
+        inserted = []
+        with self._lock:
+            try:
+                for row in rows:
+                    unknown = set(row) - set(columns)
+                    if unknown:
+                        raise ValueError(f"Unknown columns: {sorted(unknown)}")
+                    values = {column: row.get(column) for column in stored}
+                    values["id"] = str(values["id"] or uuid.uuid4())
+                    values["created_at"] = values["created_at"] or _now()
+                    if table == "memories":
+                        values["updated_at"] = values["updated_at"] or values["created_at"]
+                    if values.get("topics") is not None:
+                        values["topics"] = json.dumps(values["topics"])
+                    dim, slot = self._write_vector(row.get("embedding"), None)
+                    self._db.execute(
+                        f"INSERT INTO {table} ({', '.join(stored)}, embedding_dim, embedding_slot) "
+                        f"VALUES ({', '.join('?' * (len(stored) + 2))})",
+                        [values[column] for column in stored] + [dim, slot],
+                    )
+                    inserted.append(values["id"])
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+            return self._rows_by_id(table, inserted)
+
+    def _update(self, query: "LocalQuery") -> List[Dict[str, Any]]:
+        fields = dict(query._payload)
+        unknown = set(fields) - set(TABLES[query._table])
+        if unknown:
+            raise ValueError(f"Unknown columns: {sorted(unknown)}")
+        where, params = query._where_sql()
+        with self._lock:
+            try:
+                targets = self._db.execute(f"SELECT * FROM {query._table}{where}", params).fetchall()
+                for current in targets:
+                    values = {k: v for k, v in fields.items() if k not in ("embedding", "id")}
+                    if "topics" in values and values["topics"] is not None:
+                        values["topics"] = json.dumps(values["topics"])
+                    if "embedding" in fields:
+                        values["embedding_dim"], values["embedding_slot"] = self._write_vector(fields["embedding"], current)
+                    if values and query._table == "memories":
+                        # The memories_touch_updated_at trigger in Postgres
+                        values["updated_at"] = _now()
+                    if values:
+                        self._db.execute(
+                            f"UPDATE {query._table} SET {', '.join(f'{k} = ?' for k in values)} WHERE rowid = ?",
+                            list(values.values()) + [current["rowid"]],
+                        )
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+            return self._rows_by_id(query._table, [row["id"] for row in targets])
+
+    def _delete(self, query: "LocalQuery") -> List[Dict[str, Any]]:
+        where, params = query._where_sql()
+        with self._lock:
+            rows = self._db.execute(f"SELECT * FROM {query._table}{where}", params).fetchall()
+            deleted = [self._to_dict(row, TABLES[query._table]) for row in rows]
+            self._db.execute(f"DELETE FROM {query._table}{where}", params)
+            if query._table == "memories" and rows:
+                # ON DELETE CASCADE in the Postgres schema
+                ids = [row["id"] for row in rows]
+                self._db.execute(
+                    f"DELETE FROM memory_passages WHERE memory_id IN ({', '.join('?' * len(ids))})", ids
+                )
+            self._db.commit()
+            # Vector slots are not reused; the space is reclaimed by re-importing into a fresh store
+            return deleted
+
+    def _rows_by_id(self, table: str, ids: List[str]) -> List[Dict[str, Any]]:
+        if not ids:
+            return []
+        rows = self._db.execute(
+            f"SELECT * FROM {table} WHERE id IN ({', '.join('?' * len(ids))})", ids
+        ).fetchall()
+        by_id = {row["id"]: self._to_dict(row, TABLES[table]) for row in rows}
+        return [by_id[memory_id] for memory_id in ids if memory_id in by_id]
+
+    # RPCs
+
+    def _nearest(self, table: str, query_embedding: List[float], match_threshold: float, match_count: int,
+                 filter_user_id: str) -> List[Tuple[int, float]]:
+        """(rowid, cosine similarity) of the user's closest rows in table, best first"""
+        query = parse_embedding(query_embedding)
+        norm = float(np.linalg.norm(query))
+        if norm == 0 or match_count <= 0:
+            return []
+        query = query / norm
+        if not os.path.exists(self._vector_path(len(query))):
+            return []
+        vector_file = self._vector_file(len(query))
+        rows = self._db.execute(
+            f"SELECT rowid, embedding_slot FROM {table} WHERE user_id = ? AND embedding_dim = ?",
+            (filter_user_id, len(query)),
+        ).fetchall()
+        if not rows:
+            return []
+        slots = np.array([row["embedding_slot"] for row in rows])
+        matrix = np.asarray(vector_file.view(int(slots.max()))[slots])
+        norms = np.linalg.norm(matrix, axis=1)
+        scores = (matrix @ query) / np.where(norms > 0, norms, 1.0)
+
+        k = min(match_count, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        # Strictly above the threshold, as in the SQL functions (and LocalVectorIndex)
+        return [(rows[i]["rowid"], float(scores[i])) for i in top[np.argsort(-scores[top])] if scores[i] > match_threshold]
+
+    def search_memories(self, query_embedding: List[float], match_threshold: float, match_count: int,
+                        filter_user_id: str) -> List[Dict[str, Any]]:
+        """Cosine similarity top-k; like the Postgres function, ``distance`` holds the similarity"""
+        with self._lock:
+            top = self._nearest("memories", query_embedding, match_threshold, match_count, filter_user_id)
+            if not top:
+                return []
+            rowids = [rowid for rowid, _ in top]
+            found = {
+                row["rowid"]: row for row in self._db.execute(
+                    f"SELECT * FROM memories WHERE rowid IN ({', '.join('?' * len(rowids))})", rowids
+                )
+            }
+        return [{**self._to_dict(found[rowid], _SEARCH_FIELDS), "distance": score} for rowid, score in top]
+
+    def search_memory_passages(self, query_embedding: List[float], match_threshold: float, match_count: int,
+                               filter_user_id: str) -> List[Dict[str, Any]]:
+        """Closest passages with their text sliced from the parent memory's content"""
+        with self._lock:
+            top = self._nearest("memory_passages", query_embedding, match_threshold, match_count, filter_user_id)
+            if not top:
+                return []
+            rowids = [rowid for rowid, _ in top]
+            found = {
+                row["rowid"]: row for row in self._db.execute(
+                    "SELECT p.*, m.title AS title, m.created_at AS memory_created_at, "
+                    "substr(m.content, p.start_offset + 1, p.end_offset - p.start_offset) AS passage "
+                    "FROM memory_passages p JOIN memories m ON m.id = p.memory_id "
+                    f"WHERE p.rowid IN ({', '.join('?' * len(rowids))})", rowids
+                )
+            }
+        return [
+            {
+                **{column: found[rowid][column] for column in _PASSAGE_SEARCH_FIELDS},
+                "title": found[rowid]["title"],
+                "created_at": found[rowid]["memory_created_at"],
+                "content": found[rowid]["passage"],
+                "distance": score
+            }
+            for rowid, score in top if rowid in found
+        ]
+
+    def text_search_memories(self, search_query: str, match_count: int, filter_user_id: str) -> List[Dict[str, Any]]:
+        """Rows containing every query word (FTS5, BM25-ranked), like plainto_tsquery"""
+        terms = _SEARCH_TOKEN.findall(search_query or "")
+        if not terms or match_count <= 0:
+            return []
+        match = " AND ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT m.* FROM memories_fts JOIN memories m ON m.rowid = memories_fts.rowid "
+                "WHERE memories_fts MATCH ? AND m.user_id = ? ORDER BY bm25(memories_fts) LIMIT ?",
+                (match, filter_user_id, match_count),
+            ).fetchall()
+            return [self._to_dict(row, _SEARCH_FIELDS) for row in rows]
+
+
+class LocalRPCCall:
+    def __init__(self, store: LocalStore, func: str, params: Dict[str, Any]):
+        self._store = store
+        self._func = func
+        self._params = params
+
+    async def execute(self) -> LocalResult:
+        return LocalResult(await asyncio.to_thread(getattr(self._store, self._func), **self._params))
+
+
+class LocalQuery:
+    """Chainable builder matching the postgrest-py calls main.py makes"""
+
+    def __init__(self, store: LocalStore, table: str = "memories"):
+        self._store = store
+        self._table = table
+        self._operation = "select"
+        self._columns = list(TABLES[table])
+        self._payload: Any = None
+        self._filters: List[Tuple[str, List[Any]]] = []
+        self._order: List[Tuple[str, bool]] = []
+        self._limit: Optional[int] = None
+        self._offset = 0
+        self._count: Optional[str] = None
+
+    def _column(self, name: str) -> str:
+        if name not in TABLES[self._table] or name == "embedding":
+            raise ValueError(f"Cannot filter or sort on column {name!r}")
+        return name
+
+    def select(self, columns: str = "*", count: Optional[str] = None) -> "LocalQuery":
+        # count="exact" (or any method) fills LocalResult.count with the filtered row count
+        self._count = count
+        names = [name.strip() for name in columns.split(",") if name.strip()]
+        if names != ["*"]:
+            unknown = set(names) - set(TABLES[self._table])
+            if unknown:
+                raise ValueError(f"Unknown columns: {sorted(unknown)}")
+            self._columns = names
+        return self
+
+    def insert(self, rows: Any) -> "LocalQuery":
+        self._operation = "insert"
+        self._payload = rows if isinstance(rows, list) else [rows]
+        return self
+
+    def update(self, fields: Dict[str, Any]) -> "LocalQuery":
+        self._operation = "update"
+        self._payload = fields
+        return self
+
+    def delete(self) -> "LocalQuery":
+        self._operation = "delete"
+        return self
+
+    def eq(self, column: str, value: Any) -> "LocalQuery":
+        self._filters.append((f"{self._column(column)} = ?", [value]))
+        return self
+
+    def in_(self, column: str, values: List[Any]) -> "LocalQuery":
+        values = list(values)
+        if not values:
+            self._filters.append(("0", []))
+        else:
+            self._filters.append((f"{self._column(column)} IN ({', '.join('?' * len(values))})", values))
+        return self
+
+    def gte(self, column: str, value: Any) -> "LocalQuery":
+        self._filters.append((f"{self._column(column)} >= ?", [value]))
+        return self
+
+    def lte(self, column: str, value: Any) -> "LocalQuery":
+        self._filters.append((f"{self._column(column)} <= ?", [value]))
+        return self
+
+    def gt(self, column: str, value: Any) -> "LocalQuery":
+        self._filters.append((f"{self._column(column)} > ?", [value]))
+        return self
+
+    def lt(self, column: str, value: Any) -> "LocalQuery":
+        self._filters.append((f"{self._column(column)} < ?", [value]))
+        return self
+
+    def contains(self, column: str, values: List[Any]) -> "LocalQuery":
+        if self._column(column) != "topics":
+            raise ValueError("contains is only supported on topics")
+        for value in values:
+            self._filters.append((f"EXISTS (SELECT 1 FROM json_each({self._table}.topics) WHERE value = ?)", [value]))
+        return self
+
+    def after(self, created_at: str, row_id: str) -> "LocalQuery":
+        """Keyset filter for ``(created_at, id)`` descending; see clients.keyset_after"""
+        self._filters.append(("(created_at < ? OR (created_at = ? AND id < ?))", [created_at, created_at, row_id]))
+        return self
+
+    def order(self, column: str, desc: bool = False) -> "LocalQuery":
+        self._order.append((self._column(column), desc))
+        return self
+
+    def limit(self, count: int) -> "LocalQuery":
+        self._limit = count
+        return self
+
+    def range(self, start: int, end: int) -> "LocalQuery":
+        self._offset = start
+        self._limit = end - start + 1
+        return self
+
+    def _where_sql(self) -> Tuple[str, List[Any]]:
+        if not self._filters:
+            return "", []
+        return " WHERE " + " AND ".join(clause for clause, _ in self._filters), [
+            value for _, values in self._filters for value in values
+        ]
+
+    async def execute(self) -> LocalResult:
+        if self._operation in ("update", "delete") and not self._filters:
+            raise ValueError(f"{self._operation} requires a filter")
+        run = {
+            "select": lambda: self._store._select(self),
+            "insert": lambda: self._store._insert(self._table, self._payload),
+            "update": lambda: self._store._update(self),
+            "delete": lambda: self._store._delete(self),
+        }[self._operation]
+        data = await asyncio.to_thread(run)
+        if self._operation == "select" and self._count:
+            return LocalResult(data, await asyncio.to_thread(self._store._count, self))
+        return LocalResult(data)
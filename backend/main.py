@@ -1,19 +1,42 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Dict, Optional, Any
-import openai
+from typing import List, Dict, Optional, Any, AsyncIterator, Callable, Iterator, NamedTuple, Tuple, Union
 from dotenv import load_dotenv
 import os
 import json
+import asyncio
 from datetime import datetime, timedelta
 import uuid
 import logging
 import re
+import base64
+import tempfile
 import statistics
-from supabase import create_client, Client
+import time
 import numpy as np
+from starlette.routing import Match
+from rate_limit import Decision, create_rate_limiter
+from clients import AsyncSupabaseClient, UpstreamPool, create_openai_client, create_supabase_client, keyset_after, order_by
+from embedding_cache import EmbeddingCache
+from local_store import LocalStore
+from singleflight import CoalescingOpenAI, CoalescingStorage, SingleFlight
+from response_cache import ResponseCache
+from vector_index import LocalVectorIndex, parse_embedding
+from jobs import JobQueue
+from memory_cache import MemoryRowCache
+from knowledge_graph import KnowledgeGraphCache, build_graph, memory_set_signature
+from clustering import ClusterStore
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from rerank import mmr_select, rerank
+from conversation_state import ConversationState, ConversationStateStore
+from tokenizer import TokenCounter, bpe_files
+from analyzers import TextAnalyzer
+from chunking import Passage, chunk_turns
+from fingerprint import FingerprintIndex, appended_turns, shingle_overlap, text_fingerprint, thread_url
+from embedding_migration import EmbeddingMigrations
+from metrics import MeteredOpenAI, Metrics, record_timing, start_request_timings, timed_phase, upstream_operation
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -25,21 +48,100 @@ load_dotenv()
 # Initialize FastAPI
 app = FastAPI()
 
-# Rate limiting storage (in-memory for now)
-user_rate_limits = {}
+# Rate limiting: cost units per user per window, shared across workers via RATE_LIMIT_BACKEND.
+# Keystroke-level and local-only routes are cheap; GPT-heavy routes cost more. Bulk imports are charged
+# inside the route, per conversation, at the price of /save_conversation.
+ROUTE_COSTS = {
+    "/analyze_prompt": 0.25,
+    "/analyze_context_usage": 0,
+    "/analyze_conversation_quality": 0,
+    "/job_status": 0,
+    "/embedding_migration": 0,
+    "/search_memory": 0.5,
+    "/get_all_memories": 0.5,
+    "/get_memories": 0.5,
+    "/improve_prompt": 1,
+    "/analyze_conversation_turn": 1,
+    "/suggest_followup": 1,
+    "/save_conversation": 1,
+    "/generate_knowledge_graph": 1,
+    "/compress_context": 3,
+    "/intelligent_context_bridge": 5,
+    "/migrate_embeddings": 10,
+    "/save_conversations_batch": 0,
+    "/save_conversations_stream": 0
+}
+
+rate_limiter = create_rate_limiter(
+    algorithm=os.getenv("RATE_LIMIT_ALGORITHM", "token_bucket"),
+    backend=os.getenv("RATE_LIMIT_BACKEND", "sqlite"),
+    capacity=float(os.getenv("RATE_LIMIT_CAPACITY", 200)),
+    window_seconds=float(os.getenv("RATE_LIMIT_WINDOW_SECONDS", 24 * 3600)),
+    route_costs=ROUTE_COSTS,
+    sqlite_path=os.getenv("RATE_LIMIT_SQLITE_PATH", "rate_limits.sqlite"),
+    redis_url=os.getenv("RATE_LIMIT_REDIS_URL")
+)
+
+# Prometheus metrics (GET /metrics) and the per-response Server-Timing breakdown
+metrics = Metrics("memory_manager")
+http_request_duration = metrics.histogram(
+    "http_request_duration_seconds", "Time to response headers, by route", ("method", "route", "status")
+)
+http_requests_in_flight = metrics.gauge("http_requests_in_flight", "Requests being served, by route", ("route",))
+upstream_request_duration = metrics.histogram(
+    "upstream_request_duration_seconds", "OpenAI and Supabase HTTP calls, by operation", ("upstream", "operation", "status")
+)
+openai_tokens = metrics.counter("openai_tokens_total", "OpenAI tokens by model, endpoint and type", ("model", "endpoint", "type"))
+phase_duration = metrics.histogram("phase_duration_seconds", "In-process request phases", ("phase",))
+
+def observe_upstream(name: str):
+    def observe(request, status: Optional[int], seconds: float):
+        operation = upstream_operation(request.method, request.url.path)
+        upstream_request_duration.observe(seconds, upstream=name, operation=operation, status=status or "error")
+        record_timing(f"{name}.{operation}", seconds)
+    return observe
+
+def upstream_pool(name: str, prefix: str, read_timeout: float) -> UpstreamPool:
+    """Connection pool for one upstream, tuned by <PREFIX>_HTTP_* env vars"""
+    return UpstreamPool(
+        name,
+        max_connections=int(os.getenv(f"{prefix}_HTTP_MAX_CONNECTIONS", 100)),
+        max_keepalive_connections=int(os.getenv(f"{prefix}_HTTP_MAX_KEEPALIVE", 20)),
+        keepalive_expiry=float(os.getenv(f"{prefix}_HTTP_KEEPALIVE_EXPIRY", 30)),
+        connect_timeout=float(os.getenv(f"{prefix}_HTTP_CONNECT_TIMEOUT", 5)),
+        read_timeout=float(os.getenv(f"{prefix}_HTTP_READ_TIMEOUT", read_timeout)),
+        write_timeout=float(os.getenv(f"{prefix}_HTTP_WRITE_TIMEOUT", 10)),
+        pool_timeout=float(os.getenv(f"{prefix}_HTTP_POOL_TIMEOUT", 10)),
+        http2=os.getenv(f"{prefix}_HTTP2", "true").lower() == "true",
+        observer=observe_upstream(name)
+    )
+
+# One shared transport per upstream: bounded pools, keep-alive, HTTP/2 when h2 is installed
+upstream_pools = {
+    "openai": upstream_pool("openai", "OPENAI", read_timeout=60),
+    "supabase": upstream_pool("supabase", "SUPABASE", read_timeout=15)
+}
+
+# Identical concurrent upstream calls (embeddings, completions, RPCs) share one request
+single_flight = SingleFlight(enabled=os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true")
 
-# Initialize Supabase
+# Initialize storage: Supabase, or the embedded SQLite + vector-file store ("local")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase")
 try:
-    SUPABASE_URL = os.getenv("SUPABASE_URL")
-    SUPABASE_KEY = os.getenv("SUPABASE_ANON_KEY")
-    
-    if not SUPABASE_URL or not SUPABASE_KEY:
-        raise ValueError("Supabase credentials not found in environment variables")
-    
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-    logger.info("Supabase client initialized successfully")
+    if STORAGE_BACKEND == "local":
+        supabase: Union[AsyncSupabaseClient, LocalStore, CoalescingStorage] = LocalStore(
+            os.getenv("LOCAL_STORE_DIR", "local_store")
+        )
+        logger.info(f"Local storage initialized in {supabase.base_dir}")
+    else:
+        SUPABASE_URL = os.getenv("SUPABASE_URL")
+        SUPABASE_KEY = os.getenv("SUPABASE_ANON_KEY")
+        
+        supabase = create_supabase_client(SUPABASE_URL, SUPABASE_KEY, pool=upstream_pools["supabase"])
+        logger.info("Supabase client initialized successfully")
+    supabase = CoalescingStorage(supabase, single_flight)
 except Exception as e:
-    logger.error(f"Supabase initialization error: {e}")
+    logger.error(f"Storage initialization error: {e}")
     supabase = None
 
 # CORS middleware
@@ -50,39 +152,54 @@ async def cors_handler(request, call_next):
     response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
     response.headers["Access-Control-Allow-Headers"] = "*"
     response.headers["Access-Control-Allow-Credentials"] = "true"
+    response.headers["Access-Control-Expose-Headers"] = "Retry-After, X-RateLimit-Limit, X-RateLimit-Remaining, Server-Timing"
+    response.headers["Timing-Allow-Origin"] = "*"
     return response
 
 # Rate limiting middleware
 @app.middleware("http")
 async def rate_limit_middleware(request: Request, call_next):
-    # Skip rate limiting for health checks
-    if request.url.path in ["/", "/health"]:
+    # Skip rate limiting for health checks and CORS preflights
+    if request.url.path in ["/", "/health", "/cache_stats", "/pool_stats", "/metrics"] or request.method == "OPTIONS":
         return await call_next(request)
     
     # Get user ID from header
     user_id = request.headers.get("X-User-ID", "anonymous")
     
-    # Simple rate limiting: 200 requests per day per user
-    today = datetime.now().date().isoformat()
-    key = f"{user_id}:{today}"
-    
-    if key in user_rate_limits:
-        if user_rate_limits[key] >= 200:
-            return JSONResponse(
-                status_code=429,
-                content={"error": "Daily limit reached. Please try again tomorrow."}
-            )
-        user_rate_limits[key] += 1
-    else:
-        user_rate_limits[key] = 1
+    try:
+        decision = await rate_limiter.check(user_id, request.url.path)
+    except Exception as e:
+        logger.error(f"Rate limiter unavailable, allowing request: {e}")
+        return await call_next(request)
     
-    # Clean old entries (simple cleanup)
-    if len(user_rate_limits) > 1000:
-        user_rate_limits.clear()
+    if not decision.allowed:
+        return rate_limited_response(decision)
     
     response = await call_next(request)
+    response.headers.update(rate_limiter.headers(decision))
     return response
 
+def rate_limited_response(decision: Decision) -> JSONResponse:
+    headers = rate_limiter.headers(decision)
+    return JSONResponse(
+        status_code=429,
+        content={
+            "error": "Rate limit reached. Please try again later.",
+            "retry_after": int(headers["Retry-After"])
+        },
+        headers=headers
+    )
+
+SAVE_CONVERSATION_COST = ROUTE_COSTS["/save_conversation"]
+
+async def charge_conversations(user_id: str, count: int) -> Decision:
+    """Charge a bulk import as ``count`` /save_conversation calls"""
+    try:
+        return await rate_limiter.charge(user_id, count * SAVE_CONVERSATION_COST)
+    except Exception as e:
+        logger.error(f"Rate limiter unavailable, allowing import: {e}")
+        return Decision(True, 0.0, 0.0)
+
 @app.options("/{path:path}")
 async def options_handler(path: str):
     return JSONResponse(
@@ -102,18 +219,435 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def route_template(request: Request) -> str:
+    """The matched route's path pattern, so metric labels don't grow with memory and job ids"""
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+# Outermost middleware: rate-limited and CORS-preflight responses are measured too
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    timings = start_request_timings()
+    route = route_template(request)
+    http_requests_in_flight.inc(route=route)
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        http_requests_in_flight.dec(route=route)
+        # Streaming routes are measured to their first byte; the body is still being generated
+        http_request_duration.observe(
+            time.perf_counter() - timings.started, method=request.method, route=route, status=status
+        )
+    response.headers["Server-Timing"] = timings.header()
+    return response
+
 # Initialize OpenAI
 try:
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("OpenAI API key not found")
-    
-    client = openai.OpenAI(api_key=api_key)
+    # Token usage is counted below the coalescing layer, once per real upstream call
+    client = CoalescingOpenAI(MeteredOpenAI(create_openai_client(
+        os.getenv("OPENAI_API_KEY"),
+        pool=upstream_pools["openai"],
+        max_retries=int(os.getenv("OPENAI_MAX_RETRIES", 2))
+    ), openai_tokens, lambda messages, model: token_counter.count_messages(messages, model_encoding(model))), single_flight)
     logger.info("OpenAI client initialized successfully")
 except Exception as e:
     logger.error(f"OpenAI initialization error: {e}")
     client = None
 
+EMBEDDING_MODEL = "text-embedding-3-small"
+# The text-embedding-3 models tokenize with cl100k_base
+EMBEDDING_ENCODING = "cl100k_base"
+EMBEDDING_NATIVE_DIMENSIONS = 1536
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 256))
+
+# Shortened embeddings (e.g. 256/512) via the API's dimensions parameter. Rows are tagged
+# "model@dimensions"; rows at EMBEDDING_PREVIOUS_DIMENSIONS stay searchable until re-embedded.
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", EMBEDDING_NATIVE_DIMENSIONS))
+EMBEDDING_PREVIOUS_DIMENSIONS = [
+    int(value) for value in os.getenv("EMBEDDING_PREVIOUS_DIMENSIONS", str(EMBEDDING_NATIVE_DIMENSIONS)).split(",")
+    if value.strip() and int(value) != EMBEDDING_DIMENSIONS
+]
+
+def embedding_tag(dimensions: int) -> str:
+    return f"{EMBEDDING_MODEL}@{dimensions}"
+
+EMBEDDING_TAG = embedding_tag(EMBEDDING_DIMENSIONS)
+
+def embedding_request(dimensions: int) -> Dict:
+    """embeddings.create arguments; the pinned SDK predates the dimensions keyword, so it goes in the body"""
+    if dimensions == EMBEDDING_NATIVE_DIMENSIONS:
+        return {"model": EMBEDDING_MODEL}
+    return {"model": EMBEDDING_MODEL, "extra_body": {"dimensions": dimensions}}
+
+def embedding_cache_model(dimensions: int) -> str:
+    # Full-size entries keep the bare model name so existing cache files stay valid
+    return EMBEDDING_MODEL if dimensions == EMBEDDING_NATIVE_DIMENSIONS else embedding_tag(dimensions)
+
+def shorten_embedding(embedding: List[float], dimensions: int) -> List[float]:
+    """text-embedding-3 vectors shorten by truncation plus re-normalization, same as requesting fewer dimensions"""
+    vector = np.asarray(embedding[:dimensions], dtype=np.float32)
+    norm = float(np.linalg.norm(vector))
+    return (vector / norm if norm > 0 else vector).tolist()
+
+# Embedding cache (optional on-disk tier via EMBEDDING_CACHE_PATH)
+embedding_cache = EmbeddingCache(
+    max_bytes=int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    db_path=os.getenv("EMBEDDING_CACHE_PATH")
+)
+
+# Response cache for /analyze_prompt and /improve_prompt
+response_cache = ResponseCache(
+    ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 3600)),
+    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 5000)),
+    similarity_threshold=float(os.getenv("RESPONSE_CACHE_SIMILARITY", 0.9))
+)
+
+async def get_embedding(text: str, dimensions: int = EMBEDDING_DIMENSIONS) -> List[float]:
+    """Embed text, serving repeated inputs from the embedding cache"""
+    cache_model = embedding_cache_model(dimensions)
+    cached = await embedding_cache.get(cache_model, text)
+    if cached is not None:
+        return cached
+    
+    embedding_response = await client.embeddings.create(
+        input=text,
+        **embedding_request(dimensions)
+    )
+    embedding = embedding_response.data[0].embedding
+    await embedding_cache.put(cache_model, text, embedding)
+    return embedding
+
+async def get_embeddings(texts: List[str], dimensions: int = EMBEDDING_DIMENSIONS) -> List[List[float]]:
+    """Embed many texts with multi-input calls, skipping ones already cached"""
+    cache_model = embedding_cache_model(dimensions)
+    embeddings: List[Optional[List[float]]] = [await embedding_cache.get(cache_model, text) for text in texts]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    
+    for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+        chunk = missing[start:start + EMBEDDING_BATCH_SIZE]
+        embedding_response = await client.embeddings.create(
+            input=[texts[i] for i in chunk],
+            **embedding_request(dimensions)
+        )
+        for item in embedding_response.data:
+            i = chunk[item.index]
+            embeddings[i] = item.embedding
+            await embedding_cache.put(cache_model, texts[i], item.embedding)
+    
+    return embeddings
+
+async def query_embeddings(text: str, dimensions: List[int]) -> Dict[int, List[float]]:
+    """One embedding per dimension searched, from a single call at the largest of them"""
+    full = await get_embedding(text, max(dimensions))
+    return {d: full if d == len(full) else shorten_embedding(full, d) for d in dimensions}
+
+# Vector search backend: "supabase" (search_memories RPC) or "local" (in-process index)
+VECTOR_SEARCH_BACKEND = os.getenv("VECTOR_SEARCH_BACKEND", "supabase")
+vector_index = LocalVectorIndex(
+    os.getenv("VECTOR_INDEX_DIR", "vector_index"),
+    ivf_min_vectors=int(os.getenv("VECTOR_INDEX_IVF_MIN", 20000)),
+    nprobe=int(os.getenv("VECTOR_INDEX_NPROBE", 8)),
+    # Compact codes (int8, or PQ for very large users) with exact re-scoring of the top hits
+    quantize_min_vectors=int(os.getenv("VECTOR_INDEX_QUANTIZE_MIN", 1000)),
+    pq_min_vectors=int(os.getenv("VECTOR_INDEX_PQ_MIN", 0)),
+    pq_subvectors=int(os.getenv("VECTOR_INDEX_PQ_SUBVECTORS", 0)) or None,
+    rescore=int(os.getenv("VECTOR_INDEX_RESCORE", 4)),
+    pq_rescore=int(os.getenv("VECTOR_INDEX_PQ_RESCORE", 16))
+) if VECTOR_SEARCH_BACKEND == "local" else None
+
+async def fetch_all_memory_rows(user_id: str, columns: str, page_size: int = 1000, updated_since: Optional[str] = None) -> List[Dict]:
+    """Every memory row for a user (or only those updated at/after ``updated_since``), paged so no single response is unbounded"""
+    rows = []
+    while True:
+        query = supabase.table("memories").select(columns).eq("user_id", user_id)
+        if updated_since is not None:
+            query = query.gte("updated_at", updated_since)
+        page = await query.order("id").range(len(rows), len(rows) + page_size - 1).execute()
+        rows.extend(page.data or [])
+        if len(page.data or []) < page_size:
+            break
+    return rows
+
+async def ensure_local_index(user_id: str):
+    """Build a user's local index from Supabase the first time it is needed, or after a dimension change"""
+    if vector_index.dimension(user_id) == EMBEDDING_DIMENSIONS:
+        return
+    
+    async def build():
+        # Writes during the paging below are replayed by build(), so none are lost or resurrected
+        vector_index.begin_build(user_id)
+        try:
+            rows = await fetch_all_memory_rows(user_id, "id, title, summary, topics, created_at, content, embedding")
+        except Exception:
+            vector_index.abort_build(user_id)
+            raise
+        await asyncio.to_thread(vector_index.build, user_id, rows, EMBEDDING_DIMENSIONS)
+    
+    # Concurrent first searches for a user share one build
+    await single_flight.do("index_build:vector", user_id, build)
+
+async def sync_local_index(operation: str, user_id: str, *args):
+    """Mirror a Supabase write into the local index; on failure drop it so it is rebuilt"""
+    if not vector_index:
+        return
+    try:
+        await asyncio.to_thread(getattr(vector_index, operation), user_id, *args)
+    except Exception as e:
+        logger.warning(f"Local vector index {operation} failed for user {user_id}, invalidating: {e}")
+        vector_index.invalidate(user_id)
+
+def merge_by_similarity(groups: List[List[Dict]], match_count: int) -> List[Dict]:
+    """Best-first union of per-dimension result lists (``distance`` holds the similarity)"""
+    if len(groups) == 1:
+        return groups[0]
+    best: Dict[str, Dict] = {}
+    for row in (row for group in groups for row in group):
+        key = str(row['id'])
+        if key not in best or row['distance'] > best[key]['distance']:
+            best[key] = row
+    return sorted(best.values(), key=lambda row: row['distance'], reverse=True)[:match_count]
+
+async def vector_search(user_id: str, query_embeddings: Dict[int, List[float]], match_threshold: float,
+                        match_count: int) -> List[Dict]:
+    """Rows shaped like the search_memories RPC, across every embedding dimension being searched"""
+    groups = await asyncio.gather(*[
+        vector_search_dimension(user_id, query_embedding, match_threshold, match_count)
+        for query_embedding in query_embeddings.values()
+    ])
+    return merge_by_similarity(list(groups), match_count)
+
+async def vector_search_dimension(user_id: str, query_embedding: List[float], match_threshold: float,
+                                  match_count: int) -> List[Dict]:
+    """One dimension's rows: the local index holds the current dimension, the RPC serves any"""
+    if vector_index and len(query_embedding) == EMBEDDING_DIMENSIONS:
+        try:
+            await ensure_local_index(user_id)
+            with timed_phase("vector_index", phase_duration):
+                return await asyncio.to_thread(
+                    vector_index.search, user_id, query_embedding, match_threshold, match_count
+                )
+        except Exception as e:
+            logger.warning(f"Local vector search failed, falling back to search_memories RPC: {e}")
+    
+    results = await supabase.rpc(
+        'search_memories',
+        {
+            'query_embedding': query_embedding,
+            'match_threshold': match_threshold,
+            'match_count': match_count,
+            'filter_user_id': user_id
+        }
+    ).execute()
+    return results.data or []
+
+# Hybrid search: in-process BM25 index fused with vector search by reciprocal rank fusion
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", 60))
+HYBRID_CANDIDATES_PER_RESULT = int(os.getenv("HYBRID_CANDIDATES_PER_RESULT", 4))
+lexical_index = LexicalIndex(
+    k1=float(os.getenv("BM25_K1", 1.2)),
+    b=float(os.getenv("BM25_B", 0.75)),
+    max_users=int(os.getenv("LEXICAL_INDEX_MAX_USERS", 200)),
+    check_seconds=float(os.getenv("LEXICAL_INDEX_CHECK_SECONDS", 60))
+)
+LEXICAL_INDEX_COLUMNS = "id, title, summary, content, updated_at"
+
+async def catch_up_lexical_index(user_id: str):
+    """Pull writes made by other workers into a built BM25 index, reading only what changed"""
+    state = lexical_index.sync_state(user_id)
+    if state is None:
+        return
+    _, synced_until = state
+    lexical_index.begin_sync(user_id)
+    try:
+        # One row and a count: enough to tell whether anything changed since the last check
+        probe = await supabase.table("memories").select("updated_at", count="exact").eq(
+            "user_id", user_id
+        ).order("updated_at", desc=True).limit(1).execute()
+        newest = probe.data[0]["updated_at"] if probe.data else None
+        changed = []
+        if newest is not None and newest != synced_until:
+            changed = await fetch_all_memory_rows(user_id, LEXICAL_INDEX_COLUMNS, updated_since=synced_until)
+        
+        removed = []
+        indexed = set(lexical_index.document_ids(user_id)) | {str(row["id"]) for row in changed}
+        if probe.count is not None and probe.count != len(indexed):
+            # Deletes (or rows committed out of updated_at order) elsewhere: reconcile by id only
+            live = {str(row["id"]) for row in await fetch_all_memory_rows(user_id, "id")}
+            removed = list(indexed - live)
+            missing = list(live - indexed)
+            for start in range(0, len(missing), 500):
+                result = await supabase.table("memories").select(LEXICAL_INDEX_COLUMNS).in_(
+                    "id", missing[start:start + 500]
+                ).execute()
+                changed.extend(result.data or [])
+    except Exception:
+        lexical_index.abort_sync(user_id)
+        raise
+    await asyncio.to_thread(lexical_index.catch_up, user_id, changed, removed, newest or synced_until)
+    if changed or removed:
+        logger.info(f"Lexical index for {user_id} caught up: {len(changed)} changed, {len(removed)} removed")
+
+async def ensure_lexical_index(user_id: str):
+    """Build a user's BM25 index from Supabase the first time it is needed, then catch it up periodically"""
+    if lexical_index.has_user(user_id):
+        if lexical_index.claim_check(user_id):
+            try:
+                await single_flight.do("index_sync:lexical", user_id, lambda: catch_up_lexical_index(user_id))
+            except Exception as e:
+                logger.warning(f"Lexical index catch-up failed for {user_id}, serving the current index: {e}")
+        return
+    
+    async def build():
+        # Writes during the paging below are replayed by build(), so none are lost or resurrected
+        lexical_index.begin_sync(user_id)
+        try:
+            rows = await fetch_all_memory_rows(user_id, LEXICAL_INDEX_COLUMNS)
+        except Exception:
+            lexical_index.abort_sync(user_id)
+            raise
+        await asyncio.to_thread(lexical_index.build, user_id, rows)
+    
+    await single_flight.do("index_build:lexical", user_id, build)
+
+async def lexical_search(user_id: str, query: str, match_count: int) -> List[Tuple[str, Optional[float]]]:
+    """Ranked (memory_id, bm25 score); the text_search_memories RPC (no scores) if the index is unavailable"""
+    try:
+        await ensure_lexical_index(user_id)
+        with timed_phase("lexical_index", phase_duration):
+            hits = await asyncio.to_thread(lexical_index.search, user_id, query, match_count)
+        if hits is not None:
+            return hits
+    except Exception as e:
+        logger.warning(f"Lexical index search failed, falling back to text_search_memories RPC: {e}")
+    
+    results = await supabase.rpc(
+        'text_search_memories',
+        {
+            'search_query': query,
+            'match_count': match_count,
+            'filter_user_id': user_id
+        }
+    ).execute()
+    rows = [row for row in (results.data or []) if row.get("id") is not None]
+    memory_rows.put_many(user_id, rows)
+    return [(str(row["id"]), None) for row in rows]
+
+# Short-lived per-user row cache shared by the bridge, compress_context and /get_memories
+MEMORY_FETCH_CHUNK = 100
+memory_rows = MemoryRowCache(
+    ttl_seconds=float(os.getenv("MEMORY_ROW_CACHE_TTL_SECONDS", 120)),
+    max_users=int(os.getenv("MEMORY_ROW_CACHE_MAX_USERS", 2000))
+)
+
+async def fetch_memories(user_id: str, memory_ids: List[str], columns: List[str]) -> List[Dict]:
+    """The user's rows for memory_ids, in request order; cache first, then one in_ query per chunk"""
+    memory_ids = list(dict.fromkeys(str(memory_id) for memory_id in memory_ids))
+    columns = list(dict.fromkeys(["id"] + columns))
+    found, missing = memory_rows.get_many(user_id, memory_ids, columns)
+    
+    if missing:
+        chunks = [missing[i:i + MEMORY_FETCH_CHUNK] for i in range(0, len(missing), MEMORY_FETCH_CHUNK)]
+        results = await asyncio.gather(*[
+            supabase.table("memories").select(",".join(columns)).in_("id", chunk).eq("user_id", user_id).execute()
+            for chunk in chunks
+        ])
+        fetched = [row for result in results for row in (result.data or [])]
+        memory_rows.put_many(user_id, fetched)
+        found.update({str(row["id"]): row for row in fetched})
+    
+    return [found[memory_id] for memory_id in memory_ids if memory_id in found]
+
+# Durable background jobs (summary/embedding enrichment for background saves)
+job_queue = JobQueue(
+    os.getenv("JOB_QUEUE_PATH", "jobs.sqlite"),
+    workers=int(os.getenv("JOB_WORKERS", 4)),
+    max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", 5)),
+    lease_seconds=float(os.getenv("JOB_LEASE_SECONDS", 60))
+)
+
+# Persistent embedding clusters for the knowledge graph
+cluster_store = ClusterStore(
+    os.getenv("CLUSTER_DB_PATH", "clusters.sqlite"),
+    max_clusters=int(os.getenv("CLUSTER_MAX_CLUSTERS", 40)),
+    new_cluster_similarity=float(os.getenv("CLUSTER_NEW_SIMILARITY", 0.5)),
+    merge_similarity=float(os.getenv("CLUSTER_MERGE_SIMILARITY", 0.9))
+)
+pending_cluster_fits = set()
+
+async def fit_memory_clusters(payload: Dict) -> Dict:
+    """Background job: (re)fit a user's clusters over all stored embeddings"""
+    user_id = payload["user_id"]
+    try:
+        # Memories placed while the rows are paged are replayed onto the new fit
+        cluster_store.begin_fit(user_id)
+        rows = await fetch_all_memory_rows(user_id, "id, topics, embedding")
+        vectors = [(row, parse_embedding(row.get("embedding"))) for row in rows]
+        vectors = [(row, vector) for row, vector in vectors if vector is not None]
+        if not vectors:
+            # Persisted as an empty fit, so graph requests stop queueing fits until there is something to cluster
+            await asyncio.to_thread(cluster_store.fit, user_id, [], np.zeros((0, EMBEDDING_DIMENSIONS)), [],
+                                    EMBEDDING_DIMENSIONS)
+            return {"user_id": user_id, "clustered": 0}
+        # Mid-migration a user has two dimensions; cluster the current one when present
+        dims = {len(vector) for _, vector in vectors}
+        dim = EMBEDDING_DIMENSIONS if EMBEDDING_DIMENSIONS in dims else len(vectors[0][1])
+        vectors = [(row, vector) for row, vector in vectors if len(vector) == dim]
+        
+        await asyncio.to_thread(
+            cluster_store.fit,
+            user_id,
+            [row["id"] for row, _ in vectors],
+            np.stack([vector for _, vector in vectors]),
+            [row.get("topics") or [] for row, _ in vectors]
+        )
+        return {"user_id": user_id, "clustered": len(vectors)}
+    except Exception:
+        cluster_store.abort_fit(user_id)
+        raise
+    finally:
+        pending_cluster_fits.discard(user_id)
+
+async def request_cluster_fit(user_id: str):
+    if user_id in pending_cluster_fits:
+        return
+    pending_cluster_fits.add(user_id)
+    await job_queue.enqueue("fit_memory_clusters", {"user_id": user_id}, user_id=user_id)
+
+async def index_saved_memory(user_id: str, row: Dict):
+    """Keep derived indexes (local vectors, clusters) in step with a saved memory row"""
+    await sync_local_index("add", user_id, row)
+    await asyncio.to_thread(lexical_index.add, user_id, row)
+    fingerprint_index.add(user_id, row["id"], row.get("fingerprint"))
+    if row.get("embedding") is None:
+        return
+    try:
+        assigned = await asyncio.to_thread(
+            cluster_store.assign, user_id, row["id"], row["embedding"], row.get("topics")
+        )
+        if assigned is not None and await asyncio.to_thread(cluster_store.needs_refit, user_id):
+            await request_cluster_fit(user_id)
+    except Exception as e:
+        logger.warning(f"Cluster assignment failed for memory {row['id']}: {e}")
+
+@app.on_event("startup")
+async def start_background_workers():
+    job_queue.start()
+
+@app.on_event("shutdown")
+async def close_upstream_clients():
+    await job_queue.stop()
+    if client:
+        await client.close()
+    if supabase:
+        await supabase.aclose()
+    for pool in upstream_pools.values():
+        await pool.aclose()
+
 # Utility function for smart text truncation
 def smart_truncate(text, max_length=350):
     """Truncate text at sentence boundary, not mid-sentence"""
@@ -154,40 +688,15 @@ def smart_truncate(text, max_length=350):
     return text[:max_length].rstrip() + "..."
 
 # Phase 2: Conversation analysis functions (keeping all existing ones)
+# Keyword analyzers compiled once; per-message results are cached across calls
+text_analyzer = TextAnalyzer.from_file(
+    os.getenv("ANALYZER_KEYWORDS_PATH"),
+    max_cache_bytes=int(os.getenv("ANALYZER_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+)
+
 def extract_topics_from_text(text: str) -> List[str]:
     """Extract main topics from a text using keyword analysis"""
-    programming_keywords = ["code", "function", "variable", "class", "method", "python", "javascript", "bug", "error", "api", "database", "algorithm"]
-    writing_keywords = ["write", "essay", "article", "content", "blog", "story", "draft", "edit", "grammar", "style"]
-    business_keywords = ["strategy", "market", "analysis", "revenue", "customer", "business", "plan", "growth", "competition"]
-    learning_keywords = ["explain", "understand", "learn", "concept", "theory", "definition", "example", "teach"]
-    creative_keywords = ["design", "creative", "art", "brainstorm", "idea", "innovation", "inspiration"]
-    health_keywords = ["health", "medical", "fitness", "wellness", "nutrition", "exercise", "symptoms"]
-    finance_keywords = ["investment", "money", "budget", "financial", "trading", "economics", "profit"]
-    travel_keywords = ["travel", "trip", "vacation", "hotel", "flight", "tourism", "destination"]
-    
-    text_lower = text.lower()
-    topics = []
-    
-    keyword_groups = {
-        "programming": programming_keywords,
-        "writing": writing_keywords,
-        "business": business_keywords,
-        "learning": learning_keywords,
-        "creative": creative_keywords,
-        "health": health_keywords,
-        "finance": finance_keywords,
-        "travel": travel_keywords
-    }
-    
-    for topic, keywords in keyword_groups.items():
-        if any(keyword in text_lower for keyword in keywords):
-            topics.append(topic)
-    
-    # Default topic if none detected
-    if not topics:
-        topics.append("general")
-    
-    return topics
+    return text_analyzer.topics(text)
 
 def calculate_topic_coherence(topics_per_turn: List[List[str]]) -> float:
     """Calculate how coherent the conversation topics are"""
@@ -211,7 +720,7 @@ def calculate_topic_coherence(topics_per_turn: List[List[str]]) -> float:
         overlap_scores.append(overlap_score)
     
     # Convert to 0-10 scale
-    avg_overlap = statistics.mean(overlap_scores) if overlap_scores else 0.5
+    avg_overlap = statistics.fmean(overlap_scores) if overlap_scores else 0.5
     coherence_score = 10 * avg_overlap + 3  # Bias towards higher scores
     
     return min(10.0, max(0.0, coherence_score))
@@ -254,32 +763,11 @@ def identify_conversation_issues(history: List[Dict]) -> List[str]:
 
 def is_similar_question(q1: str, q2: str) -> bool:
     """Check if two questions are similar"""
-    q1_words = set(q1.lower().split())
-    q2_words = set(q2.lower().split())
-    
-    if len(q1_words) == 0 or len(q2_words) == 0:
-        return False
-    
-    intersection = len(q1_words.intersection(q2_words))
-    union = len(q1_words.union(q2_words))
-    
-    similarity = intersection / union if union > 0 else 0
-    return similarity > 0.6
+    return text_analyzer.is_similar(q1, q2)
 
 def is_vague_response(response: str) -> bool:
     """Detect if an AI response is vague or unhelpful"""
-    vague_indicators = [
-        "it depends", "maybe", "possibly", "perhaps", "i'm not sure",
-        "that's a good question", "there are many ways", "it varies"
-    ]
-    
-    response_lower = response.lower()
-    vague_count = sum(1 for indicator in vague_indicators if indicator in response_lower)
-    
-    # Also check for very short responses
-    word_count = len(response.split())
-    
-    return vague_count >= 2 or word_count < 20
+    return text_analyzer.is_vague(response)
 
 def analyze_conversation_coherence(history: List[Dict]) -> Dict:
     """Analyze if conversation maintains focus and coherence"""
@@ -303,10 +791,50 @@ def analyze_conversation_coherence(history: List[Dict]) -> Dict:
     return {
         "coherence_score": coherence_score,
         "issues": issues,
-        "topic_drift": len(set(sum(topics_per_turn, []))) / len(topics_per_turn) if topics_per_turn else 1.0,
+        "topic_drift": len({topic for topics in topics_per_turn for topic in topics}) / len(topics_per_turn) if topics_per_turn else 1.0,
         "conversation_depth": {"depth_score": 5.0, "progression": "stable"}
     }
 
+# Shared token counter (offline BPE from local .tiktoken files; a configured file that is missing fails startup)
+token_counter = TokenCounter(
+    bpe_files(
+        os.getenv("TOKENIZER_BPE_DIR"),
+        os.getenv("TOKENIZER_BPE_PATH"),
+        os.getenv("TOKENIZER_ENCODING", "o200k_base")
+    ),
+    default_encoding=os.getenv("TOKENIZER_ENCODING", "o200k_base")
+)
+
+# Per-conversation analysis state, so repeat calls only process new messages
+conversation_states = ConversationStateStore(
+    extract_topics_from_text,
+    is_similar_question,
+    is_vague_response,
+    count_tokens=token_counter.count_message,
+    max_conversations=int(os.getenv("CONVERSATION_STATE_MAX", 10000)),
+    ttl_seconds=float(os.getenv("CONVERSATION_STATE_TTL_SECONDS", 6 * 3600))
+)
+
+def resolve_conversation_state(namespace: str, user_id: Optional[str], conversation_id: Optional[str],
+                               history: List[Dict], cursor: Optional[int] = None,
+                               new_messages: Optional[List[Dict]] = None,
+                               encoding: Optional[str] = None) -> Optional[ConversationState]:
+    """Update stored state from a delta (cursor + new messages) or a full history.
+    
+    State is per user: without an X-User-ID the request is analyzed statelessly.
+    """
+    if not conversation_id or not user_id:
+        return None
+    if cursor is not None:
+        state = conversation_states.apply_delta(namespace, user_id, conversation_id, cursor, new_messages or [], encoding)
+        if state is None:
+            raise HTTPException(status_code=409, detail={
+                "error": "resync_required",
+                "message": "Conversation state not found or cursor mismatch; resend the full history"
+            })
+        return state
+    return conversation_states.sync(namespace, user_id, conversation_id, history, encoding)
+
 def generate_conversation_suggestions(analysis: Dict, context: str) -> List[str]:
     """Generate specific suggestions based on conversation analysis"""
     suggestions = []
@@ -362,6 +890,9 @@ class Conversation(BaseModel):
     url: str = ""
     title: str = ""
 
+class ConversationBatch(BaseModel):
+    conversations: List[Conversation]
+
 class SearchQuery(BaseModel):
     query: str
     limit: int = 5
@@ -383,6 +914,8 @@ class ConversationAnalysisRequest(BaseModel):
     assistant_message: str
     conversation_history: List[Dict] = []
     conversation_id: Optional[str] = None
+    # Delta mode: conversation_history holds only messages after this cursor
+    cursor: Optional[int] = None
 
 class FollowUpRequest(BaseModel):
     conversation_history: List[Dict]
@@ -400,10 +933,15 @@ class ContextBridgeRequest(BaseModel):
     current_conversation: List[Dict]
     search_query: Optional[str] = None
     max_context_tokens: int = 2000
+    context_mode: Optional[str] = None  # "summarize" (LLM) or "passages"; BRIDGE_CONTEXT_MODE by default
 
 class KnowledgeGraphRequest(BaseModel):
     time_range_days: int = 30
     max_nodes: int = 50
+    topic_top_k: int = 8
+    similarity_edges: bool = True
+    similarity_top_k: int = 5
+    similarity_threshold: float = 0.75
 
 class ContextInjectionRequest(BaseModel):
     memory_ids: List[str]
@@ -418,19 +956,766 @@ async def root():
         "environment": os.getenv("RAILWAY_ENVIRONMENT", "local"),
         "openai_configured": client is not None,
         "supabase_configured": supabase is not None,
-        "storage_backend": "supabase" if supabase else "none",
+        "storage_backend": STORAGE_BACKEND if supabase else "none",
         "features": ["user_isolation", "rate_limiting", "conversation_analysis", "permanent_storage"],
         "version": "2.0.0"
     }
 
 @app.get("/health")
 async def health():
-    return {"status": "healthy", "storage": "supabase" if supabase else "none"}
+    return {"status": "healthy", "storage": STORAGE_BACKEND if supabase else "none"}
+
+@app.get("/pool_stats")
+async def pool_stats():
+    """Upstream connection pool usage; saturation near 1.0 means requests are waiting for a connection"""
+    return {name: pool.snapshot() for name, pool in upstream_pools.items()}
+
+@app.get("/cache_stats")
+async def cache_stats():
+    return {
+        "embeddings": embedding_cache.snapshot(),
+        "responses": response_cache.snapshot(),
+        "conversation_state": conversation_states.snapshot(),
+        "token_counts": token_counter.snapshot(),
+        "memory_rows": memory_rows.snapshot(),
+        "knowledge_graphs": knowledge_graphs.snapshot(),
+        "lexical_index": lexical_index.snapshot(),
+        "text_analyzer": text_analyzer.snapshot(),
+        "single_flight": single_flight.snapshot(),
+        "vector_index": vector_index.snapshot() if vector_index else None,
+        "embedding_migrations": embedding_migrations.snapshot(),
+        "dedupe": {**fingerprint_index.snapshot(), "actions": dict(save_actions)}
+    }
+
+# Scrape-time metrics read from the same counters /cache_stats and /pool_stats report
+CACHE_METRICS = {
+    "embeddings": (lambda: embedding_cache.stats, ("memory_hits", "disk_hits"), ("misses",)),
+    "responses": (lambda: response_cache.stats, ("exact_hits", "near_hits"), ("misses",)),
+    "memory_rows": (lambda: memory_rows.stats, ("hits",), ("misses",)),
+    "knowledge_graphs": (lambda: knowledge_graphs.stats, ("hits",), ("misses",)),
+    "token_counts": (lambda: token_counter.stats, ("hits",), ("misses",)),
+    "conversation_state": (lambda: conversation_states.stats, ("incremental",), ("rebuilt",))
+}
+
+@metrics.collector
+def cache_metrics():
+    hits, misses, ratios = [], [], []
+    for name, (stats, hit_keys, miss_keys) in CACHE_METRICS.items():
+        counts = stats()
+        hit_count = sum(counts.get(key, 0) for key in hit_keys)
+        miss_count = sum(counts.get(key, 0) for key in miss_keys)
+        hits.append(({"cache": name}, hit_count))
+        misses.append(({"cache": name}, miss_count))
+        ratios.append(({"cache": name}, hit_count / (hit_count + miss_count) if hit_count + miss_count else 0.0))
+    return [
+        ("cache_hits_total", "counter", "Lookups answered from cache", hits),
+        ("cache_misses_total", "counter", "Lookups that missed the cache", misses),
+        ("cache_hit_ratio", "gauge", "Hits over lookups since start", ratios)
+    ]
+
+@metrics.collector
+def upstream_metrics():
+    pools = {name: pool.snapshot() for name, pool in upstream_pools.items()}
+    flights = single_flight.snapshot()
+    return [
+        ("upstream_requests_in_flight", "gauge", "Upstream HTTP requests awaiting a response or body",
+         [({"upstream": name}, stats["in_flight"]) for name, stats in pools.items()]),
+        ("upstream_open_connections", "gauge", "Pooled upstream connections",
+         [({"upstream": name}, stats["open_connections"]) for name, stats in pools.items()]),
+        ("upstream_queued_requests_total", "counter", "Requests that found the pool at its connection limit",
+         [({"upstream": name}, stats["queued_requests"]) for name, stats in pools.items()]),
+        ("singleflight_in_flight", "gauge", "Distinct upstream calls being coalesced onto", [({}, flights["in_flight"])]),
+        ("singleflight_calls_total", "counter", "Calls that went upstream, by group",
+         [({"group": group}, stats["calls"]) for group, stats in flights["groups"].items()]),
+        ("singleflight_coalesced_total", "counter", "Calls that joined one already in flight, by group",
+         [({"group": group}, stats["coalesced"]) for group, stats in flights["groups"].items()])
+    ]
+
+@metrics.collector
+def background_metrics():
+    return [
+        ("jobs", "gauge", "Background jobs by status", [({"status": status}, count) for status, count in job_queue.snapshot().items()]),
+        ("memory_saves_total", "counter", "Conversation saves by dedupe outcome",
+         [({"action": action}, count) for action, count in save_actions.items()])
+    ]
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus text exposition format"""
+    # Rendered on the event loop, like /cache_stats, so snapshots never race the counters they read
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
 
 # USER-ISOLATED ENDPOINTS WITH SUPABASE
 
+# Conversation ingestion helpers (shared by single and batch saves)
+BATCH_MAX_CONVERSATIONS = int(os.getenv("BATCH_MAX_CONVERSATIONS", 500))
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", 100))
+# Conversations one request can pay for at once; streamed chunks are kept within it
+MAX_CHARGED_CONVERSATIONS = (
+    int(rate_limiter.algorithm.capacity // SAVE_CONVERSATION_COST) if SAVE_CONVERSATION_COST > 0 else BATCH_MAX_CONVERSATIONS
+)
+STREAM_CHUNK_SIZE = max(1, min(BATCH_CHUNK_SIZE, MAX_CHARGED_CONVERSATIONS))
+# Streamed uploads past this size are spooled to disk instead of held in memory
+STREAM_SPOOL_BYTES = int(os.getenv("STREAM_SPOOL_BYTES", 8 * 1024 * 1024))
+BATCH_SUMMARY_CONCURRENCY = int(os.getenv("BATCH_SUMMARY_CONCURRENCY", 8))
+
+def conversation_turns(conversation: Conversation) -> List[str]:
+    return [f"{msg.role}: {msg.content}" for msg in conversation.messages]
+
+def conversation_to_text(conversation: Conversation) -> str:
+    return "\n".join(conversation_turns(conversation))
+
+# Passage-level embeddings: turn-aligned chunks of each conversation (memory_passages table)
+PASSAGES_ENABLED = os.getenv("PASSAGES_ENABLED", "true").lower() == "true"
+PASSAGE_MAX_TOKENS = int(os.getenv("PASSAGE_MAX_TOKENS", 400))
+PASSAGE_MATCH_THRESHOLD = float(os.getenv("PASSAGE_MATCH_THRESHOLD", 0.5))
+SEARCH_PASSAGES_PER_RESULT = int(os.getenv("SEARCH_PASSAGES_PER_RESULT", 2))
+
+def conversation_passages(conversation: Conversation) -> List[Passage]:
+    if not PASSAGES_ENABLED:
+        return []
+    return chunk_turns(conversation_turns(conversation), PASSAGE_MAX_TOKENS,
+                       lambda text: token_counter.count(text, EMBEDDING_ENCODING))
+
+def passage_texts(conversation_text: str, passages: List[Passage]) -> List[str]:
+    return [conversation_text[passage.start:passage.end] for passage in passages]
+
+def passage_rows(user_id: str, memory_id: str, passages: List[Passage],
+                 vectors: List[Optional[List[float]]]) -> List[Dict]:
+    return [
+        {
+            "memory_id": memory_id,
+            "user_id": user_id,
+            "passage_index": passage.index,
+            "start_offset": passage.start,
+            "end_offset": passage.end,
+            "message_start": passage.message_start,
+            "message_end": passage.message_end,
+            "embedding": vector,
+            "embedding_model": EMBEDDING_TAG
+        }
+        for passage, vector in zip(passages, vectors) if vector is not None
+    ]
+
+async def store_passages(rows: List[Dict], replace: bool = False):
+    """Insert passage rows; a failure only costs passage search for those memories.
+    
+    With ``replace`` the memories' old passages are deleted first, so a failed insert
+    would leave them with none: that failure is raised for the calling job to retry.
+    """
+    if not rows:
+        return
+    try:
+        if replace:
+            memory_ids = list(dict.fromkeys(row["memory_id"] for row in rows))
+            await supabase.table("memory_passages").delete().in_("memory_id", memory_ids).execute()
+        for start in range(0, len(rows), BATCH_CHUNK_SIZE):
+            await supabase.table("memory_passages").insert(rows[start:start + BATCH_CHUNK_SIZE]).execute()
+    except Exception as e:
+        if replace:
+            raise
+        logger.warning(f"Storing {len(rows)} passages failed: {e}")
+
+async def passage_search(user_id: str, query_embeddings: Dict[int, List[float]], match_count: int,
+                         match_threshold: float = PASSAGE_MATCH_THRESHOLD) -> List[Dict]:
+    """Closest passages across the user's memories; empty when passages are off or unavailable"""
+    if not PASSAGES_ENABLED:
+        return []
+    try:
+        results = await asyncio.gather(*[
+            supabase.rpc(
+                'search_memory_passages',
+                {
+                    'query_embedding': query_embedding,
+                    'match_threshold': match_threshold,
+                    'match_count': match_count,
+                    'filter_user_id': user_id
+                }
+            ).execute()
+            for query_embedding in query_embeddings.values()
+        ])
+        return merge_by_similarity([result.data or [] for result in results], match_count)
+    except Exception as e:
+        logger.warning(f"Passage search failed: {e}")
+        return []
+
+def passage_result(row: Dict) -> Dict:
+    return {
+        "passage_index": row.get("passage_index"),
+        "start": row.get("start_offset"),
+        "end": row.get("end_offset"),
+        "message_start": row.get("message_start"),
+        "message_end": row.get("message_end"),
+        "text": row.get("content") or "",
+        "similarity": round(float(row.get("distance") or 0.0), 4)
+    }
+
+async def summarize_conversation(conversation_text: str) -> Tuple[str, List[str]]:
+    """Ask GPT for a summary and topic list; returns (summary, topics)"""
+    response = await client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": """Extract:
+                        1. A concise summary of the key information
+                        2. Main topics discussed (comma-separated)
+                        Format: 
+                        Summary: [your summary]
+                        Topics: [topic1, topic2, topic3]"""},
+            {"role": "user", "content": conversation_text}
+        ],
+        max_tokens=300
+    )
+    return parse_summary_response(response.choices[0].message.content)
+
+async def summarize_conversation_delta(previous_summary: str, previous_topics: List[str],
+                                       new_text: str) -> Tuple[str, List[str]]:
+    """Fold the messages added since the last save into the existing summary, without resending the transcript"""
+    response = await client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": """You are updating the summary of a conversation that has continued.
+                        You get its current summary and topics, then only the new messages.
+                        Extract:
+                        1. A concise summary of the key information in the whole conversation so far
+                        2. Main topics of the whole conversation (comma-separated)
+                        Format: 
+                        Summary: [your summary]
+                        Topics: [topic1, topic2, topic3]"""},
+            {"role": "user", "content": f"Current summary: {previous_summary}\n"
+                                        f"Current topics: {', '.join(previous_topics or [])}\n\n"
+                                        f"New messages:\n{new_text}"}
+        ],
+        max_tokens=300
+    )
+    return parse_summary_response(response.choices[0].message.content)
+
+def parse_summary_response(full_response: str) -> Tuple[str, List[str]]:
+    if "Summary:" in full_response and "Topics:" in full_response:
+        parts = full_response.split("Topics:")
+        summary = parts[0].replace("Summary:", "").strip()
+        topics_str = parts[1].strip()
+        return summary, [t.strip() for t in topics_str.split(",")]
+    return full_response, []
+
+def fallback_summary(conversation: Conversation) -> str:
+    first_msg = conversation.messages[0].content[:100] if conversation.messages else "Empty conversation"
+    return f"Conversation starting with: {first_msg}..."
+
+def build_memory_row(user_id: str, conversation: Conversation, conversation_text: str,
+                     summary: str, key_topics: List[str], embedding: Optional[List[float]],
+                     fingerprint: Optional[str] = None) -> Dict:
+    return {
+        "user_id": user_id,
+        "content": conversation_text,
+        "summary": summary,
+        "title": conversation.title or "Untitled Conversation",
+        "topics": key_topics,
+        # Thread URLs are stored without their query string, so every later save of the thread finds them
+        "url": thread_url(conversation.url) or conversation.url,
+        "message_count": len(conversation.messages),
+        "content_length": len(conversation_text),
+        "embedding": embedding,
+        "embedding_model": EMBEDDING_TAG if embedding is not None else None,
+        "fingerprint": fingerprint
+    }
+
+# Re-saves of one conversation update its memory instead of adding another: matched on a thread URL, or on
+# MinHash fingerprint (fingerprint.py) when the URL finds nothing; a thread that only grew is re-summarized
+# from its stored summary plus the new messages. Any other change replaces the memory only when at least
+# DEDUPE_REPLACE_OVERLAP of its text survives in the new save; otherwise the save is a new memory
+DEDUPE_ENABLED = os.getenv("DEDUPE_ENABLED", "true").lower() == "true"
+DEDUPE_SIMILARITY = float(os.getenv("DEDUPE_SIMILARITY", 0.9))
+DEDUPE_REPLACE_OVERLAP = float(os.getenv("DEDUPE_REPLACE_OVERLAP", 0.5))
+SAVE_MATCH_CANDIDATES = 5
+SAVE_MATCH_COLUMNS = "id, title, summary, topics, content, url, message_count, created_at, embedding_model"
+fingerprint_index = FingerprintIndex(
+    max_users=int(os.getenv("FINGERPRINT_INDEX_MAX_USERS", 500)),
+    max_age_seconds=float(os.getenv("FINGERPRINT_INDEX_MAX_AGE_SECONDS", 600))
+)
+save_actions = {"insert": 0, "unchanged": 0, "append": 0, "replace": 0, "superseded": 0}
+
+class SaveMatch(NamedTuple):
+    # "insert" (no earlier save of this conversation), "unchanged" (same text), "append" (earlier text is a
+    # whole-turn prefix) or "replace" (text diverged, e.g. an edited or regenerated message, but mostly overlaps)
+    action: str
+    existing: Optional[Dict] = None
+    appended_from: int = 0
+
+async def ensure_fingerprint_index(user_id: str):
+    if fingerprint_index.has_user(user_id):
+        return
+    
+    async def build():
+        rows = await fetch_all_memory_rows(user_id, "id, fingerprint")
+        await asyncio.to_thread(fingerprint_index.build, user_id, rows)
+    
+    await single_flight.do("index_build:fingerprint", user_id, build)
+
+async def find_saved_conversations(user_id: str, conversation: Conversation, fingerprint: str) -> List[Dict]:
+    """Latest memories saved from the same thread URL, else the closest fingerprint from a save without one"""
+    url = thread_url(conversation.url)
+    if url:
+        result = await order_by(
+            supabase.table("memories").select(SAVE_MATCH_COLUMNS).eq("user_id", user_id).eq("url", url),
+            "created_at.desc", "id.desc"
+        ).limit(SAVE_MATCH_CANDIDATES).execute()
+        if result.data:
+            return result.data
+    
+    await ensure_fingerprint_index(user_id)
+    match = await asyncio.to_thread(fingerprint_index.nearest, user_id, fingerprint, DEDUPE_SIMILARITY)
+    if match is None:
+        return []
+    result = await supabase.table("memories").select(SAVE_MATCH_COLUMNS).eq(
+        "id", match[0]
+    ).eq("user_id", user_id).execute()
+    existing = result.data[0] if result.data else None
+    # Two different threads can open identically; only a save without a thread URL is matched on content alone
+    if not existing or (thread_url(existing.get("url")) and url):
+        return []
+    if url:
+        # Record the URL so later, longer saves of the thread match on it
+        await supabase.table("memories").update({"url": url}).eq("id", existing["id"]).execute()
+        existing["url"] = url
+    return [existing]
+
+async def compare_saved_conversation(existing: Dict, conversation: Conversation, conversation_text: str) -> Optional[SaveMatch]:
+    """How a save relates to one candidate memory, or None if it is a different conversation"""
+    if (existing.get("content") or "") == conversation_text:
+        return SaveMatch("unchanged", existing)
+    
+    # A delta summary needs a real one to extend; raw or failed saves have no embedding_model
+    appended_from = appended_turns(existing.get("content") or "", conversation_turns(conversation))
+    if appended_from is not None and existing.get("embedding_model"):
+        return SaveMatch("append", existing, appended_from)
+    if appended_from is not None:
+        return SaveMatch("replace", existing)
+    # Never overwrite a memory with text it does not share, whatever matched it
+    overlap = await asyncio.to_thread(shingle_overlap, existing.get("content") or "", conversation_text)
+    if overlap >= DEDUPE_REPLACE_OVERLAP:
+        return SaveMatch("replace", existing)
+    logger.info(f"Save matched memory {existing['id']} but shares only {overlap:.0%} of its text; not replacing it")
+    return None
+
+async def match_saved_conversation(user_id: str, conversation: Conversation, conversation_text: str,
+                                   fingerprint: str) -> SaveMatch:
+    if not DEDUPE_ENABLED:
+        return SaveMatch("insert")
+    try:
+        candidates = await find_saved_conversations(user_id, conversation, fingerprint)
+        for existing in candidates:
+            match = await compare_saved_conversation(existing, conversation, conversation_text)
+            if match is not None:
+                return match
+    except Exception as e:
+        logger.warning(f"Duplicate lookup failed, saving as a new memory: {e}")
+    return SaveMatch("insert")
+
+def delta_text(conversation: Conversation, appended_from: int) -> str:
+    return "\n".join(conversation_turns(conversation)[appended_from:])
+
+async def reusable_passage_vectors(memory_id: str, passages: List[Passage]) -> List[Optional[List[float]]]:
+    """Stored vectors of passages whose span is unchanged, i.e. in the part of a grown conversation saved before"""
+    try:
+        result = await supabase.table("memory_passages").select(
+            "start_offset, end_offset, embedding, embedding_model"
+        ).eq("memory_id", memory_id).execute()
+    except Exception as e:
+        logger.warning(f"Loading passages of memory {memory_id} failed, re-embedding them: {e}")
+        return [None] * len(passages)
+    stored = {
+        (row["start_offset"], row["end_offset"]): parse_embedding(row.get("embedding"))
+        for row in result.data or [] if row.get("embedding_model") == EMBEDDING_TAG
+    }
+    vectors = [stored.get((passage.start, passage.end)) for passage in passages]
+    return [vector.tolist() if vector is not None else None for vector in vectors]
+
+async def embed_memories(items: List[Tuple[str, str, List[Passage], Optional[List[Optional[List[float]]]]]]
+                         ) -> List[Tuple[List[float], List[List[float]]]]:
+    """(summary, text, passages, reused vectors or None) -> (memory embedding, passage embeddings), in one call
+
+    Each memory is embedded from its summary and opening text; passages that
+    already have a vector are not sent again.
+    """
+    missing = [
+        [j for j in range(len(passages)) if not reused or reused[j] is None]
+        for _, _, passages, reused in items
+    ]
+    vectors = await get_embeddings(
+        [f"{summary}\n{text[:1000]}" for summary, text, _, _ in items]
+        + [text[passages[j].start:passages[j].end] for (_, text, passages, _), js in zip(items, missing) for j in js]
+    )
+    remaining = iter(vectors[len(items):])
+    embedded = []
+    for (_, _, passages, reused), embedding, js in zip(items, vectors, missing):
+        passage_vectors = list(reused) if reused else [None] * len(passages)
+        for j in js:
+            passage_vectors[j] = next(remaining)
+        embedded.append((embedding, passage_vectors))
+    return embedded
+
+async def update_saved_memory(user_id: str, memory_id: str, memory_data: Dict,
+                              passages: List[Passage], passage_vectors: List[Optional[List[float]]]) -> Dict:
+    """Write a re-saved conversation over its existing memory and refresh its passages and indexes"""
+    fields = {key: value for key, value in memory_data.items() if key != "user_id"}
+    result = await supabase.table("memories").update(fields).eq("id", memory_id).eq("user_id", user_id).execute()
+    if not result.data:
+        raise ValueError(f"Memory {memory_id} was deleted while being updated")
+    
+    if "embedding" in fields:
+        try:
+            await store_passages(passage_rows(user_id, memory_id, passages, passage_vectors), replace=True)
+        except Exception as e:
+            # The memory itself is saved; only passage search is lost for it until it changes again
+            logger.warning(f"Replacing passages of memory {memory_id} failed: {e}")
+    await index_saved_memory(user_id, {**result.data[0], "embedding": fields.get("embedding")})
+    memory_rows.invalidate(user_id, memory_id)
+    return result.data[0]
+
+async def defer_enrichment(user_id: str, match: SaveMatch, conversation: Conversation, conversation_text: str,
+                           fingerprint: str, passages: List[Passage]) -> Tuple[Dict, str]:
+    """Store a re-saved conversation's text now and leave its summary and embeddings to enrich_memory"""
+    existing = match.existing
+    memory_data = build_memory_row(user_id, conversation, conversation_text, existing.get("summary"),
+                                   existing.get("topics") or [], None, fingerprint)
+    # The stored embedding stays searchable; a null embedding_model marks the summary as pending, so
+    # another re-save before the job finishes is summarized in full rather than as a delta of it
+    for field in ("summary", "topics", "embedding"):
+        memory_data.pop(field)
+    await update_saved_memory(user_id, existing["id"], memory_data, passages, [])
+    
+    payload = {
+        "user_id": user_id,
+        "memory_id": existing["id"],
+        "conversation_text": conversation_text,
+        "passages": [list(passage) for passage in passages],
+        "fallback_summary": existing.get("summary") or fallback_summary(conversation)
+    }
+    if match.action == "append":
+        payload.update({
+            "previous_summary": existing.get("summary"),
+            "previous_topics": existing.get("topics") or [],
+            "delta_text": delta_text(conversation, match.appended_from)
+        })
+    job_id = await job_queue.enqueue("enrich_memory", payload, user_id=user_id)
+    return existing, job_id
+
+async def ingest_conversations(user_id: str, conversations: List[Conversation]) -> List[Dict]:
+    """Summarize, embed and save many conversations, updating earlier saves of the same ones; one status per item"""
+    texts = [conversation_to_text(c) for c in conversations]
+    fingerprints = await asyncio.to_thread(lambda: [text_fingerprint(text) for text in texts])
+    summaries = [(fallback_summary(c), []) for c in conversations]
+    embeddings: List[Optional[List[float]]] = [None] * len(conversations)
+    passages = [conversation_passages(c) for c in conversations]
+    passage_vectors: List[List[Optional[List[float]]]] = [[] for _ in conversations]
+    semaphore = asyncio.Semaphore(BATCH_SUMMARY_CONCURRENCY)
+    statuses: Dict[int, Dict] = {}
+    
+    # Earlier copies of a URL in the same batch are older snapshots of the thread the last copy saves
+    urls = [thread_url(c.url) for c in conversations]
+    last_for_url = {url: i for i, url in enumerate(urls) if url}
+    for i, url in enumerate(urls):
+        if DEDUPE_ENABLED and url and last_for_url[url] != i:
+            statuses[i] = {"index": i, "status": "success", "action": "superseded", "superseded_by": last_for_url[url]}
+            save_actions["superseded"] += 1
+    
+    async def match(i: int) -> SaveMatch:
+        async with semaphore:
+            return await match_saved_conversation(user_id, conversations[i], texts[i], fingerprints[i])
+    
+    pending = [i for i in range(len(conversations)) if i not in statuses]
+    matches = dict(zip(pending, await asyncio.gather(*[match(i) for i in pending])))
+    for i, saved in matches.items():
+        save_actions[saved.action] += 1
+        if saved.action == "unchanged":
+            statuses[i] = {
+                "index": i,
+                "status": "success",
+                "action": saved.action,
+                "id": saved.existing["id"],
+                "summary": saved.existing.get("summary"),
+                "message_count": saved.existing.get("message_count"),
+                "topics": saved.existing.get("topics") or []
+            }
+    pending = [i for i in pending if i not in statuses]
+    
+    if client:
+        async def summarize(i: int) -> bool:
+            async with semaphore:
+                try:
+                    saved = matches[i]
+                    if saved.action == "append":
+                        summary, key_topics = await summarize_conversation_delta(
+                            saved.existing.get("summary"), saved.existing.get("topics") or [],
+                            delta_text(conversations[i], saved.appended_from)
+                        )
+                    else:
+                        summary, key_topics = await summarize_conversation(texts[i])
+                    summaries[i] = (summary or fallback_summary(conversations[i]), key_topics)
+                    return True
+                except Exception as e:
+                    logger.error(f"OpenAI API error in batch item {i}: {e}")
+                    summaries[i] = (f"Error generating summary: {str(e)}", [])
+                    return False
+        
+        summarized = await asyncio.gather(*[summarize(i) for i in pending])
+        
+        # Memory and passage embeddings share multi-input calls instead of one call per text
+        to_embed = [i for i, ok in zip(pending, summarized) if ok]
+        
+        async def reusable(i: int) -> Optional[List[Optional[List[float]]]]:
+            if matches[i].action != "append":
+                return None
+            return await reusable_passage_vectors(matches[i].existing["id"], passages[i])
+        
+        reused = await asyncio.gather(*[reusable(i) for i in to_embed])
+        try:
+            embedded = await embed_memories([
+                (summaries[i][0], texts[i], passages[i], vectors) for i, vectors in zip(to_embed, reused)
+            ])
+            for i, (embedding, vectors) in zip(to_embed, embedded):
+                embeddings[i], passage_vectors[i] = embedding, vectors
+        except Exception as e:
+            logger.error(f"OpenAI embedding error in batch: {e}")
+    
+    inserts = [i for i in pending if matches[i].action == "insert"]
+    rows = {
+        i: build_memory_row(user_id, conversations[i], texts[i], summaries[i][0], summaries[i][1],
+                            embeddings[i], fingerprints[i])
+        for i in pending
+    }
+    
+    for start in range(0, len(inserts), BATCH_CHUNK_SIZE):
+        chunk = inserts[start:start + BATCH_CHUNK_SIZE]
+        try:
+            result = await supabase.table("memories").insert([rows[i] for i in chunk]).execute()
+            saved_rows = result.data or []
+        except Exception as e:
+            # One bad row fails the whole statement: retry the chunk row by row so only that row errors
+            logger.warning(f"Bulk insert failed for items {chunk[0]}-{chunk[-1]}, retrying one by one: {e}")
+            saved_rows = []
+            for i in chunk:
+                try:
+                    result = await supabase.table("memories").insert(rows[i]).execute()
+                    if not result.data:
+                        raise ValueError("Insert returned no row")
+                    saved_rows.append(result.data[0])
+                except Exception as row_error:
+                    logger.error(f"Insert failed for batch item {i}: {row_error}")
+                    statuses[i] = {"index": i, "status": "error", "error": str(row_error)}
+            chunk = [i for i in chunk if i not in statuses]
+        if len(saved_rows) != len(chunk):
+            logger.error(f"Bulk insert for items {chunk[0]}-{chunk[-1]} returned {len(saved_rows)} of {len(chunk)} rows")
+            statuses.update({i: {"index": i, "status": "error", "error": f"Inserted {len(saved_rows)} of {len(chunk)} rows"} for i in chunk})
+            continue
+        
+        await store_passages([
+            passage_row
+            for i, saved in zip(chunk, saved_rows)
+            for passage_row in passage_rows(user_id, saved['id'], passages[i], passage_vectors[i])
+        ])
+        for i, saved in zip(chunk, saved_rows):
+            await index_saved_memory(user_id, {**saved, "embedding": rows[i]["embedding"]})
+            if client and embeddings[i] is None:
+                # Summary or embedding failed: the row is saved unsearchable, so finish it in the background
+                job_id = await job_queue.enqueue("enrich_memory", {
+                    "user_id": user_id,
+                    "memory_id": saved['id'],
+                    "conversation_text": texts[i],
+                    "passages": [list(passage) for passage in passages[i]],
+                    "fallback_summary": fallback_summary(conversations[i])
+                }, user_id=user_id)
+                statuses[i] = {"index": i, "status": "accepted", "action": "insert", "id": saved['id'], "job_id": job_id}
+                continue
+            statuses[i] = {
+                "index": i,
+                "status": "success",
+                "action": "insert",
+                "id": saved['id'],
+                "summary": rows[i]["summary"],
+                "message_count": rows[i]["message_count"],
+                "topics": rows[i]["topics"]
+            }
+    
+    async def update(i: int):
+        saved = matches[i]
+        async with semaphore:
+            try:
+                if embeddings[i] is None:
+                    # Keep the earlier summary rather than overwrite it with an error; the job retries
+                    _, job_id = await defer_enrichment(user_id, saved, conversations[i], texts[i],
+                                                       fingerprints[i], passages[i])
+                    statuses[i] = {"index": i, "status": "accepted", "action": saved.action,
+                                   "id": saved.existing["id"], "job_id": job_id}
+                    return
+                await update_saved_memory(user_id, saved.existing["id"], rows[i], passages[i], passage_vectors[i])
+            except Exception as e:
+                logger.error(f"Updating memory {saved.existing['id']} from batch item {i} failed: {e}")
+                statuses[i] = {"index": i, "status": "error", "error": str(e)}
+                return
+        statuses[i] = {
+            "index": i,
+            "status": "success",
+            "action": saved.action,
+            "id": saved.existing["id"],
+            "summary": rows[i]["summary"],
+            "message_count": rows[i]["message_count"],
+            "topics": rows[i]["topics"]
+        }
+    
+    await asyncio.gather(*[update(i) for i in pending if matches[i].action != "insert"])
+    return [statuses[i] for i in range(len(conversations))]
+
+async def enrich_memory(payload: Dict) -> Dict:
+    """Background job: summarize and embed a memory that was saved raw"""
+    if not client:
+        raise RuntimeError("OpenAI not configured")
+    
+    user_id = payload["user_id"]
+    memory_id = payload["memory_id"]
+    conversation_text = payload["conversation_text"]
+    passages = [Passage(*passage) for passage in payload.get("passages", [])]
+    
+    reused = None
+    if "delta_text" in payload:
+        # A re-save of a conversation that only grew: extend the stored summary, keep the earlier passages' vectors
+        summary, key_topics = await summarize_conversation_delta(
+            payload["previous_summary"], payload["previous_topics"], payload["delta_text"]
+        )
+        reused = await reusable_passage_vectors(memory_id, passages)
+    else:
+        summary, key_topics = await summarize_conversation(conversation_text)
+    summary = summary or payload["fallback_summary"]
+    [(embedding, passage_vectors)] = await embed_memories([(summary, conversation_text, passages, reused)])
+    
+    result = await supabase.table("memories").update({
+        "summary": summary,
+        "topics": key_topics,
+        "embedding": embedding,
+        "embedding_model": EMBEDDING_TAG
+    }).eq("id", memory_id).eq("user_id", user_id).execute()
+    
+    if not result.data:
+        logger.info(f"Memory {memory_id} was deleted before enrichment finished")
+        return {"memory_id": memory_id, "skipped": "memory deleted"}
+    
+    # A retried job replaces the passages an earlier attempt stored
+    await store_passages(passage_rows(user_id, memory_id, passages, passage_vectors), replace=True)
+    await index_saved_memory(user_id, {**result.data[0], "embedding": embedding})
+    memory_rows.invalidate(user_id, result.data[0]["id"])
+    logger.info(f"Enriched memory {memory_id} for user {user_id} with topics: {key_topics}")
+    return {"memory_id": memory_id, "summary": summary, "topics": key_topics}
+
+job_queue.register("enrich_memory", enrich_memory)
+job_queue.register("fit_memory_clusters", fit_memory_clusters)
+
+# Re-embedding at EMBEDDING_DIMENSIONS: resumable per-user batches, checkpointed after each one
+EMBEDDING_MIGRATION_BATCH = int(os.getenv("EMBEDDING_MIGRATION_BATCH", 100))
+EMBEDDING_AUTO_MIGRATE = os.getenv("EMBEDDING_AUTO_MIGRATE", "true").lower() == "true"
+embedding_migrations = EmbeddingMigrations(os.getenv("EMBEDDING_MIGRATION_DB_PATH", "embedding_migrations.sqlite"))
+pending_migrations = set()
+
+async def search_dimensions(user_id: str) -> List[int]:
+    """Embedding dimensions a user's rows may be at; starts their migration if it has not finished"""
+    if not EMBEDDING_PREVIOUS_DIMENSIONS or embedding_migrations.is_done(user_id, EMBEDDING_TAG):
+        return [EMBEDDING_DIMENSIONS]
+    if EMBEDDING_AUTO_MIGRATE:
+        await request_embedding_migration(user_id)
+    return [EMBEDDING_DIMENSIONS] + EMBEDDING_PREVIOUS_DIMENSIONS
+
+async def request_embedding_migration(user_id: str) -> Optional[str]:
+    if user_id in pending_migrations:
+        return None
+    pending_migrations.add(user_id)
+    return await job_queue.enqueue("reembed_memories", {"user_id": user_id, "target": EMBEDDING_TAG}, user_id=user_id)
+
+async def fetch_passage_rows(memory_ids: List[str], page_size: int = 1000) -> List[Dict]:
+    rows = []
+    while True:
+        page = await supabase.table("memory_passages").select(
+            "memory_id, passage_index, start_offset, end_offset, message_start, message_end"
+        ).in_("memory_id", memory_ids).order("id").range(len(rows), len(rows) + page_size - 1).execute()
+        rows.extend(page.data or [])
+        if len(page.data or []) < page_size:
+            return rows
+
+async def reembed_batch(user_id: str, rows: List[Dict]):
+    """Re-embed memories and their stored passages at the current dimension, in one batched call"""
+    contents = {row['id']: row.get('content') or '' for row in rows}
+    passages = await fetch_passage_rows(list(contents))
+    vectors = await get_embeddings(
+        [f"{row.get('summary') or ''}\n{contents[row['id']][:1000]}" for row in rows]
+        + [contents[p['memory_id']][p['start_offset']:p['end_offset']] for p in passages]
+    )
+    
+    semaphore = asyncio.Semaphore(BATCH_SUMMARY_CONCURRENCY)
+    
+    async def update(row: Dict, embedding: List[float]):
+        async with semaphore:
+            # Only if the tag is still the one read: a re-save since then nulled it and queued enrich_memory
+            result = await supabase.table("memories").update({
+                "embedding": embedding,
+                "embedding_model": EMBEDDING_TAG
+            }).eq("id", row['id']).eq("user_id", user_id).eq("embedding_model", row["embedding_model"]).execute()
+        if result.data:
+            await sync_local_index("add", user_id, {**row, "embedding": embedding})
+    
+    await asyncio.gather(*[update(row, embedding) for row, embedding in zip(rows, vectors)])
+    await store_passages([
+        {**p, "user_id": user_id, "embedding": embedding, "embedding_model": EMBEDDING_TAG}
+        for p, embedding in zip(passages, vectors[len(rows):])
+    ], replace=True)
+
+async def reembed_memories(payload: Dict) -> Dict:
+    """Background job: move a user's memories to the current embedding tag, newest first"""
+    user_id = payload["user_id"]
+    target = payload["target"]
+    if target != EMBEDDING_TAG:
+        pending_migrations.discard(user_id)
+        return {"user_id": user_id, "skipped": f"target is now {EMBEDDING_TAG}"}
+    
+    try:
+        progress = await asyncio.to_thread(embedding_migrations.get, user_id, target) or {}
+        if progress.get("status") == "done":
+            return {"user_id": user_id, **progress}
+        cursor = progress.get("cursor")
+        migrated, skipped = progress.get("migrated", 0), progress.get("skipped", 0)
+        
+        while True:
+            query = order_by(
+                supabase.table("memories").select("id, title, summary, topics, created_at, content, embedding_model").eq("user_id", user_id),
+                "created_at.desc", "id.desc"
+            )
+            if cursor:
+                query = keyset_after(query, *cursor)
+            rows = (await query.limit(EMBEDDING_MIGRATION_BATCH).execute()).data or []
+            if not rows:
+                break
+            
+            # A null tag means enrich_memory has not finished; it embeds at the current tag itself
+            stale = [row for row in rows if row.get("embedding_model") not in (None, target)]
+            if stale:
+                await reembed_batch(user_id, stale)
+            migrated += len(stale)
+            skipped += len(rows) - len(stale)
+            cursor = (rows[-1]["created_at"], rows[-1]["id"])
+            await asyncio.to_thread(embedding_migrations.checkpoint, user_id, target, cursor, migrated, skipped)
+            if len(rows) < EMBEDDING_MIGRATION_BATCH:
+                break
+        
+        await asyncio.to_thread(embedding_migrations.finish, user_id, target, migrated, skipped)
+    finally:
+        pending_migrations.discard(user_id)
+    
+    # Clusters were fitted at the old dimension
+    await request_cluster_fit(user_id)
+    logger.info(f"Re-embedded {migrated} memories for user {user_id} as {target} ({skipped} already current)")
+    return {"user_id": user_id, "target": target, "migrated": migrated, "skipped": skipped}
+
+job_queue.register("reembed_memories", reembed_memories)
+
 @app.post("/save_conversation")
-async def save_conversation(conversation: Conversation, request: Request):
+async def save_conversation(conversation: Conversation, request: Request, background: bool = False):
     # Get user ID from header
     user_id = request.headers.get("X-User-ID")
     if not user_id:
@@ -440,81 +1725,134 @@ async def save_conversation(conversation: Conversation, request: Request):
         raise HTTPException(status_code=503, detail="Storage backend not configured")
     
     try:
-        conversation_text = "\n".join([
-            f"{msg.role}: {msg.content}" 
-            for msg in conversation.messages
-        ])
+        conversation_text = conversation_to_text(conversation)
+        passages = conversation_passages(conversation)
+        fingerprint = await asyncio.to_thread(text_fingerprint, conversation_text)
+        match = await match_saved_conversation(user_id, conversation, conversation_text, fingerprint)
+        save_actions[match.action] += 1
+        
+        if match.action == "unchanged":
+            existing = match.existing
+            logger.info(f"Conversation for user {user_id} is already saved as {existing['id']} ({match.action})")
+            return {
+                "status": "success",
+                "action": match.action,
+                "id": existing['id'],
+                "user_id": user_id,
+                "summary": existing.get("summary"),
+                "message_count": existing.get("message_count"),
+                "topics": existing.get("topics") or []
+            }
+        
+        if background and match.action != "insert":
+            existing, job_id = await defer_enrichment(user_id, match, conversation, conversation_text, fingerprint, passages)
+            logger.info(f"Updated raw conversation {existing['id']} for user {user_id} ({match.action}), enrichment job {job_id}")
+            return {
+                "status": "accepted",
+                "action": match.action,
+                "id": existing['id'],
+                "job_id": job_id,
+                "user_id": user_id,
+                "summary": existing.get("summary"),
+                "message_count": len(conversation.messages),
+                "topics": existing.get("topics") or []
+            }
+        
+        if background:
+            # Persist the raw conversation now; summary, topics and embedding follow from the job queue
+            summary = fallback_summary(conversation)
+            memory_data = build_memory_row(user_id, conversation, conversation_text, summary, [], None, fingerprint)
+            result = await supabase.table("memories").insert(memory_data).execute()
+            
+            if not result.data:
+                raise HTTPException(status_code=500, detail="Failed to save memory")
+            
+            saved_memory = result.data[0]
+            fingerprint_index.add(user_id, saved_memory['id'], fingerprint)
+            job_id = await job_queue.enqueue("enrich_memory", {
+                "user_id": user_id,
+                "memory_id": saved_memory['id'],
+                "conversation_text": conversation_text,
+                "passages": [list(passage) for passage in passages],
+                "fallback_summary": summary
+            }, user_id=user_id)
+            
+            logger.info(f"Saved raw conversation {saved_memory['id']} for user {user_id}, enrichment job {job_id}")
+            
+            return {
+                "status": "accepted",
+                "action": match.action,
+                "id": saved_memory['id'],
+                "job_id": job_id,
+                "user_id": user_id,
+                "summary": summary,
+                "message_count": len(conversation.messages),
+                "topics": []
+            }
         
         summary = ""
         key_topics = []
         embedding = None
+        passage_vectors = []
         
         if client:
             try:
-                response = client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": """Extract:
-                        1. A concise summary of the key information
-                        2. Main topics discussed (comma-separated)
-                        Format: 
-                        Summary: [your summary]
-                        Topics: [topic1, topic2, topic3]"""},
-                        {"role": "user", "content": conversation_text}
-                    ],
-                    max_tokens=300
-                )
-                
-                full_response = response.choices[0].message.content
-                
-                if "Summary:" in full_response and "Topics:" in full_response:
-                    parts = full_response.split("Topics:")
-                    summary = parts[0].replace("Summary:", "").strip()
-                    topics_str = parts[1].strip()
-                    key_topics = [t.strip() for t in topics_str.split(",")]
+                reused = None
+                if match.action == "append":
+                    # Only the messages added since the last save go to the model
+                    summary, key_topics = await summarize_conversation_delta(
+                        match.existing.get("summary"), match.existing.get("topics") or [],
+                        delta_text(conversation, match.appended_from)
+                    )
+                    reused = await reusable_passage_vectors(match.existing["id"], passages)
                 else:
-                    summary = full_response
+                    summary, key_topics = await summarize_conversation(conversation_text)
                 
-                # Generate embedding for semantic search
-                embedding_text = f"{summary}\n{conversation_text[:1000]}"
-                embedding_response = client.embeddings.create(
-                    model="text-embedding-3-small",
-                    input=embedding_text
-                )
-                embedding = embedding_response.data[0].embedding
+                # Generate embeddings for semantic search: the memory and each passage, in one call
+                [(embedding, passage_vectors)] = await embed_memories([(summary, conversation_text, passages, reused)])
                     
             except Exception as e:
                 logger.error(f"OpenAI API error: {e}")
                 summary = f"Error generating summary: {str(e)}"
         
+        if match.action != "insert" and embedding is None:
+            # Keep the earlier summary rather than overwrite it with an error; the job retries
+            existing, job_id = await defer_enrichment(user_id, match, conversation, conversation_text, fingerprint, passages)
+            return {
+                "status": "accepted",
+                "action": match.action,
+                "id": existing['id'],
+                "job_id": job_id,
+                "user_id": user_id,
+                "summary": existing.get("summary"),
+                "message_count": len(conversation.messages),
+                "topics": existing.get("topics") or []
+            }
+        
         if not summary:
-            first_msg = conversation.messages[0].content[:100] if conversation.messages else "Empty conversation"
-            summary = f"Conversation starting with: {first_msg}..."
+            summary = fallback_summary(conversation)
         
         # Prepare data for Supabase
-        memory_data = {
-            "user_id": user_id,
-            "content": conversation_text,
-            "summary": summary,
-            "title": conversation.title or "Untitled Conversation",
-            "topics": key_topics,
-            "url": conversation.url,
-            "message_count": len(conversation.messages),
-            "embedding": embedding
-        }
-        
-        # Save to Supabase
-        result = supabase.table("memories").insert(memory_data).execute()
-        
-        if not result.data:
-            raise HTTPException(status_code=500, detail="Failed to save memory")
+        memory_data = build_memory_row(user_id, conversation, conversation_text, summary, key_topics, embedding, fingerprint)
         
-        saved_memory = result.data[0]
+        if match.action != "insert":
+            saved_memory = await update_saved_memory(user_id, match.existing["id"], memory_data, passages, passage_vectors)
+        else:
+            # Save to Supabase
+            result = await supabase.table("memories").insert(memory_data).execute()
+            
+            if not result.data:
+                raise HTTPException(status_code=500, detail="Failed to save memory")
+            
+            saved_memory = result.data[0]
+            await store_passages(passage_rows(user_id, saved_memory['id'], passages, passage_vectors))
+            await index_saved_memory(user_id, {**saved_memory, "embedding": embedding})
         
-        logger.info(f"Saved conversation {saved_memory['id']} for user {user_id} with topics: {key_topics}")
+        logger.info(f"Saved conversation {saved_memory['id']} for user {user_id} ({match.action}) with topics: {key_topics}")
         
         return {
             "status": "success",
+            "action": match.action,
             "id": saved_memory['id'],
             "user_id": user_id,
             "summary": summary,
@@ -526,6 +1864,168 @@ async def save_conversation(conversation: Conversation, request: Request):
         logger.error(f"Error in save_conversation: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/job_status/{job_id}")
+async def job_status(job_id: str, request: Request):
+    user_id = request.headers.get("X-User-ID")
+    if not user_id:
+        raise HTTPException(status_code=400, detail="User ID required")
+    
+    job = await job_queue.get(job_id)
+    if not job or job["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    return job
+
+@app.post("/migrate_embeddings")
+async def migrate_embeddings(request: Request):
+    """Re-embed the user's memories at the configured model and dimension"""
+    user_id = request.headers.get("X-User-ID")
+    if not user_id:
+        raise HTTPException(status_code=400, detail="User ID required")
+    
+    if not supabase:
+        raise HTTPException(status_code=503, detail="Storage backend not configured")
+    
+    if embedding_migrations.is_done(user_id, EMBEDDING_TAG):
+        return {"status": "done", "target": EMBEDDING_TAG}
+    
+    job_id = await request_embedding_migration(user_id)
+    return {"status": "queued" if job_id else "running", "job_id": job_id, "target": EMBEDDING_TAG}
+
+@app.get("/embedding_migration")
+async def embedding_migration(request: Request):
+    user_id = request.headers.get("X-User-ID")
+    if not user_id:
+        raise HTTPException(status_code=400, detail="User ID required")
+    
+    progress = await asyncio.to_thread(embedding_migrations.get, user_id, EMBEDDING_TAG)
+    done = not EMBEDDING_PREVIOUS_DIMENSIONS or embedding_migrations.is_done(user_id, EMBEDDING_TAG)
+    return {
+        "target": EMBEDDING_TAG,
+        "status": "done" if done else (progress or {}).get("status", "pending"),
+        "migrated": (progress or {}).get("migrated", 0),
+        "skipped": (progress or {}).get("skipped", 0),
+        "search_dimensions": [EMBEDDING_DIMENSIONS] if done else [EMBEDDING_DIMENSIONS] + EMBEDDING_PREVIOUS_DIMENSIONS
+    }
+
+@app.post("/save_conversations_batch")
+async def save_conversations_batch(batch: ConversationBatch, request: Request):
+    """Bulk import: many conversations in one request, with per-item status"""
+    user_id = request.headers.get("X-User-ID")
+    if not user_id:
+        raise HTTPException(status_code=400, detail="User ID required")
+    
+    if not supabase:
+        raise HTTPException(status_code=503, detail="Storage backend not configured")
+    
+    if len(batch.conversations) > BATCH_MAX_CONVERSATIONS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch too large (max {BATCH_MAX_CONVERSATIONS}); use /save_conversations_stream"
+        )
+    if len(batch.conversations) > MAX_CHARGED_CONVERSATIONS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch costs more than the rate limit allows (max {MAX_CHARGED_CONVERSATIONS}); use /save_conversations_stream"
+        )
+    
+    decision = await charge_conversations(user_id, len(batch.conversations))
+    if not decision.allowed:
+        return rate_limited_response(decision)
+    
+    try:
+        statuses = await ingest_conversations(user_id, batch.conversations)
+        saved = sum(1 for item in statuses if item["status"] != "error")
+        logger.info(f"Batch saved {saved}/{len(statuses)} conversations for user {user_id}")
+        return {"status": "success", "saved": saved, "failed": len(statuses) - saved, "items": statuses}
+        
+    except Exception as e:
+        logger.error(f"Error in save_conversations_batch: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def ndjson_lines(upload) -> Iterator[bytes]:
+    """Yield the non-empty lines of a spooled NDJSON upload"""
+    for line in upload:
+        if line.strip():
+            yield line
+
+@app.post("/save_conversations_stream")
+async def save_conversations_stream(request: Request):
+    """Streaming import: NDJSON Conversation objects in, NDJSON per-item statuses out.
+    
+    The upload is spooled first (to disk past STREAM_SPOOL_BYTES): under the
+    http middlewares a streaming response listens on the same receive channel
+    as request.stream() and would swallow body chunks. Lines are then ingested
+    in chunks and each chunk's statuses are written back as soon as it is
+    stored, so memory stays bounded by the chunk size rather than the size of
+    the export. Hitting the rate limit ends the import with a single error line
+    for the first refused index; later lines are never parsed.
+    """
+    user_id = request.headers.get("X-User-ID")
+    if not user_id:
+        raise HTTPException(status_code=400, detail="User ID required")
+    
+    if not supabase:
+        raise HTTPException(status_code=503, detail="Storage backend not configured")
+    
+    upload = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_BYTES)
+    async for chunk in request.stream():
+        upload.write(chunk)
+    upload.seek(0)
+    
+    async def flush(pending: List[Tuple[int, Conversation]]) -> Tuple[List[Dict], bool]:
+        # Each chunk is paid for before it is ingested; a refusal ends the import
+        decision = await charge_conversations(user_id, len(pending))
+        if not decision.allowed:
+            return [{
+                "index": pending[0][0],
+                "status": "error",
+                "error": "Rate limit reached; import stopped at this line",
+                "retry_after": int(rate_limiter.headers(decision)["Retry-After"])
+            }], True
+        statuses = await ingest_conversations(user_id, [c for _, c in pending])
+        for status in statuses:
+            status["index"] = pending[status["index"]][0]
+            if "superseded_by" in status:
+                status["superseded_by"] = pending[status["superseded_by"]][0]
+        pending.clear()
+        return statuses, False
+    
+    async def events() -> AsyncIterator[bytes]:
+        pending: List[Tuple[int, Conversation]] = []
+        index = 0
+        stopped = False
+        try:
+            for line in ndjson_lines(upload):
+                try:
+                    pending.append((index, Conversation(**json.loads(line))))
+                except Exception as e:
+                    yield ndjson_event({"index": index, "status": "error", "error": f"Invalid conversation: {e}"})
+                index += 1
+                
+                if len(pending) >= STREAM_CHUNK_SIZE:
+                    statuses, stopped = await flush(pending)
+                    for status in statuses:
+                        yield ndjson_event(status)
+                    if stopped:
+                        # Leave the rest of the upload unread rather than parse lines that will be refused
+                        break
+            
+            if pending and not stopped:
+                statuses, stopped = await flush(pending)
+                for status in statuses:
+                    yield ndjson_event(status)
+        except Exception as e:
+            logger.error(f"Streamed import failed for user {user_id} at line {index}: {str(e)}")
+            yield ndjson_event({"index": pending[0][0] if pending else index, "status": "error", "error": str(e)})
+            return
+        finally:
+            upload.close()
+        
+        logger.info(f"Streamed import of {index} conversations for user {user_id}")
+    
+    return ndjson_stream(events())
+
 @app.post("/search_memory")
 async def search_memory(query: SearchQuery, request: Request):
     user_id = request.headers.get("X-User-ID")
@@ -537,72 +2037,86 @@ async def search_memory(query: SearchQuery, request: Request):
     
     try:
         logger.info(f"User {user_id} searching for: {query.query}")
+        candidates = max(query.limit, query.limit * HYBRID_CANDIDATES_PER_RESULT)
+        
+        async def vector_candidates() -> Tuple[List[Dict], List[Dict]]:
+            if not client:
+                return [], []
+            embeddings = await query_embeddings(query.query, await search_dimensions(user_id))
+            # Memory-level (Supabase RPC or local index) and passage-level similarity search
+            return await asyncio.gather(
+                vector_search(
+                    user_id,
+                    embeddings,
+                    match_threshold=0.5,  # Lower threshold for better results
+                    match_count=candidates
+                ),
+                passage_search(user_id, embeddings, candidates * SEARCH_PASSAGES_PER_RESULT)
+            )
         
-        memories = []
-        
-        # Try vector search first if OpenAI is available
-        if client:
-            try:
-                # Generate embedding for search query
-                embedding_response = client.embeddings.create(
-                    model="text-embedding-3-small",
-                    input=query.query
-                )
-                query_embedding = embedding_response.data[0].embedding
-                
-                # Perform vector similarity search in Supabase
-                results = supabase.rpc(
-                    'search_memories',
-                    {
-                        'query_embedding': query_embedding,
-                        'match_threshold': 0.5,  # Lower threshold for better results
-                        'match_count': query.limit,
-                        'filter_user_id': user_id
-                    }
-                ).execute()
-                
-                if results.data:
-                    for row in results.data:
-                        memories.append({
-                            "content": row['content'][:300] + "..." if len(row['content']) > 300 else row['content'],
-                            "metadata": {
-                                "summary": row['summary'],
-                                "timestamp": row['created_at'],
-                                "title": row['title'],
-                                "topics": json.dumps(row['topics']) if row['topics'] else "[]"
-                            },
-                            "relevance": round(row['distance'], 2),
-                            "distance": row['distance']
-                        })
-                else:
-                    logger.info("No results from vector search, falling back to text search")
-            except Exception as e:
-                logger.warning(f"Vector search failed, falling back to text search: {e}")
+        # Lexical and vector retrieval run concurrently; either may fail without failing the search
+        vector_results, lexical_hits = await asyncio.gather(
+            vector_candidates(), lexical_search(user_id, query.query, candidates), return_exceptions=True
+        )
+        if isinstance(vector_results, Exception):
+            logger.warning(f"Vector search failed, using lexical results only: {vector_results}")
+            vector_results = ([], [])
+        if isinstance(lexical_hits, Exception):
+            logger.warning(f"Lexical search failed, using vector results only: {lexical_hits}")
+            lexical_hits = []
+        vector_rows, passage_hits = vector_results
+        if not vector_rows and not lexical_hits and not passage_hits:
+            return {"memories": []}
+        
+        rows = {str(row['id']): row for row in vector_rows}
+        lexical_scores = dict(lexical_hits)
+        # Passage hits arrive best first, so each memory's first hit is its best passage
+        passages_by_memory: Dict[str, List[Dict]] = {}
+        for hit in passage_hits:
+            passages_by_memory.setdefault(str(hit['memory_id']), []).append(hit)
+        rankings = {name: ranked for name, ranked in [
+            ("vector", list(rows)),
+            ("lexical", [memory_id for memory_id, _ in lexical_hits]),
+            ("passage", list(passages_by_memory))
+        ] if ranked}
+        fused = reciprocal_rank_fusion(rankings, k=HYBRID_RRF_K)[:query.limit]
+        
+        not_loaded = [memory_id for memory_id, _, _ in fused if memory_id not in rows]
+        if not_loaded:
+            fetched = await fetch_memories(
+                user_id, not_loaded, ["title", "summary", "topics", "created_at", "content"]
+            )
+            rows.update({str(row['id']): row for row in fetched})
         
-        # If vector search didn't work or no results, try text search
-        if not memories:
-            results = supabase.rpc(
-                'text_search_memories',
-                {
-                    'search_query': query.query,
-                    'match_count': query.limit,
-                    'filter_user_id': user_id
+        # Relevance is the fused score relative to ranking first in every list that ran
+        best_possible = len(rankings) / (HYBRID_RRF_K + 1)
+        memories = []
+        for memory_id, score, ranks in fused:
+            row = rows.get(memory_id)
+            if row is None:
+                continue
+            similarity = row.get('distance') if 'vector' in ranks else None
+            content = row.get('content') or ''
+            passages = passages_by_memory.get(memory_id, [])[:SEARCH_PASSAGES_PER_RESULT]
+            memories.append({
+                "content": content[:300] + "..." if len(content) > 300 else content,
+                "metadata": {
+                    "summary": row.get('summary'),
+                    "timestamp": row.get('created_at'),
+                    "title": row.get('title'),
+                    "topics": json.dumps(row['topics']) if row.get('topics') else "[]"
+                },
+                "relevance": round(score / best_possible, 2),
+                "distance": similarity,
+                "passages": [passage_result(hit) for hit in passages],
+                "scores": {
+                    "vector": round(similarity, 4) if similarity is not None else None,
+                    "lexical": round(lexical_scores[memory_id], 4) if lexical_scores.get(memory_id) is not None else None,
+                    "passage": round(float(passages[0]['distance']), 4) if passages else None,
+                    "rrf": round(score, 6),
+                    "ranks": ranks
                 }
-            ).execute()
-            
-            if results.data:
-                for row in results.data:
-                    memories.append({
-                        "content": row['content'][:300] + "..." if len(row['content']) > 300 else row['content'],
-                        "metadata": {
-                            "summary": row['summary'],
-                            "timestamp": row['created_at'],
-                            "title": row['title'],
-                            "topics": json.dumps(row['topics']) if row['topics'] else "[]"
-                        },
-                        "relevance": 0.7,  # Default relevance for text search
-                        "distance": 0.3
-                    })
+            })
         
         logger.info(f"Found {len(memories)} relevant results for user {user_id}")
         return {"memories": memories}
@@ -611,8 +2125,72 @@ async def search_memory(query: SearchQuery, request: Request):
         logger.error(f"Error in search_memory: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Memory listing: projected columns, keyset pagination on (created_at, id)
+MEMORY_LIST_FIELDS = ["id", "title", "summary", "topics", "created_at", "url", "message_count", "content"]
+MEMORY_LIST_DEFAULT_FIELDS = ["id", "summary", "created_at", "title", "topics"]
+MEMORY_PAGE_MAX = 1000
+# Page size when /get_all_memories is called without a limit, so no listing is an unbounded read
+MEMORY_PAGE_DEFAULT = min(int(os.getenv("MEMORY_PAGE_DEFAULT", 100)), MEMORY_PAGE_MAX)
+MEMORY_EXPORT_PAGE_SIZE = 500
+
+def encode_memory_cursor(row: Dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps([row["created_at"], row["id"]]).encode("utf-8")).decode("ascii")
+
+def decode_memory_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        created_at, memory_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return str(created_at), str(memory_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def parse_memory_fields(fields: Optional[str]) -> List[str]:
+    if not fields:
+        return MEMORY_LIST_DEFAULT_FIELDS
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in MEMORY_LIST_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return requested
+
+def memory_list_item(row: Dict, fields: List[str]) -> Dict:
+    item = {}
+    for field in fields:
+        if field == "created_at":
+            item["timestamp"] = row["created_at"]
+        elif field == "topics":
+            item["topics"] = row['topics'] if row.get('topics') else []
+        else:
+            item[field] = row.get(field)
+    return item
+
+def memory_list_query(user_id: str, fields: List[str], topic: Optional[str], since: Optional[str],
+                      until: Optional[str], after: Optional[Tuple[str, str]], limit: Optional[int]):
+    # id and created_at are always selected: they are the sort key and the cursor
+    columns = ",".join(dict.fromkeys(["id", "created_at"] + fields))
+    query = supabase.table("memories").select(columns).eq("user_id", user_id)
+    if topic:
+        query = query.contains("topics", [topic])
+    if since:
+        query = query.gte("created_at", since)
+    if until:
+        query = query.lte("created_at", until)
+    if after:
+        query = keyset_after(query, *after)
+    query = order_by(query, "created_at.desc", "id.desc")
+    if limit:
+        query = query.limit(limit)
+    return query
+
 @app.get("/get_all_memories")
-async def get_all_memories(request: Request):
+async def get_all_memories(request: Request, limit: Optional[int] = None, cursor: Optional[str] = None,
+                           fields: Optional[str] = None, topic: Optional[str] = None,
+                           since: Optional[str] = None, until: Optional[str] = None, stream: bool = False):
+    """List memories newest first, a page at a time.
+
+    Returns up to ``limit`` (default MEMORY_PAGE_DEFAULT) memories plus ``next_cursor``,
+    null on the last page; ``stream=true`` exports every matching memory as NDJSON,
+    fetched page by page.
+    """
     user_id = request.headers.get("X-User-ID")
     if not user_id:
         raise HTTPException(status_code=400, detail="User ID required")
@@ -620,30 +2198,84 @@ async def get_all_memories(request: Request):
     if not supabase:
         raise HTTPException(status_code=503, detail="Storage backend not configured")
     
+    if limit is not None and not 1 <= limit <= MEMORY_PAGE_MAX:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MEMORY_PAGE_MAX}")
+    limit = limit or MEMORY_PAGE_DEFAULT
+    
+    selected_fields = parse_memory_fields(fields)
+    after = decode_memory_cursor(cursor) if cursor else None
+    
+    if stream:
+        async def export_rows():
+            position = after
+            try:
+                while True:
+                    page = await memory_list_query(
+                        user_id, selected_fields, topic, since, until, position, MEMORY_EXPORT_PAGE_SIZE
+                    ).execute()
+                    rows = page.data or []
+                    for row in rows:
+                        yield ndjson_event(memory_list_item(row, selected_fields))
+                    if len(rows) < MEMORY_EXPORT_PAGE_SIZE:
+                        break
+                    position = (rows[-1]["created_at"], rows[-1]["id"])
+            except Exception as e:
+                logger.error(f"Error exporting memories: {str(e)}")
+                yield ndjson_event({"type": "error", "detail": str(e)})
+        
+        return ndjson_stream(export_rows())
+    
     try:
-        # Get all memories for this user
-        results = supabase.table("memories").select("*").eq(
-            "user_id", user_id
-        ).order("created_at", desc=True).execute()
+        # Fetch one extra row to know whether another page exists
+        results = await memory_list_query(
+            user_id, selected_fields, topic, since, until, after, limit + 1
+        ).execute()
         
-        memories = []
-        if results.data:
-            for row in results.data:
-                memories.append({
-                    "id": row['id'],
-                    "summary": row['summary'],
-                    "timestamp": row['created_at'],
-                    "title": row['title'],
-                    "topics": row['topics'] if row['topics'] else []
-                })
+        rows = results.data or []
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_memory_cursor(rows[-1])
+        
+        memories = [memory_list_item(row, selected_fields) for row in rows]
         
         logger.info(f"Retrieved {len(memories)} memories for user {user_id}")
-        return {"memories": memories, "total": len(memories), "user_id": user_id}
+        return {"memories": memories, "total": len(memories), "user_id": user_id, "next_cursor": next_cursor}
         
     except Exception as e:
         logger.error(f"Error in get_all_memories: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/get_memories")
+async def get_memories(request: Request, ids: str, fields: Optional[str] = None):
+    """Multi-get: the listed memories in one request, in the order given"""
+    user_id = request.headers.get("X-User-ID")
+    if not user_id:
+        raise HTTPException(status_code=400, detail="User ID required")
+    
+    if not supabase:
+        raise HTTPException(status_code=503, detail="Storage backend not configured")
+    
+    memory_ids = list(dict.fromkeys(i.strip() for i in ids.split(",") if i.strip()))
+    if not memory_ids or len(memory_ids) > MEMORY_PAGE_MAX:
+        raise HTTPException(status_code=400, detail=f"ids must list between 1 and {MEMORY_PAGE_MAX} memory ids")
+    
+    selected_fields = parse_memory_fields(fields)
+    
+    try:
+        rows = await fetch_memories(user_id, memory_ids, selected_fields)
+        found_ids = {str(row["id"]) for row in rows}
+        
+        return {
+            "memories": [memory_list_item(row, selected_fields) for row in rows],
+            "missing": [memory_id for memory_id in memory_ids if memory_id not in found_ids],
+            "user_id": user_id
+        }
+        
+    except Exception as e:
+        logger.error(f"Error in get_memories: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.delete("/delete_memory/{memory_id}")
 async def delete_memory(memory_id: str, request: Request):
     user_id = request.headers.get("X-User-ID")
@@ -655,7 +2287,7 @@ async def delete_memory(memory_id: str, request: Request):
     
     try:
         # Verify the memory belongs to this user
-        existing = supabase.table("memories").select("id").eq(
+        existing = await supabase.table("memories").select("id").eq(
             "id", memory_id
         ).eq("user_id", user_id).execute()
         
@@ -663,7 +2295,12 @@ async def delete_memory(memory_id: str, request: Request):
             raise HTTPException(status_code=404, detail="Memory not found")
         
         # Delete the memory
-        supabase.table("memories").delete().eq("id", memory_id).execute()
+        await supabase.table("memories").delete().eq("id", memory_id).execute()
+        await sync_local_index("remove", user_id, memory_id)
+        lexical_index.remove(user_id, memory_id)
+        fingerprint_index.remove(user_id, memory_id)
+        await asyncio.to_thread(cluster_store.remove, user_id, memory_id)
+        memory_rows.invalidate(user_id, memory_id)
         
         logger.info(f"Deleted memory {memory_id} for user {user_id}")
         return {"status": "success", "deleted_id": memory_id}
@@ -682,7 +2319,7 @@ async def update_memory(memory_id: str, update: MemoryUpdate, request: Request):
     
     try:
         # Verify the memory belongs to this user
-        existing = supabase.table("memories").select("*").eq(
+        existing = await supabase.table("memories").select("id").eq(
             "id", memory_id
         ).eq("user_id", user_id).execute()
         
@@ -695,9 +2332,12 @@ async def update_memory(memory_id: str, update: MemoryUpdate, request: Request):
             "title": update.title
         }
         
-        result = supabase.table("memories").update(update_data).eq(
+        result = await supabase.table("memories").update(update_data).eq(
             "id", memory_id
         ).execute()
+        await sync_local_index("update", user_id, memory_id, update_data)
+        lexical_index.update(user_id, memory_id, update_data)
+        memory_rows.invalidate(user_id, memory_id)
         
         logger.info(f"Updated memory {memory_id} for user {user_id}")
         return {"status": "success", "updated_id": memory_id}
@@ -724,8 +2364,12 @@ async def analyze_prompt(request: PromptAnalysisRequest):
                 "context": "general"
             }
         
+        cached = response_cache.get("analyze_prompt", prompt_text)
+        if cached is not None:
+            return cached
+        
         # Use GPT-4o-mini for fast, cost-effective analysis
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {
@@ -783,6 +2427,8 @@ Focus on prompt engineering best practices:
             }
             
             logger.info(f"Analyzed prompt: score={analysis_result['score']}, context={analysis_result['context']}")
+            response_cache.put("analyze_prompt", prompt_text, analysis_result)
+            analysis_result["cache"] = {"hit": False}
             return analysis_result
             
         except json.JSONDecodeError:
@@ -807,21 +2453,46 @@ Focus on prompt engineering best practices:
             "analysis": "Using fallback analysis due to API issues"
         }
 
-@app.post("/improve_prompt")
-async def improve_prompt(request: PromptImprovementRequest):
-    if not client:
-        raise HTTPException(status_code=503, detail="OpenAI not configured")
+# Streaming helpers: NDJSON events, metadata first, then tokens as OpenAI produces them
+def ndjson_event(event: Dict) -> bytes:
+    return (json.dumps(event, default=str) + "\n").encode("utf-8")
+
+def ndjson_stream(events: AsyncIterator[bytes]) -> StreamingResponse:
+    # X-Accel-Buffering stops nginx-style proxies from holding chunks back
+    return StreamingResponse(
+        events,
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def stream_completion(metadata: Dict, completion_kwargs: Optional[Dict],
+                            finalize: Callable[[str], Dict], fallback_text: str = "") -> AsyncIterator[bytes]:
+    """Emit a metadata event, one delta event per token chunk, then a done event.
+
+    ``finalize`` turns the full generated text into the done event's payload.
+    Without ``completion_kwargs`` the ``fallback_text`` is sent as a single delta.
+    """
+    yield ndjson_event({"type": "metadata", **metadata})
     
+    parts = []
     try:
-        original_prompt = request.prompt.strip()
-        analysis = request.analysis
-        
-        # Create context-aware system prompt
-        context = analysis.get('context', 'general')
-        score = analysis.get('score', 0)
-        suggestions = analysis.get('suggestions', [])
+        if completion_kwargs is None:
+            parts.append(fallback_text)
+            yield ndjson_event({"type": "delta", "content": fallback_text})
+        else:
+            stream = await client.chat.completions.create(stream=True, **completion_kwargs)
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield ndjson_event({"type": "delta", "content": chunk.choices[0].delta.content})
         
-        system_prompt = f"""You are an expert prompt engineering coach. Your task is to rewrite the user's prompt to make it significantly more effective for ChatGPT.
+        yield ndjson_event({"type": "done", **finalize("".join(parts))})
+    except Exception as e:
+        logger.error(f"Error while streaming completion: {str(e)}")
+        yield ndjson_event({"type": "error", "detail": str(e)})
+
+def improve_prompt_messages(original_prompt: str, context: str, score, suggestions: List[str]) -> List[Dict]:
+    system_prompt = f"""You are an expert prompt engineering coach. Your task is to rewrite the user's prompt to make it significantly more effective for ChatGPT.
 
 Original prompt context: {context}
 Current quality score: {score}/10
@@ -843,39 +2514,89 @@ IMPORTANT:
 
 Return ONLY the improved prompt text, no explanations or meta-commentary."""
 
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": system_prompt
-                },
-                {
-                    "role": "user",
-                    "content": f"Original prompt: '{original_prompt}'"
-                }
-            ],
-            max_tokens=400,
-            temperature=0.4
-        )
+    return [
+        {
+            "role": "system",
+            "content": system_prompt
+        },
+        {
+            "role": "user",
+            "content": f"Original prompt: '{original_prompt}'"
+        }
+    ]
+
+def clean_improved_prompt(improved_prompt: str) -> str:
+    improved_prompt = improved_prompt.strip()
+    
+    # Remove quotes if the AI wrapped the response
+    if improved_prompt.startswith('"') and improved_prompt.endswith('"'):
+        improved_prompt = improved_prompt[1:-1]
+    if improved_prompt.startswith("'") and improved_prompt.endswith("'"):
+        improved_prompt = improved_prompt[1:-1]
+    return improved_prompt
+
+@app.post("/improve_prompt")
+async def improve_prompt(request: PromptImprovementRequest, stream: bool = False):
+    if not client:
+        raise HTTPException(status_code=503, detail="OpenAI not configured")
+    
+    try:
+        original_prompt = request.prompt.strip()
+        analysis = request.analysis
         
-        improved_prompt = response.choices[0].message.content.strip()
+        # Create context-aware system prompt
+        context = analysis.get('context', 'general')
+        score = analysis.get('score', 0)
+        suggestions = analysis.get('suggestions', [])
         
-        # Remove quotes if the AI wrapped the response
-        if improved_prompt.startswith('"') and improved_prompt.endswith('"'):
-            improved_prompt = improved_prompt[1:-1]
-        if improved_prompt.startswith("'") and improved_prompt.endswith("'"):
-            improved_prompt = improved_prompt[1:-1]
+        # The rewrite depends on the analysis too, so it is part of the cache namespace
+        cache_namespace = "improve_prompt:" + json.dumps([context, score, suggestions], sort_keys=True, default=str)
+        # Exact tier only: a near-duplicate prompt ("Do not use pandas." vs "Use pandas.") needs its own rewrite
+        cached = response_cache.get(cache_namespace, original_prompt, near_duplicates=False)
         
-        logger.info(f"Generated improved prompt (length: {len(improved_prompt)})")
+        def build_result(improved_prompt: str) -> Dict:
+            return {
+                "improved_prompt": improved_prompt,
+                "original_length": len(original_prompt),
+                "improved_length": len(improved_prompt),
+                "context": context
+            }
         
-        return {
-            "improved_prompt": improved_prompt,
-            "original_length": len(original_prompt),
-            "improved_length": len(improved_prompt),
-            "context": context
+        completion_kwargs = {
+            "model": "gpt-4o-mini",
+            "messages": improve_prompt_messages(original_prompt, context, score, suggestions),
+            "max_tokens": 400,
+            "temperature": 0.4
         }
         
+        if stream:
+            if cached is not None:
+                return ndjson_stream(stream_completion(
+                    {"context": context, "cache": cached["cache"]}, None,
+                    lambda text: cached, fallback_text=cached["improved_prompt"]
+                ))
+            
+            def finalize(text: str) -> Dict:
+                result = build_result(clean_improved_prompt(text))
+                response_cache.put(cache_namespace, original_prompt, result)
+                return {**result, "cache": {"hit": False}}
+            
+            return ndjson_stream(stream_completion({"context": context, "cache": {"hit": False}}, completion_kwargs, finalize))
+        
+        if cached is not None:
+            return cached
+
+        response = await client.chat.completions.create(**completion_kwargs)
+        
+        improved_prompt = clean_improved_prompt(response.choices[0].message.content)
+        
+        logger.info(f"Generated improved prompt (length: {len(improved_prompt)})")
+        
+        result = build_result(improved_prompt)
+        response_cache.put(cache_namespace, original_prompt, result)
+        result["cache"] = {"hit": False}
+        return result
+        
     except Exception as e:
         logger.error(f"Error in prompt improvement: {str(e)}")
         return {
@@ -888,23 +2609,39 @@ Return ONLY the improved prompt text, no explanations or meta-commentary."""
 
 # Keep all existing Phase 2 endpoints unchanged
 @app.post("/analyze_conversation_turn")
-async def analyze_conversation_turn(request: ConversationAnalysisRequest):
+async def analyze_conversation_turn(request: ConversationAnalysisRequest, http_request: Request):
     """Analyze a single conversation turn for quality and flow"""
     if not client:
         raise HTTPException(status_code=503, detail="OpenAI not configured")
     
+    current_turn = [
+        {"role": "user", "content": request.user_message},
+        {"role": "assistant", "content": request.assistant_message}
+    ]
+    state = resolve_conversation_state(
+        "turn",
+        http_request.headers.get("X-User-ID"),
+        request.conversation_id,
+        request.conversation_history + current_turn,
+        cursor=request.cursor,
+        new_messages=request.conversation_history + current_turn
+    )
+    
     try:
         # Combine user message and assistant response for analysis
         conversation_text = f"User: {request.user_message}\nAssistant: {request.assistant_message}"
         
         # Add conversation history for context
         context_text = ""
-        if request.conversation_history:
+        if state is not None:
+            recent_history = list(state.recent_messages)[-8:-2]  # Last 3 turns before this one
+        else:
             recent_history = request.conversation_history[-6:]  # Last 3 turns
+        if recent_history:
             context_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in recent_history])
         
         # Analyze conversation quality with OpenAI
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {
@@ -953,10 +2690,10 @@ Remember: Frame all suggestions as actions the USER should take, not what the AI
             result = json.loads(ai_analysis)
             
             # Add local analysis
-            local_analysis = analyze_conversation_coherence(request.conversation_history + [
-                {"role": "user", "content": request.user_message},
-                {"role": "assistant", "content": request.assistant_message}
-            ])
+            if state is not None:
+                local_analysis = state.coherence()
+            else:
+                local_analysis = analyze_conversation_coherence(request.conversation_history + current_turn)
             
             # Combine AI and local analysis
             final_result = {
@@ -969,6 +2706,8 @@ Remember: Frame all suggestions as actions the USER should take, not what the AI
                 "local_issues": local_analysis["issues"],
                 "depth_info": local_analysis["conversation_depth"]
             }
+            if state is not None:
+                final_result["cursor"] = state.message_count
             
             logger.info(f"Conversation turn analyzed: flow_score={final_result['flow_score']}")
             return final_result
@@ -1014,7 +2753,7 @@ async def suggest_followup(request: FollowUpRequest):
             context = context_analysis[0] if context_analysis else "general"
         
         # Generate follow-up with OpenAI
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {
@@ -1145,6 +2884,40 @@ async def analyze_conversation_quality(request: ConversationQualityRequest):
 
 # NEW CONTEXT BRIDGE ENDPOINTS - Add these here:
 
+# Model context windows and tokenizer encodings; longest prefix wins so dated variants match their family
+CONTEXT_LIMITS = {
+    "gpt-3.5-turbo": (16385, "cl100k_base"),
+    "gpt-3.5-turbo-0613": (4096, "cl100k_base"),
+    "gpt-4": (8192, "cl100k_base"),
+    "gpt-4-32k": (32768, "cl100k_base"),
+    "gpt-4-turbo": (128000, "cl100k_base"),
+    "gpt-4-1106": (128000, "cl100k_base"),
+    "gpt-4-0125": (128000, "cl100k_base"),
+    "gpt-4o": (128000, "o200k_base"),
+    "gpt-4o-mini": (128000, "o200k_base"),
+    "gpt-4.1": (1047576, "o200k_base"),
+    "gpt-4.5": (128000, "o200k_base"),
+    "gpt-5": (400000, "o200k_base"),
+    "o1": (200000, "o200k_base"),
+    "o1-mini": (128000, "o200k_base"),
+    "o3": (200000, "o200k_base"),
+    "o3-mini": (200000, "o200k_base"),
+    "o4-mini": (200000, "o200k_base")
+}
+# Unknown models are treated like gpt-4
+DEFAULT_CONTEXT_LIMIT = (8192, "cl100k_base")
+
+def context_entry(model: str) -> Tuple[int, str]:
+    model = (model or "").lower()
+    matches = [name for name in CONTEXT_LIMITS if model == name or model.startswith(name + "-")]
+    return CONTEXT_LIMITS[max(matches, key=len)] if matches else DEFAULT_CONTEXT_LIMIT
+
+def context_limit_for(model: str) -> int:
+    return context_entry(model)[0]
+
+def model_encoding(model: str) -> str:
+    return context_entry(model)[1]
+
 @app.post("/analyze_context_usage")
 async def analyze_context_usage(request: Request):
     """Analyze how close the user is to context limits"""
@@ -1153,23 +2926,31 @@ async def analyze_context_usage(request: Request):
         current_conversation = data.get("conversation", [])
         model = data.get("model", "gpt-4")  # Get model from request
         
-        # Estimate token count (rough approximation)
-        total_text = " ".join([msg.get("content", "") for msg in current_conversation])
-        estimated_tokens = len(total_text) / 4  # Rough estimate: 1 token ≈ 4 chars
+        encoding = model_encoding(model)
+        
+        # With a conversation_id only messages not seen before are counted;
+        # "cursor" + "new_messages" sends just those instead of the full history
+        state = resolve_conversation_state(
+            "context_usage",
+            request.headers.get("X-User-ID"),
+            data.get("conversation_id"),
+            current_conversation,
+            cursor=data.get("cursor"),
+            new_messages=data.get("new_messages"),
+            encoding=encoding
+        )
         
-        # ChatGPT context windows (approximate)
-        context_limits = {
-            "gpt-4": 8192,
-            "gpt-3.5-turbo": 4096,
-            "gpt-4-32k": 32768,
-            "gpt-4-turbo": 128000  # Add GPT-4 Turbo
-        }
+        # Count tokens with the model's encoding (memoized per message, so only new messages are encoded)
+        if state is not None:
+            estimated_tokens = token_counter.with_overhead(state.content_tokens, state.message_count)
+        else:
+            estimated_tokens = token_counter.count_messages(current_conversation, encoding)
         
         # Use detected model or default to GPT-4
-        limit = context_limits.get(model, 8192)
+        limit = context_limit_for(model)
         usage_percentage = (estimated_tokens / limit) * 100
         
-        return {
+        result = {
             "estimated_tokens": int(estimated_tokens),
             "context_limit": limit,
             "usage_percentage": round(usage_percentage, 1),
@@ -1178,13 +2959,125 @@ async def analyze_context_usage(request: Request):
             "recommendation": "Consider using Context Bridge to continue this conversation" if usage_percentage > 70 else "Context usage is healthy",
             "detected_model": model  # Include detected model in response
         }
+        if state is not None:
+            result["cursor"] = state.message_count
+        return result
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error analyzing context usage: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
         
+# Bridge retrieval: approximate top-N, rerank (similarity, recency, topic overlap), then MMR
+BRIDGE_CANDIDATES = int(os.getenv("BRIDGE_CANDIDATES", 30))
+BRIDGE_MIN_SIMILARITY = float(os.getenv("BRIDGE_MIN_SIMILARITY", 0.6))
+BRIDGE_MAX_MEMORIES = int(os.getenv("BRIDGE_MAX_MEMORIES", 5))
+BRIDGE_RERANK_WEIGHTS = {
+    "similarity_weight": float(os.getenv("BRIDGE_SIMILARITY_WEIGHT", 0.7)),
+    "recency_weight": float(os.getenv("BRIDGE_RECENCY_WEIGHT", 0.15)),
+    "topic_weight": float(os.getenv("BRIDGE_TOPIC_WEIGHT", 0.15)),
+    "half_life_days": float(os.getenv("BRIDGE_RECENCY_HALF_LIFE_DAYS", 30))
+}
+BRIDGE_MMR_DIVERSITY = float(os.getenv("BRIDGE_MMR_DIVERSITY", 0.3))
+BRIDGE_REDUNDANCY_THRESHOLD = float(os.getenv("BRIDGE_REDUNDANCY_THRESHOLD", 0.92))
+BRIDGE_CONTEXT_MODE = os.getenv("BRIDGE_CONTEXT_MODE", "summarize")
+BRIDGE_PASSAGE_CANDIDATES = int(os.getenv("BRIDGE_PASSAGE_CANDIDATES", 50))
+BRIDGE_PASSAGES_PER_MEMORY = int(os.getenv("BRIDGE_PASSAGES_PER_MEMORY", 2))
+
+async def select_bridge_memories(user_id: str, candidates: List[Dict], current_topics: List[str]) -> List[Dict]:
+    """Stages 2 and 3: rerank the vector candidates, then pick a diverse few with MMR"""
+    ranked = rerank(candidates, current_topics, **BRIDGE_RERANK_WEIGHTS)
+    pool = ranked[:BRIDGE_MAX_MEMORIES * 3]
+    if len(pool) <= 1:
+        return pool
+    
+    vectors = None
+    try:
+        vectors = await memory_vectors(user_id, [mem['id'] for mem in pool])
+    except Exception as e:
+        logger.warning(f"Embeddings unavailable for MMR, using topic overlap instead: {e}")
+    return mmr_select(
+        pool,
+        BRIDGE_MAX_MEMORIES,
+        vectors,
+        diversity=BRIDGE_MMR_DIVERSITY,
+        redundancy_threshold=BRIDGE_REDUNDANCY_THRESHOLD
+    )
+
+def bridge_completion_kwargs(request: ContextBridgeRequest, current_topics: List[str],
+                             relevant_memories: List[Dict]) -> Optional[Dict]:
+    """Chat completion arguments for the bridge summary, or None when nothing was retrieved"""
+    if not relevant_memories:
+        return None
+    
+    memory_summaries = "\n".join([
+        f"- {mem['title']}: {mem['summary']}"
+        for mem in relevant_memories
+    ])
+    
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {
+                "role": "system",
+                "content": f"""You are an expert at creating concise context bridges for conversations.
+                        
+Given previous conversation summaries, create a brief context injection that:
+1. Highlights only the most relevant information
+2. Uses bullet points for clarity
+3. Preserves key decisions, code snippets, or conclusions
+4. Stays under {request.max_context_tokens} tokens
+5. Starts with "📌 Continuing from previous conversations:"
+
+Focus on information that would be helpful for continuing the current discussion."""
+            },
+            {
+                "role": "user",
+                "content": f"Current topics: {', '.join(set(current_topics))}\n\nPrevious conversations:\n{memory_summaries}"
+            }
+        ],
+        "max_tokens": request.max_context_tokens // 2
+    }
+
+def bridge_passages(relevant_memories: List[Dict], passage_hits: List[Dict], max_tokens: int) -> Dict[str, List[Dict]]:
+    """Best passages of the selected memories within the token budget, in conversation order"""
+    selected = {str(mem['id']) for mem in relevant_memories}
+    chosen: Dict[str, List[Dict]] = {}
+    budget = max_tokens
+    for hit in passage_hits:
+        memory_id = str(hit['memory_id'])
+        if memory_id not in selected or len(chosen.get(memory_id, [])) >= BRIDGE_PASSAGES_PER_MEMORY:
+            continue
+        tokens = token_counter.count(hit.get('content') or '')
+        if tokens > budget:
+            continue
+        budget -= tokens
+        chosen.setdefault(memory_id, []).append(hit)
+    return {memory_id: sorted(hits, key=lambda hit: hit['passage_index']) for memory_id, hits in chosen.items()}
+
+def passage_injection(relevant_memories: List[Dict], chosen: Dict[str, List[Dict]]) -> str:
+    sections = [
+        f"From \"{mem['title']}\":\n" + "\n...\n".join(hit['content'] for hit in chosen[str(mem['id'])])
+        for mem in relevant_memories if str(mem['id']) in chosen
+    ]
+    return "📌 Continuing from previous conversations:\n\n" + "\n\n".join(sections)
+
+def bridge_metrics(relevant_memories: List[Dict], current_topics: List[str], context_injection: str) -> Dict:
+    original_tokens = sum(token_counter.count(mem.get('content', '')) for mem in relevant_memories)
+    compressed_tokens = token_counter.count(context_injection)
+    compression_ratio = (1 - compressed_tokens / original_tokens) * 100 if original_tokens > 0 else 0
+    
+    return {
+        "memories_found": len(relevant_memories),
+        "original_tokens": int(original_tokens),
+        "compressed_tokens": int(compressed_tokens),
+        "compression_ratio": round(compression_ratio, 1),
+        "topics_covered": list(set(current_topics))
+    }
+
 @app.post("/intelligent_context_bridge")
-async def intelligent_context_bridge(request: ContextBridgeRequest, req: Request):
+async def intelligent_context_bridge(request: ContextBridgeRequest, req: Request, stream: bool = False):
     """Generate intelligent context bridge with relevant memories"""
     user_id = req.headers.get("X-User-ID")
     if not user_id:
@@ -1193,6 +3086,10 @@ async def intelligent_context_bridge(request: ContextBridgeRequest, req: Request
     if not client or not supabase:
         raise HTTPException(status_code=503, detail="Services not configured")
     
+    context_mode = request.context_mode or BRIDGE_CONTEXT_MODE
+    if context_mode not in ("summarize", "passages"):
+        raise HTTPException(status_code=400, detail="context_mode must be 'summarize' or 'passages'")
+    
     try:
         # Step 1: Extract key topics from current conversation
         current_topics = []
@@ -1204,27 +3101,48 @@ async def intelligent_context_bridge(request: ContextBridgeRequest, req: Request
         # Step 2: Search for relevant memories
         search_query = request.search_query or " ".join(set(current_topics))
         
+        candidates = []
         relevant_memories = []
+        passage_hits = []
         if search_query:
-            # Use existing search_memory logic
-            embedding_response = client.embeddings.create(
-                model="text-embedding-3-small",
-                input=search_query
-            )
-            query_embedding = embedding_response.data[0].embedding
+            # Stage 1: approximate vector top-N (plus the closest passages when injecting them)
+            embeddings = await query_embeddings(search_query, await search_dimensions(user_id))
             
-            results = supabase.rpc(
-                'search_memories',
-                {
-                    'query_embedding': query_embedding,
-                    'match_threshold': 0.6,
-                    'match_count': 10,
-                    'filter_user_id': user_id
-                }
-            ).execute()
-            
-            if results.data:
-                relevant_memories = results.data
+            memory_search = vector_search(
+                user_id,
+                embeddings,
+                match_threshold=BRIDGE_MIN_SIMILARITY,
+                match_count=BRIDGE_CANDIDATES
+            )
+            if context_mode == "passages":
+                candidates, passage_hits = await asyncio.gather(
+                    memory_search,
+                    passage_search(user_id, embeddings, BRIDGE_PASSAGE_CANDIDATES, BRIDGE_MIN_SIMILARITY)
+                )
+                # Memories matched only by a passage deep in the conversation join the candidates
+                best_passage: Dict[str, float] = {}
+                for hit in passage_hits:
+                    best_passage.setdefault(str(hit['memory_id']), float(hit['distance']))
+                found = {str(mem['id']) for mem in candidates}
+                passage_only = [memory_id for memory_id in best_passage if memory_id not in found]
+                if passage_only:
+                    rows = await fetch_memories(
+                        user_id, passage_only, ["title", "summary", "topics", "created_at", "content"]
+                    )
+                    candidates += [{**row, "distance": best_passage[str(row['id'])]} for row in rows]
+            else:
+                candidates = await memory_search
+            # Follow-up compress/get_memories calls on these rows can skip the database
+            memory_rows.put_many(user_id, [
+                {key: value for key, value in mem.items() if key != "distance"} for mem in candidates
+            ])
+            relevant_memories = await select_bridge_memories(user_id, candidates, current_topics)
+        
+        # Passages mode injects the matching excerpts verbatim instead of asking the LLM to compress
+        chosen_passages = bridge_passages(relevant_memories, passage_hits, request.max_context_tokens)
+        if context_mode == "passages" and not chosen_passages and relevant_memories:
+            logger.info(f"No passages matched for user {user_id}, summarizing the selected memories instead")
+            context_mode = "summarize"
         
         # Step 3: Build knowledge connections
         connections = []
@@ -1241,59 +3159,26 @@ async def intelligent_context_bridge(request: ContextBridgeRequest, req: Request
                         "strength": overlap
                     })
         
-        # Step 4: Generate smart summary using GPT
-        if relevant_memories:
-            memory_summaries = "\n".join([
-                f"- {mem['title']}: {mem['summary']}"
-                for mem in relevant_memories[:5]
-            ])
-            
-            compression_response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": f"""You are an expert at creating concise context bridges for conversations.
-                        
-Given previous conversation summaries, create a brief context injection that:
-1. Highlights only the most relevant information
-2. Uses bullet points for clarity
-3. Preserves key decisions, code snippets, or conclusions
-4. Stays under {request.max_context_tokens} tokens
-5. Starts with "📌 Continuing from previous conversations:"
-
-Focus on information that would be helpful for continuing the current discussion."""
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Current topics: {', '.join(set(current_topics))}\n\nPrevious conversations:\n{memory_summaries}"
-                    }
-                ],
-                max_tokens=request.max_context_tokens // 2
-            )
-            
-            context_injection = compression_response.choices[0].message.content
-        else:
-            context_injection = "No relevant previous conversations found."
-        
-        # Step 5: Calculate metrics
-        original_tokens = sum(len(mem.get('content', '')) / 4 for mem in relevant_memories)
-        compressed_tokens = len(context_injection) / 4
-        compression_ratio = (1 - compressed_tokens / original_tokens) * 100 if original_tokens > 0 else 0
-        
-        return {
-            "context_injection": context_injection,
+        retrieval = {
             "relevant_memories": [
                 {
                     "id": mem['id'],
                     "title": mem['title'],
                     "summary": mem['summary'],
-                    "relevance_score": round(1 - mem.get('distance', 0.5), 2),
+                    "relevance_score": round(mem['scores']['total'], 2),
+                    "scores": mem['scores'],
                     "topics": mem.get('topics', []),
-                    "created_at": mem['created_at']
+                    "created_at": mem['created_at'],
+                    "passages": [passage_result(hit) for hit in chosen_passages.get(str(mem['id']), [])]
                 }
-                for mem in relevant_memories[:5]
+                for mem in relevant_memories
             ],
+            "retrieval": {
+                "candidates": len(candidates),
+                "selected": len(relevant_memories),
+                "context_mode": context_mode,
+                "passage_candidates": len(passage_hits)
+            },
             "knowledge_graph": {
                 "nodes": [
                     {
@@ -1305,20 +3190,76 @@ Focus on information that would be helpful for continuing the current discussion
                     for mem in relevant_memories
                 ],
                 "connections": connections
-            },
-            "metrics": {
-                "memories_found": len(relevant_memories),
-                "original_tokens": int(original_tokens),
-                "compressed_tokens": int(compressed_tokens),
-                "compression_ratio": round(compression_ratio, 1),
-                "topics_covered": list(set(current_topics))
             }
         }
         
+        # Step 4: Generate smart summary using GPT, or assemble the chosen passages
+        injection_text = "No relevant previous conversations found."
+        if context_mode == "passages":
+            completion_kwargs = None
+            if chosen_passages:
+                injection_text = passage_injection(relevant_memories, chosen_passages)
+        else:
+            completion_kwargs = bridge_completion_kwargs(request, current_topics, relevant_memories)
+        
+        if stream:
+            # Retrieval results go out before generation starts
+            return ndjson_stream(stream_completion(
+                retrieval,
+                completion_kwargs,
+                lambda text: {
+                    "context_injection": text,
+                    "metrics": bridge_metrics(relevant_memories, current_topics, text)
+                },
+                fallback_text=injection_text
+            ))
+        
+        if completion_kwargs is not None:
+            compression_response = await client.chat.completions.create(**completion_kwargs)
+            context_injection = compression_response.choices[0].message.content
+        else:
+            context_injection = injection_text
+        
+        # Step 5: Calculate metrics
+        return {
+            "context_injection": context_injection,
+            **retrieval,
+            "metrics": bridge_metrics(relevant_memories, current_topics, context_injection)
+        }
+        
     except Exception as e:
         logger.error(f"Error in intelligent context bridge: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Knowledge graphs, cached per user until their memory set changes
+KNOWLEDGE_GRAPH_MAX_NODES = int(os.getenv("KNOWLEDGE_GRAPH_MAX_NODES", 5000))
+knowledge_graphs = KnowledgeGraphCache(
+    max_vector_bytes=int(os.getenv("KNOWLEDGE_GRAPH_VECTOR_CACHE_BYTES", 64 * 1024 * 1024))
+)
+
+async def memory_vectors(user_id: str, memory_ids: List[str]) -> Dict[str, np.ndarray]:
+    """Embeddings for similarity edges: from the local index when enabled, else Supabase"""
+    if vector_index:
+        try:
+            await ensure_local_index(user_id)
+            return await asyncio.to_thread(vector_index.vectors_for, user_id, memory_ids)
+        except Exception as e:
+            logger.warning(f"Local index vectors unavailable, fetching from Supabase: {e}")
+    
+    chunks = [memory_ids[i:i + MEMORY_FETCH_CHUNK] for i in range(0, len(memory_ids), MEMORY_FETCH_CHUNK)]
+    results = await asyncio.gather(*[
+        supabase.table("memories").select("id,embedding").in_("id", chunk).eq("user_id", user_id).execute()
+        for chunk in chunks
+    ])
+    vectors = {}
+    for result in results:
+        for row in result.data or []:
+            vector = parse_embedding(row.get("embedding"))
+            # Rows not yet re-embedded are left out; callers fall back to topic overlap for them
+            if vector is not None and len(vector) == EMBEDDING_DIMENSIONS:
+                vectors[row["id"]] = vector
+    return vectors
+
 @app.post("/generate_knowledge_graph")
 async def generate_knowledge_graph(request: KnowledgeGraphRequest, req: Request):
     """Generate a knowledge graph of all user's conversations"""
@@ -1326,10 +3267,16 @@ async def generate_knowledge_graph(request: KnowledgeGraphRequest, req: Request)
     if not user_id:
         raise HTTPException(status_code=400, detail="User ID required")
     
+    if not 1 <= request.max_nodes <= KNOWLEDGE_GRAPH_MAX_NODES:
+        raise HTTPException(status_code=400, detail=f"max_nodes must be between 1 and {KNOWLEDGE_GRAPH_MAX_NODES}")
+    
     try:
         # Get recent memories
         cutoff_date = (datetime.now() - timedelta(days=request.time_range_days)).isoformat()
-        results = supabase.table("memories").select("*").eq(
+        # No content: node sizes come from content_length and the cache signature from updated_at
+        results = await supabase.table("memories").select(
+            "id,title,summary,topics,created_at,updated_at,message_count,content_length"
+        ).eq(
             "user_id", user_id
         ).gte("created_at", cutoff_date).order(
             "created_at", desc=True
@@ -1340,71 +3287,47 @@ async def generate_knowledge_graph(request: KnowledgeGraphRequest, req: Request)
         
         memories = results.data
         
-        # Build topic-based graph
-        topic_graph = defaultdict(list)
-        nodes = []
-        edges = []
-        
-        for mem in memories:
-            nodes.append({
-                "id": mem['id'],
-                "label": mem['title'][:30] + "..." if len(mem['title']) > 30 else mem['title'],
-                "title": mem['title'],
-                "summary": mem['summary'][:100] + "...",
-                "topics": mem.get('topics', []),
-                "created_at": mem['created_at'],
-                "size": min(50, 10 + len(mem.get('content', '')) / 100)  # Node size based on content
-            })
-            
-            # Group by topics for clustering
-            for topic in mem.get('topics', ['general']):
-                topic_graph[topic].append(mem['id'])
-        
-        # Create edges based on shared topics
-        processed_pairs = set()
-        for topic, memory_ids in topic_graph.items():
-            for i, id1 in enumerate(memory_ids):
-                for id2 in memory_ids[i+1:]:
-                    pair = tuple(sorted([id1, id2]))
-                    if pair not in processed_pairs:
-                        processed_pairs.add(pair)
-                        edges.append({
-                            "source": id1,
-                            "target": id2,
-                            "weight": 1,
-                            "topic": topic
-                        })
-        
-        # Identify clusters
-        clusters = [
-            {
-                "id": topic,
-                "name": topic.capitalize(),
-                "nodes": memory_ids,
-                "color": f"hsl({hash(topic) % 360}, 70%, 50%)"
-            }
-            for topic, memory_ids in topic_graph.items()
-            if len(memory_ids) > 1
-        ]
-        
-        return {
-            "nodes": nodes,
-            "edges": edges,
-            "clusters": clusters,
-            "stats": {
-                "total_memories": len(memories),
-                "total_topics": len(topic_graph),
-                "most_common_topic": max(topic_graph.items(), key=lambda x: len(x[1]))[0] if topic_graph else None,
-                "connections": len(edges)
-            }
-        }
+        # Persisted embedding clusters replace per-topic clusters once the user has been fitted
+        if await asyncio.to_thread(cluster_store.has_user, user_id):
+            clusters = await asyncio.to_thread(cluster_store.clusters, user_id, [mem['id'] for mem in memories])
+        else:
+            clusters = None
+        if await asyncio.to_thread(cluster_store.needs_refit, user_id):
+            await request_cluster_fit(user_id)
+        
+        params = request.dict(exclude={"time_range_days"})
+        signature = memory_set_signature(memories, params)
+        cached = knowledge_graphs.get(user_id, signature)
+        if cached is not None:
+            return {**cached, "clusters": clusters or cached["clusters"], "cache": {"hit": True}}
+        
+        vectors = None
+        if request.similarity_edges:
+            vectors = knowledge_graphs.reusable_vectors(user_id, memories)
+            missing = [mem['id'] for mem in memories if mem['id'] not in vectors]
+            if missing:
+                vectors.update(await memory_vectors(user_id, missing))
+        
+        graph = await asyncio.to_thread(
+            build_graph,
+            memories,
+            vectors,
+            topic_top_k=request.topic_top_k,
+            similarity_top_k=request.similarity_top_k,
+            similarity_threshold=request.similarity_threshold
+        )
+        updated = {mem['id']: mem.get('updated_at') for mem in memories}
+        knowledge_graphs.put(user_id, signature, graph, {
+            memory_id: (updated[memory_id], vector) for memory_id, vector in vectors.items()
+        } if vectors is not None else None)
+        return {**graph, "clusters": clusters or graph["clusters"], "cache": {"hit": False}}
         
     except Exception as e:
         logger.error(f"Error generating knowledge graph: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/compress_context")
-async def compress_context(request: ContextInjectionRequest, req: Request):
+async def compress_context(request: ContextInjectionRequest, req: Request, stream: bool = False):
     """Compress multiple memories into optimal context injection"""
     user_id = req.headers.get("X-User-ID")
     if not user_id:
@@ -1414,15 +3337,8 @@ async def compress_context(request: ContextInjectionRequest, req: Request):
         raise HTTPException(status_code=503, detail="Services not configured")
     
     try:
-        # Fetch selected memories
-        memories = []
-        for memory_id in request.memory_ids:
-            result = supabase.table("memories").select("*").eq(
-                "id", memory_id
-            ).eq("user_id", user_id).execute()
-            
-            if result.data:
-                memories.append(result.data[0])
+        # Fetch selected memories in one batched lookup
+        memories = await fetch_memories(user_id, request.memory_ids, ["title", "summary", "topics"])
         
         if not memories:
             raise HTTPException(status_code=404, detail="No memories found")
@@ -1434,9 +3350,9 @@ async def compress_context(request: ContextInjectionRequest, req: Request):
         ])
         
         # Use GPT to create optimal compression
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
+        completion_kwargs = {
+            "model": "gpt-4o-mini",
+            "messages": [
                 {
                     "role": "system",
                     "content": f"""You are an expert at compressing conversation context while preserving critical information.
@@ -1455,15 +3371,28 @@ Format the output to be directly pasteable into a ChatGPT conversation."""
                     "content": f"Current context: {request.current_context}\n\nPrevious conversations to compress:\n{memory_context}"
                 }
             ],
-            max_tokens=request.target_tokens
-        )
+            "max_tokens": request.target_tokens
+        }
+        
+        if stream:
+            return ndjson_stream(stream_completion(
+                {"original_memories": len(memories)},
+                completion_kwargs,
+                lambda text: {
+                    "compressed_context": text,
+                    "estimated_tokens": token_counter.count(text),
+                    "compression_successful": True
+                }
+            ))
+        
+        response = await client.chat.completions.create(**completion_kwargs)
         
         compressed_context = response.choices[0].message.content
         
         return {
             "compressed_context": compressed_context,
             "original_memories": len(memories),
-            "estimated_tokens": len(compressed_context) / 4,
+            "estimated_tokens": token_counter.count(compressed_context),
             "compression_successful": True
         }
         
@@ -0,0 +1,79 @@
+"""Short-lived per-user cache of memory rows.
+
+The context bridge retrieves memories, and the user often compresses or
+opens those same memories right after. Rows are cached per user for a short
+TTL, so those follow-up reads skip the database. Writes to a memory
+invalidate its cached row.
+
+A cached row only serves a lookup that needs columns the row actually has.
+Rows from the search RPC, for example, have no ``url``.
+"""
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+import time
+
+
+class MemoryRowCache:
+    """LRU of users, each holding ``memory_id -> (row, cached_at)``"""
+
+    def __init__(self, ttl_seconds: float = 120, max_users: int = 2000, max_rows_per_user: int = 500):
+        self.ttl_seconds = ttl_seconds
+        self.max_users = max_users
+        self.max_rows_per_user = max_rows_per_user
+        self._users: "OrderedDict[str, OrderedDict[str, Tuple[Dict, float]]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get_many(self, user_id: str, memory_ids: Iterable[str],
+                 columns: Iterable[str]) -> Tuple[Dict[str, Dict], List[str]]:
+        """Return (cached rows by id, ids that still need fetching)"""
+        required = set(columns)
+        rows = self._users.get(user_id)
+        if rows is not None:
+            self._users.move_to_end(user_id)
+        now = time.time()
+
+        found, missing = {}, []
+        for memory_id in memory_ids:
+            entry = rows.get(memory_id) if rows is not None else None
+            if entry is not None and now - entry[1] <= self.ttl_seconds and required.issubset(entry[0]):
+                found[memory_id] = entry[0]
+                rows.move_to_end(memory_id)
+            else:
+                missing.append(memory_id)
+
+        self.stats["hits"] += len(found)
+        self.stats["misses"] += len(missing)
+        return found, missing
+
+    def put_many(self, user_id: str, rows: Iterable[Dict]):
+        user_rows = self._users.get(user_id)
+        if user_rows is None:
+            user_rows = self._users[user_id] = OrderedDict()
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        self._users.move_to_end(user_id)
+
+        now = time.time()
+        for row in rows:
+            existing = user_rows.pop(str(row["id"]), None)
+            # Keep columns a wider earlier fetch had, unless that entry has expired
+            if existing is not None and now - existing[1] <= self.ttl_seconds:
+                row = {**existing[0], **row}
+            user_rows[str(row["id"])] = (dict(row), now)
+        while len(user_rows) > self.max_rows_per_user:
+            user_rows.popitem(last=False)
+
+    def invalidate(self, user_id: str, memory_id: Optional[str] = None):
+        if memory_id is None:
+            self._users.pop(user_id, None)
+        elif user_id in self._users:
+            self._users[user_id].pop(str(memory_id), None)
+
+    def snapshot(self) -> Dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "users": len(self._users),
+            "rows": sum(len(rows) for rows in self._users.values()),
+            "hit_ratio": round(self.stats["hits"] / lookups, 3) if lookups else 0.0
+        }
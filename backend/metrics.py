@@ -0,0 +1,301 @@
+"""Prometheus-format metrics and per-request Server-Timing.
+
+``Metrics`` is a small registry of counters, gauges and histograms with
+labels. ``render()`` writes them in the Prometheus text exposition format
+(version 0.0.4), along with values that collectors read from the existing
+``snapshot()`` methods at scrape time. Cache hit ratios, pool in-flight
+counts and job queue depth therefore need no extra bookkeeping on the hot
+path.
+
+Every request gets a ``RequestTimings`` through a context variable. Upstream
+calls made on its behalf (the HTTP transport reports each OpenAI and Supabase
+request) and named local phases add to it. The middleware turns it into a
+``Server-Timing`` header, e.g.
+``openai.embeddings;dur=84.1;desc="1 call", supabase.rpc.search_memories;dur=31.0;desc="1 call", total;dur=190.3``.
+A call coalesced onto another request's identical call (singleflight.py) is
+timed in the request that made it. Time spent streaming a response body
+happens after the headers are sent and is not in the header.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import math
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# (metric name, type, help, [(labels, value)]) as produced by a collector
+Family = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...], lock: threading.Lock):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._lock = lock
+        self._values: Dict[Tuple[str, ...], Any] = {}
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def lines(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    lines = Counter.lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...], lock: threading.Lock,
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames, lock)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def lines(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in sorted(self._values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': _format_value(bound)})} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Metrics:
+    """Registry of labelled metrics plus scrape-time collectors"""
+
+    def __init__(self, namespace: str = ""):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], Iterable[Family]]] = []
+
+    def _name(self, name: str) -> str:
+        return f"{self.namespace}_{name}" if self.namespace else name
+
+    def counter(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(self._name(name), help_text, labelnames, self._lock)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        metric = Gauge(self._name(name), help_text, labelnames, self._lock)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(self._name(name), help_text, labelnames, self._lock, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, collect: Callable[[], Iterable[Family]]):
+        """Register a function returning metric families read at scrape time"""
+        self._collectors.append(collect)
+        return collect
+
+    def render(self) -> str:
+        out = []
+        with self._lock:
+            for metric in self._metrics:
+                out.append(f"# HELP {metric.name} {metric.help}")
+                out.append(f"# TYPE {metric.name} {metric.kind}")
+                out.extend(metric.lines())
+        for collect in self._collectors:
+            for name, kind, help_text, samples in collect():
+                name = self._name(name)
+                out.append(f"# HELP {name} {help_text}")
+                out.append(f"# TYPE {name} {kind}")
+                out.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for labels, value in samples)
+        return "\n".join(out) + "\n"
+
+
+class RequestTimings:
+    """Durations recorded while serving one request, keyed by Server-Timing metric name"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.entries: Dict[str, List[float]] = {}
+
+    def add(self, name: str, seconds: float):
+        self.entries.setdefault(name, []).append(seconds)
+
+    def header(self) -> str:
+        parts = [
+            f'{name};dur={sum(durations) * 1000:.1f};desc="{len(durations)} call{"s" if len(durations) != 1 else ""}"'
+            for name, durations in self.entries.items()
+        ]
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_request_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+def start_request_timings() -> RequestTimings:
+    timings = RequestTimings()
+    _request_timings.set(timings)
+    return timings
+
+
+def record_timing(name: str, seconds: float):
+    """Add to the current request's Server-Timing; a no-op outside a request (e.g. in background jobs)"""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextmanager
+def timed_phase(name: str, histogram: Optional[Histogram] = None):
+    """Time a block into the current request's Server-Timing and, if given, a histogram labelled phase=name"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        record_timing(name, seconds)
+        if histogram is not None:
+            histogram.observe(seconds, phase=name)
+
+
+def upstream_operation(method: str, path: str) -> str:
+    """Low-cardinality name for an upstream HTTP call: "embeddings", "rpc.search_memories", "select.memories"..."""
+    parts = [part for part in path.split("/") if part and part not in ("v1", "rest")]
+    if not parts:
+        return method.lower()
+    if parts[0] == "rpc" and len(parts) > 1:
+        return f"rpc.{parts[1]}"
+    if path.startswith("/rest/"):
+        verb = {"GET": "select", "POST": "insert", "PATCH": "update", "DELETE": "delete"}.get(method, method.lower())
+        return f"{verb}.{parts[0]}"
+    return "_".join(parts)
+
+
+class _Resource:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class _CountedStream:
+    """Async iterator over a streamed completion that records token usage once it is exhausted"""
+
+    def __init__(self, stream, on_done: Callable[[int], None]):
+        self._stream = stream
+        self._on_done = on_done
+
+    async def __aiter__(self):
+        chunks = 0
+        try:
+            async for chunk in self._stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    chunks += 1
+                yield chunk
+        finally:
+            self._on_done(chunks)
+
+
+class MeteredOpenAI:
+    """AsyncOpenAI wrapper counting token usage per model and endpoint; everything else passes through
+
+    Streamed completions carry no usage in this API version. Their prompt is
+    counted with ``count_prompt`` and their completion as one token per
+    content chunk.
+    """
+
+    def __init__(self, client, tokens: Counter, count_prompt: Optional[Callable[[List[Dict], str], int]] = None):
+        self._client = client
+        self._tokens = tokens
+        self._count_prompt = count_prompt
+        self.chat = _Resource(completions=_Resource(create=self._chat_create))
+        self.embeddings = _Resource(create=self._embeddings_create)
+
+    def _record(self, model: str, endpoint: str, prompt: int, completion: int = 0):
+        self._tokens.inc(prompt, model=model, endpoint=endpoint, type="prompt")
+        if completion:
+            self._tokens.inc(completion, model=model, endpoint=endpoint, type="completion")
+
+    async def _chat_create(self, **kwargs):
+        response = await self._client.chat.completions.create(**kwargs)
+        model = kwargs.get("model", "")
+        if kwargs.get("stream"):
+            prompt = self._count_prompt(kwargs.get("messages") or [], model) if self._count_prompt else 0
+            return _CountedStream(response, lambda chunks: self._record(model, "chat_completions", prompt, chunks))
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self._record(model, "chat_completions", usage.prompt_tokens or 0, usage.completion_tokens or 0)
+        return response
+
+    async def _embeddings_create(self, **kwargs):
+        response = await self._client.embeddings.create(**kwargs)
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self._record(kwargs.get("model", ""), "embeddings", usage.prompt_tokens or 0)
+        return response
+
+    def __getattr__(self, name: str):
+        return getattr(self._client, name)
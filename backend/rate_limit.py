@@ -0,0 +1,230 @@
+"""Rate limiting with per-route costs and pluggable shared state.
+
+Each user key holds a small fixed-size state: ``[tokens, updated_at]`` for the
+token bucket, or ``[window_start, current, previous]`` for the sliding window.
+Every entry expires once it would be back at full allowance, so memory tracks
+active users only.
+
+Backends apply a state update atomically:
+
+* ``MemoryBackend``: one process, a dict swept for expired keys.
+* ``SQLiteBackend``: a WAL-mode file shared by every worker on the host.
+* ``RedisBackend``: any Redis-compatible server, via WATCH/MULTI. Needs the
+  optional ``redis`` package.
+"""
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
+import json
+import math
+import sqlite3
+import threading
+import time
+
+State = List[float]
+Updater = Callable[[Optional[State]], Tuple[State, "Decision"]]
+
+
+class Decision:
+    __slots__ = ("allowed", "remaining", "retry_after")
+
+    def __init__(self, allowed: bool, remaining: float, retry_after: float):
+        self.allowed = allowed
+        self.remaining = remaining
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """``capacity`` tokens refilled continuously over ``window_seconds``"""
+
+    def __init__(self, capacity: float, window_seconds: float):
+        self.capacity = capacity
+        self.rate = capacity / window_seconds
+        self.ttl = window_seconds
+
+    def updater(self, cost: float, now: float) -> Updater:
+        def update(state: Optional[State]) -> Tuple[State, Decision]:
+            tokens, updated_at = state if state else (self.capacity, now)
+            tokens = min(self.capacity, tokens + (now - updated_at) * self.rate)
+            if tokens >= cost:
+                tokens -= cost
+                return [tokens, now], Decision(True, tokens, 0.0)
+            return [tokens, now], Decision(False, tokens, (cost - tokens) / self.rate)
+        return update
+
+
+class SlidingWindow:
+    """At most ``capacity`` cost units in any trailing ``window_seconds`` (two-bucket estimate)"""
+
+    def __init__(self, capacity: float, window_seconds: float):
+        self.capacity = capacity
+        self.window = window_seconds
+        self.ttl = 2 * window_seconds
+
+    def updater(self, cost: float, now: float) -> Updater:
+        def update(state: Optional[State]) -> Tuple[State, Decision]:
+            window_start, current, previous = state if state else (now, 0.0, 0.0)
+            elapsed_windows = int((now - window_start) // self.window)
+            if elapsed_windows >= 1:
+                previous = current if elapsed_windows == 1 else 0.0
+                current = 0.0
+                window_start += elapsed_windows * self.window
+
+            weight = 1 - (now - window_start) / self.window
+            used = previous * weight + current
+            if used + cost <= self.capacity:
+                current += cost
+                return [window_start, current, previous], Decision(True, self.capacity - used - cost, 0.0)
+
+            # Time until the previous window's share decays enough, or the window rolls over
+            until_rollover = window_start + self.window - now
+            if previous > 0:
+                retry_after = min((used + cost - self.capacity) * self.window / previous, until_rollover)
+            else:
+                retry_after = until_rollover
+            return [window_start, current, previous], Decision(False, max(0.0, self.capacity - used), retry_after)
+        return update
+
+
+class MemoryBackend:
+    """Per-process state; expired keys are swept instead of clearing everyone's quota"""
+
+    def __init__(self, sweep_every: int = 1000):
+        self._states: Dict[str, Tuple[State, float]] = {}
+        self._sweep_every = sweep_every
+        self._calls = 0
+
+    async def apply(self, key: str, update: Updater, ttl: float) -> Decision:
+        now = time.time()
+        entry = self._states.get(key)
+        state = entry[0] if entry and entry[1] > now else None
+        new_state, decision = update(state)
+        self._states[key] = (new_state, now + ttl)
+
+        self._calls += 1
+        if self._calls % self._sweep_every == 0:
+            self._states = {k: v for k, v in self._states.items() if v[1] > now}
+        return decision
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+
+class SQLiteBackend:
+    """State shared across processes through one WAL-mode SQLite file"""
+
+    def __init__(self, db_path: str, sweep_every: int = 1000):
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, state TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+        self._sweep_every = sweep_every
+        self._calls = 0
+
+    async def apply(self, key: str, update: Updater, ttl: float) -> Decision:
+        return await asyncio.to_thread(self._apply, key, update, ttl)
+
+    def _apply(self, key: str, update: Updater, ttl: float) -> Decision:
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock up front so other processes serialize here
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT state, expires_at FROM rate_limits WHERE key = ?", (key,)
+                ).fetchone()
+                state = json.loads(row[0]) if row and row[1] > now else None
+                new_state, decision = update(state)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO rate_limits (key, state, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(new_state), now + ttl),
+                )
+                self._calls += 1
+                if self._calls % self._sweep_every == 0:
+                    self._db.execute("DELETE FROM rate_limits WHERE expires_at <= ?", (now,))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return decision
+
+
+class RedisBackend:
+    """State in a Redis-compatible server, updated with optimistic WATCH/MULTI transactions"""
+
+    def __init__(self, url: str, prefix: str = "ratelimit:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis requires the 'redis' package") from e
+        self._redis = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    async def apply(self, key: str, update: Updater, ttl: float) -> Decision:
+        return await asyncio.to_thread(self._apply, self._prefix + key, update, ttl)
+
+    def _apply(self, key: str, update: Updater, ttl: float) -> Decision:
+        result = {}
+
+        def transaction(pipe):
+            raw = pipe.get(key)
+            new_state, result["decision"] = update(json.loads(raw) if raw else None)
+            pipe.multi()
+            pipe.set(key, json.dumps(new_state), px=int(ttl * 1000))
+
+        self._redis.transaction(transaction, key)
+        return result["decision"]
+
+
+class RateLimiter:
+    """Charges per-route costs against a per-user allowance"""
+
+    def __init__(self, algorithm, backend, route_costs: Optional[Dict[str, float]] = None,
+                 default_cost: float = 1.0):
+        self.algorithm = algorithm
+        self.backend = backend
+        self.route_costs = route_costs or {}
+        self.default_cost = default_cost
+
+    def cost(self, path: str) -> float:
+        # Costs are keyed by the route's first segment so /delete_memory/{id} matches /delete_memory
+        return self.route_costs.get("/" + path.strip("/").split("/")[0], self.default_cost)
+
+    async def check(self, user_id: str, path: str) -> Decision:
+        return await self.charge(user_id, self.cost(path))
+
+    async def charge(self, user_id: str, cost: float) -> Decision:
+        """Debit ``cost`` units directly, for work whose size is only known inside the route"""
+        if cost <= 0:
+            return Decision(True, self.algorithm.capacity, 0.0)
+        return await self.backend.apply(user_id, self.algorithm.updater(cost, time.time()), self.algorithm.ttl)
+
+    def headers(self, decision: Decision) -> Dict[str, str]:
+        headers = {
+            "X-RateLimit-Limit": str(int(self.algorithm.capacity)),
+            "X-RateLimit-Remaining": str(max(0, int(decision.remaining)))
+        }
+        if not decision.allowed:
+            headers["Retry-After"] = str(max(1, math.ceil(decision.retry_after)))
+        return headers
+
+
+def create_rate_limiter(algorithm: str, backend: str, capacity: float, window_seconds: float,
+                        route_costs: Dict[str, float], sqlite_path: str = "rate_limits.sqlite",
+                        redis_url: Optional[str] = None) -> RateLimiter:
+    algorithms = {"token_bucket": TokenBucket, "sliding_window": SlidingWindow}
+    if algorithm not in algorithms:
+        raise ValueError(f"Unknown rate limit algorithm: {algorithm}")
+
+    if backend == "memory":
+        state_backend = MemoryBackend()
+    elif backend == "sqlite":
+        state_backend = SQLiteBackend(sqlite_path)
+    elif backend == "redis":
+        state_backend = RedisBackend(redis_url or "redis://localhost:6379/0")
+    else:
+        raise ValueError(f"Unknown rate limit backend: {backend}")
+
+    return RateLimiter(algorithms[algorithm](capacity, window_seconds), state_backend, route_costs)
@@ -0,0 +1,114 @@
+"""Second and third retrieval stages for the context bridge.
+
+Stage one is the approximate vector top-N (search_memories RPC or the local
+index). Each candidate is then rescored by a weighted sum of three signals:
+
+* its cosine similarity to the query,
+* a recency decay on ``created_at`` with a configurable half-life,
+* the fraction of the current conversation's topics the memory shares.
+
+Last, maximal marginal relevance (Carbonell & Goldstein 1998) picks the
+final few. Each pick trades reranked score against similarity to memories
+already picked. A candidate nearly identical to one already picked is
+dropped outright, so the LLM never summarizes the same conversation twice.
+"""
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+import math
+
+import numpy as np
+
+
+def age_days(created_at: Optional[str], now: datetime) -> Optional[float]:
+    if not created_at:
+        return None
+    try:
+        created = datetime.fromisoformat(str(created_at).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=timezone.utc)
+    return max(0.0, (now - created).total_seconds() / 86400)
+
+
+def topic_keys(topics: Optional[Iterable[str]]) -> set:
+    return {t.strip().casefold() for t in (topics or []) if t and t.strip()}
+
+
+def rerank(candidates: List[Dict[str, Any]], current_topics: Iterable[str],
+           similarity_weight: float = 0.7, recency_weight: float = 0.15, topic_weight: float = 0.15,
+           half_life_days: float = 30.0, now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """Candidates (rows with ``distance`` = cosine similarity) sorted by combined score.
+
+    Each returned row gains a ``scores`` dict with the three signals and the total.
+    """
+    now = now or datetime.now(timezone.utc)
+    wanted = topic_keys(current_topics)
+    scored = []
+    for row in candidates:
+        similarity = float(row.get("distance") or 0.0)
+        age = age_days(row.get("created_at"), now)
+        recency = math.pow(0.5, age / half_life_days) if age is not None and half_life_days > 0 else 0.0
+        overlap = len(topic_keys(row.get("topics")) & wanted) / len(wanted) if wanted else 0.0
+        total = similarity_weight * similarity + recency_weight * recency + topic_weight * overlap
+        scored.append({
+            **row,
+            "scores": {
+                "similarity": round(similarity, 4),
+                "recency": round(recency, 4),
+                "topic_overlap": round(overlap, 4),
+                "total": round(total, 4)
+            }
+        })
+    scored.sort(key=lambda row: row["scores"]["total"], reverse=True)
+    return scored
+
+
+def _pairwise_similarity(rows: List[Dict[str, Any]], vectors: Optional[Dict[str, np.ndarray]]) -> np.ndarray:
+    """Cosine between candidate embeddings; topic Jaccard for any candidate without one"""
+    n = len(rows)
+    similarity = np.zeros((n, n), dtype=np.float32)
+    ids = [str(row["id"]) for row in rows]
+    have = [i for i in range(n) if vectors and ids[i] in vectors]
+    if have:
+        matrix = np.stack([vectors[ids[i]] for i in have]).astype(np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        similarity[np.ix_(have, have)] = matrix @ matrix.T
+
+    missing = set(range(n)) - set(have)
+    topics = [topic_keys(row.get("topics")) for row in rows]
+    for i in range(n):
+        for j in range(n):
+            if i in missing or j in missing:
+                union = topics[i] | topics[j]
+                similarity[i, j] = len(topics[i] & topics[j]) / len(union) if union else 0.0
+    return similarity
+
+
+def mmr_select(ranked: List[Dict[str, Any]], k: int, vectors: Optional[Dict[str, np.ndarray]] = None,
+               diversity: float = 0.3, redundancy_threshold: float = 0.92) -> List[Dict[str, Any]]:
+    """Up to k rows from ``rerank`` output, trading score against similarity to rows already picked"""
+    if k <= 0 or not ranked:
+        return []
+    similarity = _pairwise_similarity(ranked, vectors)
+    relevance = np.array([row["scores"]["total"] for row in ranked], dtype=np.float32)
+
+    selected: List[int] = []
+    remaining = list(range(len(ranked)))
+    while remaining and len(selected) < k:
+        if selected:
+            closest = similarity[np.ix_(remaining, selected)].max(axis=1)
+        else:
+            closest = np.zeros(len(remaining), dtype=np.float32)
+        # Near-duplicates of a picked memory are dropped, not just demoted
+        keep = closest < redundancy_threshold
+        remaining = [i for i, kept in zip(remaining, keep) if kept]
+        if not remaining:
+            break
+        closest = closest[keep]
+        marginal = (1 - diversity) * relevance[remaining] - diversity * closest
+        best = remaining[int(np.argmax(marginal))]
+        selected.append(best)
+        remaining.remove(best)
+    return [ranked[i] for i in selected]
@@ -0,0 +1,160 @@
+"""Response cache for prompt analysis endpoints.
+
+The extension re-sends the prompt as the user types, so consecutive requests
+often differ only by whitespace, case or trailing ".,;:". Those are folded;
+punctuation inside tokens ("C++", "C#", "a.b") and a closing "?" or "!" are
+kept, since they change what is being asked. Lookups try an exact tier
+keyed by the normalized text, then a near-duplicate tier that compares
+character shingles through an inverted index. Entries expire after a TTL.
+
+The near-duplicate tier suits analysis, where a similar prompt gets a similar
+score. It does not suit rewrites: "Use pandas." and "Do not use pandas." are
+near-duplicates whose rewrites must differ. Callers pass
+``near_duplicates=False`` for those.
+"""
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, Optional, Set, Tuple
+import copy
+import hashlib
+import re
+import time
+
+_TRAILING_PUNCTUATION_RE = re.compile(r"[\s.,;:]+$")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_prompt(text: str) -> str:
+    text = _WHITESPACE_RE.sub(" ", text.casefold()).strip()
+    return _TRAILING_PUNCTUATION_RE.sub("", text)
+
+
+def shingles(text: str, size: int = 3) -> Set[str]:
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class _Entry:
+    __slots__ = ("namespace", "value", "shingles", "created_at")
+
+    def __init__(self, namespace: str, value: Dict, shingle_set: Set[str]):
+        self.namespace = namespace
+        self.value = value
+        self.shingles = shingle_set
+        self.created_at = time.time()
+
+
+class ResponseCache:
+    """Exact + near-duplicate cache with TTL and LRU eviction"""
+
+    def __init__(self, ttl_seconds: float = 3600, max_entries: int = 5000,
+                 similarity_threshold: float = 0.9, shingle_size: int = 3):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.shingle_size = shingle_size
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._postings: Dict[Tuple[str, str], Set[str]] = defaultdict(set)
+        self.stats = {"exact_hits": 0, "near_hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+
+    def _key(self, namespace: str, normalized: str) -> str:
+        return hashlib.sha256(f"{namespace}\x00{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, namespace: str, text: str, near_duplicates: bool = True) -> Optional[Dict[str, Any]]:
+        """Return a cached response with a ``cache`` provenance block, or None"""
+        normalized = normalize_prompt(text)
+        key = self._key(namespace, normalized)
+
+        entry = self._live_entry(key)
+        if entry is not None:
+            self.stats["exact_hits"] += 1
+            return self._hit(entry, "exact", 1.0)
+
+        if near_duplicates and self.similarity_threshold < 1.0:
+            match = self._nearest(namespace, shingles(normalized, self.shingle_size))
+            if match is not None:
+                entry, similarity = match
+                self.stats["near_hits"] += 1
+                return self._hit(entry, "near_duplicate", similarity)
+
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, namespace: str, text: str, value: Dict[str, Any]):
+        normalized = normalize_prompt(text)
+        key = self._key(namespace, normalized)
+        if key in self._entries:
+            self._drop(key)
+
+        entry = _Entry(namespace, copy.deepcopy(value), shingles(normalized, self.shingle_size))
+        self._entries[key] = entry
+        for shingle in entry.shingles:
+            self._postings[(namespace, shingle)].add(key)
+
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+            self.stats["evictions"] += 1
+
+    def _live_entry(self, key: str) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry.created_at > self.ttl_seconds:
+            self._drop(key)
+            self.stats["expired"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _nearest(self, namespace: str, query: Set[str]) -> Optional[Tuple[_Entry, float]]:
+        if not query:
+            return None
+
+        overlaps: Dict[str, int] = defaultdict(int)
+        for shingle in query:
+            for key in self._postings.get((namespace, shingle), ()):
+                overlaps[key] += 1
+
+        candidates = []
+        for key, overlap in overlaps.items():
+            union = len(query) + len(self._entries[key].shingles) - overlap
+            similarity = overlap / union if union else 0.0
+            if similarity >= self.similarity_threshold:
+                candidates.append((similarity, key))
+
+        # Most similar first; an expired entry is dropped and the next live one considered
+        for similarity, key in sorted(candidates, reverse=True):
+            entry = self._live_entry(key)
+            if entry is not None:
+                return entry, similarity
+        return None
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key)
+        for shingle in entry.shingles:
+            posting = self._postings.get((entry.namespace, shingle))
+            if posting is not None:
+                posting.discard(key)
+                if not posting:
+                    del self._postings[(entry.namespace, shingle)]
+
+    def _hit(self, entry: _Entry, tier: str, similarity: float) -> Dict[str, Any]:
+        response = copy.deepcopy(entry.value)
+        response["cache"] = {
+            "hit": True,
+            "tier": tier,
+            "similarity": round(similarity, 3),
+            "age_seconds": round(time.time() - entry.created_at, 1)
+        }
+        return response
+
+    def snapshot(self) -> Dict:
+        lookups = self.stats["exact_hits"] + self.stats["near_hits"] + self.stats["misses"]
+        hits = self.stats["exact_hits"] + self.stats["near_hits"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+            "ttl_seconds": self.ttl_seconds,
+            "similarity_threshold": self.similarity_threshold
+        }
@@ -0,0 +1,123 @@
+-- Embeddings at more than one dimension (EMBEDDING_DIMENSIONS in backend/main.py).
+-- Rows are tagged "<model>@<dimensions>". While a user's memories are re-embedded
+-- (POST /migrate_embeddings) both dimensions live in the same column, and search
+-- queries each one separately, so the columns become untyped and every index is
+-- a partial expression index for one dimension.
+
+alter table memories add column if not exists embedding_model text;
+alter table memory_passages add column if not exists embedding_model text;
+
+update memories set embedding_model = 'text-embedding-3-small@1536'
+    where embedding_model is null and embedding is not null;
+update memory_passages set embedding_model = 'text-embedding-3-small@1536'
+    where embedding_model is null and embedding is not null;
+
+-- An ANN index on the typed column (memory_passages_embedding, and whatever ivfflat/hnsw
+-- index the memories table was set up with) cannot survive the type change: drop them
+-- first. The per-dimension partial indexes below are left alone on a re-run.
+drop index if exists memory_passages_embedding;
+do $$
+declare
+    idx record;
+begin
+    for idx in
+        select schemaname, indexname from pg_indexes
+        where tablename in ('memories', 'memory_passages')
+          and indexdef ~* 'using (ivfflat|hnsw)'
+          and indexname !~ '_embedding_[0-9]+$'
+    loop
+        execute format('drop index if exists %I.%I', idx.schemaname, idx.indexname);
+    end loop;
+end;
+$$;
+
+alter table memories alter column embedding type vector;
+alter table memory_passages alter column embedding type vector;
+
+-- One pair per dimension in use; add another pair before switching to a new size
+create index if not exists memories_embedding_1536 on memories
+    using hnsw ((embedding::vector(1536)) vector_cosine_ops) where vector_dims(embedding) = 1536;
+create index if not exists memories_embedding_512 on memories
+    using hnsw ((embedding::vector(512)) vector_cosine_ops) where vector_dims(embedding) = 512;
+create index if not exists memory_passages_embedding_1536 on memory_passages
+    using hnsw ((embedding::vector(1536)) vector_cosine_ops) where vector_dims(embedding) = 1536;
+create index if not exists memory_passages_embedding_512 on memory_passages
+    using hnsw ((embedding::vector(512)) vector_cosine_ops) where vector_dims(embedding) = 512;
+
+-- Both functions now take a query of any dimension and only compare rows of the same one
+drop function if exists search_memories(vector, float, int, text);
+drop function if exists search_memory_passages(vector, float, int, text);
+
+create or replace function search_memories(
+    query_embedding vector,
+    match_threshold float,
+    match_count int,
+    filter_user_id text
+)
+returns table (
+    id uuid,
+    title text,
+    summary text,
+    topics text[],
+    created_at timestamptz,
+    content text,
+    distance float
+)
+language plpgsql stable
+as $$
+declare
+    dims int := vector_dims(query_embedding);
+begin
+    -- The cast matches the partial index expression, so the planner can use that dimension's hnsw index
+    return query execute format(
+        'select m.id, m.title, m.summary, m.topics, m.created_at, m.content,
+                (1 - (m.embedding::vector(%1$s) <=> $1::vector(%1$s)))::float as distance
+         from memories m
+         where m.user_id = $3
+           and vector_dims(m.embedding) = %1$s
+           and 1 - (m.embedding::vector(%1$s) <=> $1::vector(%1$s)) > $2
+         order by m.embedding::vector(%1$s) <=> $1::vector(%1$s)
+         limit $4', dims
+    ) using query_embedding, match_threshold, filter_user_id, match_count;
+end;
+$$;
+
+create or replace function search_memory_passages(
+    query_embedding vector,
+    match_threshold float,
+    match_count int,
+    filter_user_id text
+)
+returns table (
+    id uuid,
+    memory_id uuid,
+    passage_index integer,
+    start_offset integer,
+    end_offset integer,
+    message_start integer,
+    message_end integer,
+    title text,
+    created_at timestamptz,
+    content text,
+    distance float
+)
+language plpgsql stable
+as $$
+declare
+    dims int := vector_dims(query_embedding);
+begin
+    return query execute format(
+        'select p.id, p.memory_id, p.passage_index, p.start_offset, p.end_offset, p.message_start, p.message_end,
+                m.title, m.created_at,
+                substr(m.content, p.start_offset + 1, p.end_offset - p.start_offset) as content,
+                (1 - (p.embedding::vector(%1$s) <=> $1::vector(%1$s)))::float as distance
+         from memory_passages p
+         join memories m on m.id = p.memory_id
+         where p.user_id = $3
+           and vector_dims(p.embedding) = %1$s
+           and 1 - (p.embedding::vector(%1$s) <=> $1::vector(%1$s)) > $2
+         order by p.embedding::vector(%1$s) <=> $1::vector(%1$s)
+         limit $4', dims
+    ) using query_embedding, match_threshold, filter_user_id, match_count;
+end;
+$$;
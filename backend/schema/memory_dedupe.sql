@@ -0,0 +1,8 @@
+-- Re-saves of one conversation update its memory (see backend/fingerprint.py).
+-- Saves with a URL are matched on (user_id, url); saves without one on the MinHash
+-- signature in "fingerprint" (64 x uint32, base64), compared in the API process.
+
+alter table memories add column if not exists fingerprint text;
+
+create index if not exists memories_user_url on memories (user_id, url, created_at desc)
+    where url <> '';
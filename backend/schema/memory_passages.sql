@@ -0,0 +1,62 @@
+-- Passage-level embeddings for long conversations (see backend/chunking.py).
+-- A passage stores only offsets into its memory's content; the text is sliced on read.
+
+create table if not exists memory_passages (
+    id uuid primary key default gen_random_uuid(),
+    memory_id uuid not null references memories (id) on delete cascade,
+    user_id text not null,
+    passage_index integer not null,
+    start_offset integer not null,
+    end_offset integer not null,
+    message_start integer,
+    message_end integer,
+    created_at timestamptz not null default now(),
+    embedding vector(1536)
+);
+
+create index if not exists memory_passages_user on memory_passages (user_id);
+create index if not exists memory_passages_memory on memory_passages (memory_id, passage_index);
+create index if not exists memory_passages_embedding on memory_passages
+    using hnsw (embedding vector_cosine_ops);
+
+-- Same contract as search_memories: "distance" holds the cosine similarity
+create or replace function search_memory_passages(
+    query_embedding vector(1536),
+    match_threshold float,
+    match_count int,
+    filter_user_id text
+)
+returns table (
+    id uuid,
+    memory_id uuid,
+    passage_index integer,
+    start_offset integer,
+    end_offset integer,
+    message_start integer,
+    message_end integer,
+    title text,
+    created_at timestamptz,
+    content text,
+    distance float
+)
+language sql stable
+as $$
+    select
+        p.id,
+        p.memory_id,
+        p.passage_index,
+        p.start_offset,
+        p.end_offset,
+        p.message_start,
+        p.message_end,
+        m.title,
+        m.created_at,
+        substr(m.content, p.start_offset + 1, p.end_offset - p.start_offset) as content,
+        1 - (p.embedding <=> query_embedding) as distance
+    from memory_passages p
+    join memories m on m.id = p.memory_id
+    where p.user_id = filter_user_id
+      and 1 - (p.embedding <=> query_embedding) > match_threshold
+    order by p.embedding <=> query_embedding
+    limit match_count;
+$$;
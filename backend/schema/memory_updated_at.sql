@@ -0,0 +1,28 @@
+-- Lets /generate_knowledge_graph (and the BM25 index's drift check) tell whether a user's
+-- memories changed without reading their content: updated_at moves on every write to a row,
+-- and content_length is stored at save time for node sizes.
+
+alter table memories add column if not exists updated_at timestamptz;
+alter table memories add column if not exists content_length integer;
+
+update memories set updated_at = created_at where updated_at is null;
+update memories set content_length = coalesce(length(content), 0) where content_length is null;
+
+alter table memories alter column updated_at set default now();
+alter table memories alter column updated_at set not null;
+
+create or replace function touch_memories_updated_at()
+returns trigger
+language plpgsql
+as $$
+begin
+    new.updated_at := now();
+    return new;
+end;
+$$;
+
+drop trigger if exists memories_touch_updated_at on memories;
+create trigger memories_touch_updated_at before update on memories
+    for each row execute function touch_memories_updated_at();
+
+create index if not exists memories_user_updated on memories (user_id, updated_at desc);
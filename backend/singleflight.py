@@ -0,0 +1,128 @@
+"""Single-flight coalescing of identical concurrent upstream calls.
+
+When the dashboard and the extension are both open, or a button is
+double-clicked, the same embedding, completion or RPC request can be issued
+several times within milliseconds. ``SingleFlight`` keys each call on its
+group plus a canonical JSON of its arguments. The first caller starts the
+upstream request, and callers that arrive while it is in flight await the
+same result. Nothing is cached: once the call settles, the next identical
+request goes upstream again.
+
+The upstream call runs as its own task, and every caller awaits it through
+``asyncio.shield``. A caller whose client disconnects is cancelled without
+cancelling the call the other callers are waiting on. Coalesced callers get
+the very same result object, so treat results as read-only.
+"""
+from typing import Any, Awaitable, Callable, Dict, Tuple
+import asyncio
+import hashlib
+import json
+
+
+def call_key(*parts: Any) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """In-flight call registry with per-group counters"""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._calls: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def _group_stats(self, group: str) -> Dict[str, int]:
+        return self.stats.setdefault(group, {"calls": 0, "coalesced": 0, "errors": 0})
+
+    async def do(self, group: str, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        stats = self._group_stats(group)
+        if not self.enabled:
+            stats["calls"] += 1
+            return await call()
+
+        task = self._calls.get((group, key))
+        if task is not None:
+            stats["coalesced"] += 1
+            return await asyncio.shield(task)
+
+        stats["calls"] += 1
+        task = asyncio.ensure_future(call())
+        self._calls[(group, key)] = task
+
+        def settle(done: asyncio.Task):
+            self._calls.pop((group, key), None)
+            if not done.cancelled() and done.exception() is not None:
+                stats["errors"] += 1
+
+        task.add_done_callback(settle)
+        return await asyncio.shield(task)
+
+    def snapshot(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._calls),
+            "groups": {group: dict(stats) for group, stats in self.stats.items()}
+        }
+
+
+class CoalescedCall:
+    """Awaitable keyword-argument method routed through a SingleFlight group"""
+
+    def __init__(self, flights: SingleFlight, group: str, method: Callable[..., Awaitable[Any]]):
+        self._flights = flights
+        self._group = group
+        self._method = method
+
+    async def __call__(self, **kwargs):
+        # Streams hand each caller its own iterator and cannot be shared
+        if kwargs.get("stream"):
+            return await self._method(**kwargs)
+        return await self._flights.do(self._group, call_key(kwargs), lambda: self._method(**kwargs))
+
+
+class _Resource:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class CoalescingOpenAI:
+    """AsyncOpenAI wrapper coalescing chat completions and embeddings; everything else passes through"""
+
+    def __init__(self, client, flights: SingleFlight):
+        self._client = client
+        self.chat = _Resource(completions=_Resource(
+            create=CoalescedCall(flights, "chat_completions", client.chat.completions.create)
+        ))
+        self.embeddings = _Resource(create=CoalescedCall(flights, "embeddings", client.embeddings.create))
+
+    def __getattr__(self, name: str):
+        return getattr(self._client, name)
+
+
+class _CoalescedRPC:
+    def __init__(self, flights: SingleFlight, storage, func: str, params: Dict[str, Any]):
+        self._flights = flights
+        self._storage = storage
+        self._func = func
+        self._params = params
+
+    async def execute(self):
+        return await self._flights.do(
+            f"rpc:{self._func}",
+            call_key(self._params),
+            lambda: self._storage.rpc(self._func, self._params).execute()
+        )
+
+
+class CoalescingStorage:
+    """Storage client wrapper coalescing ``rpc(...).execute()``; tables and the rest pass through"""
+
+    def __init__(self, storage, flights: SingleFlight):
+        self._storage = storage
+        self._flights = flights
+
+    def rpc(self, func: str, params: Dict[str, Any]) -> _CoalescedRPC:
+        return _CoalescedRPC(self._flights, self._storage, func, params)
+
+    def __getattr__(self, name: str):
+        return getattr(self._storage, name)
@@ -0,0 +1,44 @@
+"""Regression tests for the compiled keyword analyzers (analyzers.py).
+
+Run from backend/: ``python -m pytest -q test_analyzers.py``
+"""
+import pytest
+
+from analyzers import TextAnalyzer
+
+
+@pytest.fixture
+def analyzer():
+    return TextAnalyzer()
+
+
+@pytest.mark.parametrize("text, topics", [
+    # Inflected keywords the old substring scan matched by their stem
+    ("I am learning to write essays", ["writing", "learning"]),
+    ("Explaining functions in coding", ["programming", "learning"]),
+    ("We planned the trip", ["business", "travel"]),
+    ("The bugs in these classes", ["programming"]),
+    # Whole words only: a keyword inside a longer unrelated word does not count
+    ("A classic and artistic film", ["general"]),
+    ("Nothing relevant here", ["general"]),
+])
+def test_topics(analyzer, text, topics):
+    assert analyzer.topics(text) == topics
+
+
+def test_non_ascii_words_are_kept(analyzer):
+    assert {"naïve", "café", "数据库"} <= analyzer.analyze("Naïve café 数据库").words
+
+
+def test_vague_phrases_count_once_each(analyzer):
+    assert analyzer.analyze("Maybe, it depends. Perhaps.").vague_hits == 3
+    assert analyzer.is_vague("It depends, maybe.")
+
+
+def test_cache_is_bounded_by_bytes():
+    analyzer = TextAnalyzer(max_cache_bytes=10_000)
+    for i in range(200):
+        analyzer.analyze(f"message number {i} about python code")
+    snapshot = analyzer.snapshot()
+    assert snapshot["bytes"] <= 10_000
+    assert snapshot["evictions"] > 0
@@ -0,0 +1,136 @@
+"""Tests for the embedded storage backend (local_store.py).
+
+Run from backend/: ``python -m pytest -q test_local_store.py``
+"""
+import asyncio
+
+import numpy as np
+import pytest
+
+from clients import keyset_after, order_by
+from local_store import LocalStore
+from vector_index import LocalVectorIndex
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return LocalStore(str(tmp_path / "store"))
+
+
+def memory(title, embedding=None, user_id="u1", **fields):
+    return {"user_id": user_id, "title": title, "summary": f"{title} summary", "content": f"{title} content",
+            "topics": ["general"], "embedding": embedding, **fields}
+
+
+def insert(store, *rows):
+    return run(store.table("memories").insert(list(rows)).execute()).data
+
+
+def test_insert_and_select_round_trip(store):
+    [saved] = insert(store, memory("python asyncio", [1.0, 0.0, 0.0], url="https://chat.openai.com/c/1"))
+
+    [row] = run(store.table("memories").select("*").eq("id", saved["id"]).execute()).data
+    assert row["title"] == "python asyncio"
+    assert row["topics"] == ["general"]
+    assert row["embedding"] == [1.0, 0.0, 0.0]
+    assert row["updated_at"] == row["created_at"]
+
+
+def test_update_rewrites_fields_and_vector(store):
+    [saved] = insert(store, memory("draft", [1.0, 0.0]))
+
+    [updated] = run(store.table("memories").update({"title": "final", "embedding": [0.0, 1.0]})
+                    .eq("id", saved["id"]).execute()).data
+    assert updated["title"] == "final"
+    assert updated["updated_at"] > saved["updated_at"]
+    [row] = run(store.table("memories").select("title, embedding").eq("id", saved["id"]).execute()).data
+    assert row == {"title": "final", "embedding": [0.0, 1.0]}
+
+
+def test_delete_removes_row_from_select_and_search(store):
+    keep, drop = insert(store, memory("keep", [1.0, 0.0]), memory("drop", [1.0, 0.1]))
+
+    run(store.table("memories").delete().eq("id", drop["id"]).execute())
+
+    ids = [row["id"] for row in run(store.table("memories").select("id").eq("user_id", "u1").execute()).data]
+    assert ids == [keep["id"]]
+    hits = store.search_memories([1.0, 0.0], 0.0, 10, "u1")
+    assert [hit["id"] for hit in hits] == [keep["id"]]
+
+
+def test_keyset_paging_visits_every_row_once(store):
+    insert(store, *[memory(f"m{i}", created_at="2024-01-01T00:00:00+00:00" if i < 3 else f"2024-01-0{i}T00:00:00+00:00")
+                    for i in range(7)])
+
+    seen, cursor = [], None
+    while True:
+        query = order_by(store.table("memories").select("id, created_at").eq("user_id", "u1"), "created_at.desc", "id.desc")
+        if cursor:
+            query = keyset_after(query, *cursor)
+        page = run(query.limit(3).execute()).data
+        seen.extend(page)
+        if len(page) < 3:
+            break
+        cursor = (page[-1]["created_at"], page[-1]["id"])
+
+    assert len(seen) == 7
+    assert len({row["id"] for row in seen}) == 7
+    assert seen == sorted(seen, key=lambda row: (row["created_at"], row["id"]), reverse=True)
+
+
+def test_select_count_uses_the_filters(store):
+    insert(store, memory("a"), memory("b"), memory("c", user_id="u2"))
+
+    result = run(store.table("memories").select("id", count="exact").eq("user_id", "u1").limit(1).execute())
+    assert len(result.data) == 1
+    assert result.count == 2
+
+
+def test_search_memories_rpc_semantics(store):
+    near, far, _ = insert(store, memory("near", [1.0, 0.1]), memory("far", [0.2, 1.0]),
+                          memory("other user", [1.0, 0.0], user_id="u2"))
+
+    rows = run(store.rpc("search_memories", {
+        "query_embedding": [1.0, 0.0], "match_threshold": 0.0, "match_count": 5, "filter_user_id": "u1"
+    }).execute()).data
+    assert [row["id"] for row in rows] == [near["id"], far["id"]]
+    assert set(rows[0]) == {"id", "title", "summary", "topics", "created_at", "content", "distance"}
+    assert rows[0]["distance"] == pytest.approx(1 / np.sqrt(1.01), rel=1e-5)
+
+    assert len(store.search_memories([1.0, 0.0], 0.0, 1, "u1")) == 1
+    assert store.search_memories([1.0, 0.0, 0.0], 0.0, 5, "u1") == []
+
+
+def test_search_threshold_is_strict_like_the_vector_index(store, tmp_path):
+    # Orthogonal vectors score exactly 0.0: excluded by a 0.0 threshold in both backends
+    orthogonal, aligned = insert(store, memory("orthogonal", [0.0, 1.0]), memory("aligned", [1.0, 0.0]))
+
+    assert [row["id"] for row in store.search_memories([1.0, 0.0], 0.0, 5, "u1")] == [aligned["id"]]
+
+    index = LocalVectorIndex(str(tmp_path / "index"))
+    index.build("u1", [orthogonal, aligned], dim=2)
+    assert [row["id"] for row in index.search("u1", [1.0, 0.0], 0.0, 5)] == [aligned["id"]]
+
+
+def test_text_search_matches_every_word(store):
+    both, _ = insert(store, memory("python asyncio"), memory("python typing"))
+
+    rows = store.text_search_memories("asyncio python", 5, "u1")
+    assert [row["id"] for row in rows] == [both["id"]]
+
+
+def test_stores_sharing_a_directory_allocate_distinct_slots(tmp_path):
+    # Two LocalStores on one directory stand in for two worker processes
+    first, second = LocalStore(str(tmp_path / "shared")), LocalStore(str(tmp_path / "shared"))
+    vectors = {f"m{i}": np.eye(4)[i % 4].tolist() for i in range(200)}
+
+    for i, (title, vector) in enumerate(vectors.items()):
+        insert(first if i % 2 else second, memory(title, vector))
+
+    for reader in (first, second):
+        rows = run(reader.table("memories").select("title, embedding").eq("user_id", "u1").execute()).data
+        assert {row["title"]: row["embedding"] for row in rows} == vectors
@@ -0,0 +1,54 @@
+"""Tests for the in-process vector index (vector_index.py).
+
+Run from backend/: ``python -m pytest -q test_vector_index.py``
+"""
+import threading
+
+import numpy as np
+
+from vector_index import LocalVectorIndex
+
+
+def rows(prefix, center, count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+        {"id": f"{prefix}{i}", "title": f"{prefix}{i}", "embedding": (center + 0.01 * rng.standard_normal(len(center))).tolist()}
+        for i in range(count)
+    ]
+
+
+def test_search_returns_nothing_when_probed_lists_are_empty(tmp_path):
+    index = LocalVectorIndex(str(tmp_path), ivf_min_vectors=16, nprobe=1, quantize_min_vectors=16)
+    east, north = np.array([1.0, 0.0, 0.0, 0.0]), np.array([0.0, 1.0, 0.0, 0.0])
+    index.build("u1", rows("e", east, 16) + rows("n", north, 16, seed=1))
+    for i in range(16):
+        index.remove("u1", f"e{i}")
+
+    assert index.search("u1", east.tolist(), 0.0, 5) == []
+    hits = index.search("u1", north.tolist(), 0.5, 3)
+    assert hits and all(hit["id"].startswith("n") for hit in hits)
+
+
+def test_search_during_writes_for_the_same_user(tmp_path):
+    index = LocalVectorIndex(str(tmp_path), quantize_min_vectors=0)
+    center = np.array([1.0, 0.0, 0.0, 0.0])
+    index.build("u1", rows("m", center, 50))
+    errors = []
+
+    def write():
+        try:
+            for i in range(200):
+                index.add("u1", rows(f"w{i}-", center, 1, seed=i)[0])
+                index.remove("u1", f"m{i % 50}")
+        except Exception as e:
+            errors.append(e)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    while writer.is_alive():
+        for hit in index.search("u1", center.tolist(), 0.5, 10):
+            assert hit["distance"] > 0.5
+    writer.join()
+
+    assert errors == []
+    assert len(index.search("u1", center.tolist(), 0.5, 500)) == 200
@@ -0,0 +1,203 @@
+"""Offline token counting with tiktoken-compatible BPE encodings.
+
+Encodings load from a local ``.tiktoken`` file, so counting never needs the
+network. Each line of the file is ``<base64 token> <rank>``. When the
+``tiktoken`` package is installed its native engine runs over those ranks.
+Otherwise a pure-Python BPE is used. That fallback pre-tokenizes with a
+stdlib ``re`` approximation of the official split pattern, so its counts can
+differ from tiktoken's by a token here and there.
+
+Files come from ``TOKENIZER_BPE_DIR`` (``cl100k_base.tiktoken``,
+``o200k_base.tiktoken``) and/or ``TOKENIZER_BPE_PATH``; a configured path
+that does not exist fails startup rather than falling back. Nothing is ever
+downloaded. Callers pick the encoding per model (gpt-4 and gpt-3.5 use
+cl100k_base, gpt-4o and later o200k_base); an encoding that is not loaded is
+counted with the default one. With no files configured at all, counts use the
+old 4-characters-per-token estimate, and that is logged as a warning.
+
+``TokenCounter`` memoizes per-message counts, so a long conversation that is
+counted again only encodes the messages that are new.
+"""
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import base64
+import hashlib
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Official split patterns, used as-is when tiktoken (and its \p{..} regex engine) is available
+_PATTERNS = {
+    "cl100k_base": r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+""",
+    "o200k_base": "|".join([
+        r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]*[\p{Ll}\p{Lm}\p{Lo}\p{M}]+(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+        r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]+[\p{Ll}\p{Lm}\p{Lo}\p{M}]*(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+        r"""\p{N}{1,3}""",
+        r""" ?[^\s\p{L}\p{N}]+[\r\n/]*""",
+        r"""\s*[\r\n]+""",
+        r"""\s+(?!\S)""",
+        r"""\s+""",
+    ]),
+}
+
+# stdlib approximation: [^\W\d_] stands in for \p{L}, \d for \p{N}
+_FALLBACK_PATTERN = re.compile(
+    r"""'(?:s|t|re|ve|m|ll|d)\b|(?:[^\r\n\w]|_)?[^\W\d_]+|\d{1,3}| ?(?:[^\s\w]|_)+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+""",
+    re.IGNORECASE
+)
+
+# Chat format overhead (per the OpenAI cookbook): tokens per message plus reply priming
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+def load_bpe_ranks(path: str) -> Dict[bytes, int]:
+    ranks = {}
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                token, rank = line.split()
+                ranks[base64.b64decode(token)] = int(rank)
+    return ranks
+
+
+class PythonBPE:
+    """Pure-Python byte-pair encoder over tiktoken ranks, with a per-piece cache"""
+
+    def __init__(self, ranks: Dict[bytes, int], piece_cache_size: int = 50000):
+        self.ranks = ranks
+        self.piece_cache_size = piece_cache_size
+        self._piece_cache: Dict[bytes, int] = {}
+
+    def _piece_tokens(self, piece: bytes) -> int:
+        if piece in self.ranks:
+            return 1
+        cached = self._piece_cache.get(piece)
+        if cached is not None:
+            return cached
+
+        parts = [piece[i:i + 1] for i in range(len(piece))]
+        while len(parts) > 1:
+            best_rank, best_index = None, -1
+            for i in range(len(parts) - 1):
+                rank = self.ranks.get(parts[i] + parts[i + 1])
+                if rank is not None and (best_rank is None or rank < best_rank):
+                    best_rank, best_index = rank, i
+            if best_rank is None:
+                break
+            parts[best_index:best_index + 2] = [parts[best_index] + parts[best_index + 1]]
+
+        if len(self._piece_cache) >= self.piece_cache_size:
+            self._piece_cache.clear()
+        self._piece_cache[piece] = len(parts)
+        return len(parts)
+
+    def count(self, text: str) -> int:
+        return sum(self._piece_tokens(piece.encode("utf-8")) for piece in _FALLBACK_PATTERN.findall(text))
+
+
+def bpe_files(bpe_dir: Optional[str], bpe_path: Optional[str] = None,
+              encoding_name: str = "o200k_base") -> Dict[str, str]:
+    """Encoding name -> local .tiktoken file, from a directory of ``<encoding>.tiktoken`` files
+    and/or one file for ``encoding_name``. A configured path that does not exist is an error."""
+    files = {}
+    if bpe_dir:
+        if not os.path.isdir(bpe_dir):
+            raise FileNotFoundError(f"TOKENIZER_BPE_DIR {bpe_dir} does not exist")
+        for name in _PATTERNS:
+            path = os.path.join(bpe_dir, f"{name}.tiktoken")
+            if os.path.exists(path):
+                files[name] = path
+        if not files:
+            raise FileNotFoundError(f"TOKENIZER_BPE_DIR {bpe_dir} holds none of {', '.join(f'{n}.tiktoken' for n in _PATTERNS)}")
+    if bpe_path:
+        if not os.path.exists(bpe_path):
+            raise FileNotFoundError(f"TOKENIZER_BPE_PATH {bpe_path} does not exist")
+        files[encoding_name] = bpe_path
+    return files
+
+
+class TokenCounter:
+    """Shared token-counting service with memoized per-message counts, one encoder per encoding"""
+
+    def __init__(self, bpe_paths: Optional[Dict[str, str]] = None, default_encoding: str = "o200k_base",
+                 max_cached_messages: int = 100000):
+        self.default_encoding = default_encoding
+        self.max_cached_messages = max_cached_messages
+        self._message_counts: "OrderedDict[str, int]" = OrderedDict()
+        # encoding name -> (engine, encoder); loaded from local files only, never fetched
+        self._encoders: Dict[str, Tuple[str, Any]] = {}
+        self.stats = {"hits": 0, "misses": 0}
+
+        for name, path in (bpe_paths or {}).items():
+            ranks = load_bpe_ranks(path)
+            try:
+                import tiktoken
+                encoder = tiktoken.Encoding(
+                    name=name,
+                    pat_str=_PATTERNS.get(name, _PATTERNS["o200k_base"]),
+                    mergeable_ranks=ranks,
+                    special_tokens={}
+                )
+                self._encoders[name] = ("tiktoken", encoder)
+            except ImportError:
+                self._encoders[name] = ("python", PythonBPE(ranks))
+            logger.info(f"Token counter loaded {name} from {path} ({len(ranks)} ranks, {self._encoders[name][0]} engine)")
+        if not self._encoders:
+            logger.warning("No BPE encoding files configured; token counts use the 4 chars/token estimate")
+
+    def _resolve(self, encoding: Optional[str]) -> Optional[str]:
+        """The loaded encoding to count with: the one asked for, else the default, else none (estimate)"""
+        for name in (encoding, self.default_encoding):
+            if name in self._encoders:
+                return name
+        return next(iter(self._encoders), None)
+
+    def count(self, text: str, encoding: Optional[str] = None) -> int:
+        if not text:
+            return 0
+        name = self._resolve(encoding)
+        if name is None:
+            return len(text) // 4
+        engine, encoder = self._encoders[name]
+        if engine == "tiktoken":
+            return len(encoder.encode_ordinary(text))
+        return encoder.count(text)
+
+    def count_message(self, message: Dict, encoding: Optional[str] = None) -> int:
+        """Tokens for one chat message's content, memoized by encoding and content hash"""
+        content = message.get("content", "") or ""
+        name = self._resolve(encoding)
+        key = f"{name}:{hashlib.sha1(content.encode('utf-8')).hexdigest()}"
+        cached = self._message_counts.get(key)
+        if cached is not None:
+            self._message_counts.move_to_end(key)
+            self.stats["hits"] += 1
+            return cached
+
+        self.stats["misses"] += 1
+        tokens = self.count(content, name)
+        self._message_counts[key] = tokens
+        while len(self._message_counts) > self.max_cached_messages:
+            self._message_counts.popitem(last=False)
+        return tokens
+
+    def count_messages(self, messages: List[Dict], encoding: Optional[str] = None) -> int:
+        """Prompt tokens for a chat conversation, including per-message overhead"""
+        return self.with_overhead(sum(self.count_message(msg, encoding) for msg in messages), len(messages))
+
+    @staticmethod
+    def with_overhead(content_tokens: int, message_count: int) -> int:
+        if not message_count:
+            return 0
+        return content_tokens + message_count * TOKENS_PER_MESSAGE + TOKENS_PER_REPLY
+
+    def snapshot(self) -> Dict:
+        return {
+            **self.stats,
+            "engines": {name: engine for name, (engine, _) in self._encoders.items()} or {"estimate": "heuristic"},
+            "default_encoding": self.default_encoding,
+            "cached_messages": len(self._message_counts)
+        }
@@ -0,0 +1,488 @@
+"""In-process vector search over per-user embedding matrices.
+
+This is an optional local backend for the Supabase ``search_memories`` RPC.
+Each user's unit-normalized embeddings are stored in a memory-mapped float32
+file. Cosine top-k is then one matrix-vector product. Row metadata lives in
+a SQLite file next to the vectors, so a search never leaves the process.
+
+Supabase stays the source of truth. A user's index is built from Supabase on
+first use, then kept in sync as memories are saved, updated and deleted.
+Paging a user's rows takes a while, and writes keep landing meanwhile. So
+``begin_build`` starts recording the user's adds, updates and removes, and
+``build`` replays them over its row snapshot. Users
+with many memories get an IVF coarse quantizer: k-means centroids over the
+vectors, with only the ``nprobe`` closest lists scanned per query.
+
+Once a user has ``quantize_min_vectors`` memories, the scan runs over compact
+in-memory codes (see quantization.py) instead of the float file: int8, or
+product quantization from ``pq_min_vectors`` up. Only the best ``rescore``
+(``pq_rescore`` for PQ) times ``match_count`` approximate hits are then read back at full precision
+and scored exactly. Returned similarities and the threshold test are therefore
+exact, and the float file is touched only for those few rows.
+
+The index-wide lock guards the loaded-user map and the SQLite connection and
+is held only briefly by searches. Each user's matrix has its own lock, which
+is the only one held for the scan, so searches no longer queue behind each
+other or behind another user's writes. Writers take the index-wide lock
+first, then the user's.
+"""
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+from quantization import ProductQuantizer, ScalarQuantizer
+
+logger = logging.getLogger(__name__)
+
+# Row fields mirrored locally; same shape the search_memories RPC returns
+META_FIELDS = ["id", "title", "summary", "topics", "created_at", "content"]
+
+
+def parse_embedding(value: Any) -> Optional[np.ndarray]:
+    """PostgREST returns pgvector columns as strings like '[0.1,0.2,...]'"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+def _unit(vector: np.ndarray) -> np.ndarray:
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm > 0 else vector
+
+
+class _UserIndex:
+    """Slot-addressed float32 matrix for one user; deletes swap the last slot in"""
+
+    def __init__(self, path: str, dim: int, ids: List[str]):
+        self.path = path
+        self.dim = dim
+        self.ids = ids
+        self.slots = {memory_id: slot for slot, memory_id in enumerate(ids)}
+        # Held while the matrix, ids or IVF/quantizer state are read or changed
+        self.lock = threading.RLock()
+        capacity = max(64, len(ids))
+        if os.path.exists(path):
+            capacity = max(capacity, os.path.getsize(path) // (4 * dim))
+        self.vectors = self._open(capacity)
+
+        # IVF state (trained lazily, not persisted)
+        self.centroids: Optional[np.ndarray] = None
+        self.assign: Optional[np.ndarray] = None
+        self.trained_count = 0
+
+        # Quantized codes, slot-aligned with the vectors (trained lazily, not persisted)
+        self.quantizer = None
+        self.codes: Optional[np.ndarray] = None
+        self.quantized_count = 0
+
+    @property
+    def count(self) -> int:
+        return len(self.ids)
+
+    def _open(self, capacity: int) -> np.memmap:
+        # Grow the file in place; existing rows keep their offsets
+        size = capacity * 4 * self.dim
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < size:
+            with open(self.path, "ab") as f:
+                f.truncate(size)
+        return np.memmap(self.path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    def _ensure_capacity(self, needed: int):
+        capacity = self.vectors.shape[0]
+        if needed <= capacity:
+            return
+        self.vectors.flush()
+        del self.vectors
+        self.vectors = self._open(max(needed, capacity * 2))
+        if self.assign is not None:
+            grown = np.full(self.vectors.shape[0], -1, dtype=np.int32)
+            grown[:len(self.assign)] = self.assign
+            self.assign = grown
+        if self.codes is not None:
+            grown = np.zeros((self.vectors.shape[0], self.codes.shape[1]), dtype=np.uint8)
+            grown[:len(self.codes)] = self.codes
+            self.codes = grown
+
+    def upsert(self, memory_id: str, vector: np.ndarray) -> int:
+        slot = self.slots.get(memory_id)
+        if slot is None:
+            slot = self.count
+            self._ensure_capacity(slot + 1)
+            self.ids.append(memory_id)
+            self.slots[memory_id] = slot
+        self.vectors[slot] = vector
+        if self.centroids is not None:
+            self.assign[slot] = int(np.argmax(self.centroids @ vector))
+        if self.quantizer is not None:
+            self.codes[slot] = self.quantizer.encode(vector)[0]
+        return slot
+
+    def remove(self, memory_id: str) -> Optional[Dict[str, int]]:
+        """Remove a row; returns {moved_id: new_slot} when the last row fills the hole"""
+        slot = self.slots.pop(memory_id, None)
+        if slot is None:
+            return None
+        last = self.count - 1
+        moved = {}
+        if slot != last:
+            moved_id = self.ids[last]
+            self.vectors[slot] = self.vectors[last]
+            if self.assign is not None:
+                self.assign[slot] = self.assign[last]
+            if self.codes is not None:
+                self.codes[slot] = self.codes[last]
+            self.ids[slot] = moved_id
+            self.slots[moved_id] = slot
+            moved[moved_id] = slot
+        self.ids.pop()
+        return moved
+
+    def train_ivf(self, nlist: int, iterations: int = 10, seed: int = 0):
+        count = self.count
+        rng = np.random.default_rng(seed)
+        data = np.asarray(self.vectors[:count])
+        sample = data[rng.choice(count, min(count, nlist * 40), replace=False)]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            onehot = np.zeros((nlist, len(sample)), dtype=np.float32)
+            onehot[labels, np.arange(len(sample))] = 1.0
+            sums = onehot @ sample
+            sizes = np.bincount(labels, minlength=nlist)
+            filled = sizes > 0
+            centroids[filled] = sums[filled] / sizes[filled, None]
+            norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+            centroids = np.divide(centroids, norms, out=centroids, where=norms > 0)
+
+        assign = np.full(self.vectors.shape[0], -1, dtype=np.int32)
+        for start in range(0, count, 8192):
+            block = data[start:start + 8192]
+            assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+
+        self.centroids = centroids
+        self.assign = assign
+        self.trained_count = count
+
+    def quantize(self, kind: str, pq_subvectors: Optional[int] = None, seed: int = 0):
+        count = self.count
+        rng = np.random.default_rng(seed)
+        # PQ k-means is the expensive part; 16 samples per centroid is plenty
+        sample_size = 16 * 256 if kind == "pq" else 8192
+        sample = np.asarray(self.vectors[np.sort(rng.choice(count, min(count, sample_size), replace=False))])
+        if kind == "pq":
+            quantizer = ProductQuantizer.train(sample, pq_subvectors, seed=seed)
+        else:
+            quantizer = ScalarQuantizer.train(sample)
+
+        codes = np.zeros((self.vectors.shape[0], quantizer.bytes_per_vector), dtype=np.uint8)
+        for start in range(0, count, 8192):
+            codes[start:min(count, start + 8192)] = quantizer.encode(np.asarray(self.vectors[start:min(count, start + 8192)]))
+        self.quantizer = quantizer
+        self.codes = codes
+        self.quantized_count = count
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> Optional[np.ndarray]:
+        if self.centroids is None:
+            return None
+        nprobe = min(nprobe, len(self.centroids))
+        probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        probed = np.zeros(len(self.centroids), dtype=bool)
+        probed[probe] = True
+        return np.nonzero(probed[self.assign[:self.count]])[0]
+
+
+class LocalVectorIndex:
+    """Per-user cosine top-k over memory-mapped float32 matrices"""
+
+    def __init__(self, base_dir: str, ivf_min_vectors: int = 20000, nprobe: int = 8,
+                 max_loaded_users: int = 256, quantize_min_vectors: int = 1000, pq_min_vectors: int = 0,
+                 pq_subvectors: Optional[int] = None, rescore: int = 4, pq_rescore: int = 16):
+        self.base_dir = base_dir
+        self.ivf_min_vectors = ivf_min_vectors
+        self.nprobe = nprobe
+        self.max_loaded_users = max_loaded_users
+        self.quantize_min_vectors = quantize_min_vectors
+        self.pq_min_vectors = pq_min_vectors
+        self.pq_subvectors = pq_subvectors
+        self.rescore = rescore
+        self.pq_rescore = pq_rescore
+        os.makedirs(base_dir, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._loaded: "OrderedDict[str, _UserIndex]" = OrderedDict()
+        # Writes recorded while a user's build is paging rows: (method name, args)
+        self._pending: Dict[str, List[Tuple[str, tuple]]] = {}
+        self._db = sqlite3.connect(os.path.join(base_dir, "index.sqlite"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                dim INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS rows (
+                user_id TEXT NOT NULL,
+                memory_id TEXT NOT NULL,
+                slot INTEGER NOT NULL,
+                meta TEXT NOT NULL,
+                PRIMARY KEY (user_id, memory_id)
+            );
+            CREATE INDEX IF NOT EXISTS rows_slot ON rows (user_id, slot);
+            """
+        )
+        self._db.commit()
+
+    def _path(self, user_id: str) -> str:
+        return os.path.join(self.base_dir, hashlib.sha1(user_id.encode("utf-8")).hexdigest()[:20] + ".f32")
+
+    def has_user(self, user_id: str) -> bool:
+        with self._lock:
+            if user_id in self._loaded:
+                return True
+            return self._db.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    def dimension(self, user_id: str) -> Optional[int]:
+        with self._lock:
+            if user_id in self._loaded:
+                return self._loaded[user_id].dim
+            row = self._db.execute("SELECT dim FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            return row[0] if row else None
+
+    def _load(self, user_id: str) -> Optional[_UserIndex]:
+        index = self._loaded.get(user_id)
+        if index is not None:
+            self._loaded.move_to_end(user_id)
+            return index
+
+        row = self._db.execute("SELECT dim FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        ids = [r[0] for r in self._db.execute(
+            "SELECT memory_id FROM rows WHERE user_id = ? ORDER BY slot", (user_id,)
+        )]
+        index = _UserIndex(self._path(user_id), row[0], ids)
+        self._loaded[user_id] = index
+        self._maybe_train(index)
+        while len(self._loaded) > self.max_loaded_users:
+            _, evicted = self._loaded.popitem(last=False)
+            evicted.vectors.flush()
+        return index
+
+    def begin_build(self, user_id: str):
+        """Record the user's writes from now on, for ``build`` to replay over rows read after this call"""
+        with self._lock:
+            self._pending.setdefault(user_id, [])
+
+    def abort_build(self, user_id: str):
+        with self._lock:
+            self._pending.pop(user_id, None)
+
+    def _record(self, user_id: str, method: str, *args):
+        pending = self._pending.get(user_id)
+        if pending is not None:
+            pending.append((method, args))
+
+    def build(self, user_id: str, rows: List[Dict[str, Any]], dim: Optional[int] = None):
+        """Replace a user's index with the given Supabase rows; with ``dim``, rows at other dimensions are left out"""
+        vectors = [(row, parse_embedding(row.get("embedding"))) for row in rows]
+        vectors = [(row, vector) for row, vector in vectors if vector is not None]
+        dim = dim or (len(vectors[0][1]) if vectors else 1536)
+
+        with self._lock:
+            pending = self._pending.pop(user_id, [])
+            self.invalidate(user_id)
+            path = self._path(user_id)
+            if os.path.exists(path):
+                os.remove(path)
+            self._db.execute("INSERT INTO users (user_id, dim) VALUES (?, ?)", (user_id, dim))
+            index = _UserIndex(path, dim, [])
+            self._loaded[user_id] = index
+            for row, vector in vectors:
+                if len(vector) == dim:
+                    self._write_row(user_id, index, row, vector)
+            # Saves and deletes that landed while the rows were being paged; the snapshot may predate them
+            for method, args in pending:
+                getattr(self, method)(user_id, *args)
+            self._db.commit()
+            index.vectors.flush()
+            self._maybe_train(index)
+        logger.info(f"Built local vector index for user {user_id} with {index.count} memories")
+
+    def _maybe_train(self, index: _UserIndex):
+        """(Re)train the IVF and code quantizers once a user crosses their threshold or doubles in size"""
+        with index.lock:
+            self._train(index)
+
+    def _train(self, index: _UserIndex):
+        if index.count >= self.ivf_min_vectors and index.count >= 2 * index.trained_count:
+            index.train_ivf(nlist=int(4 * np.sqrt(index.count)))
+        if self.quantize_min_vectors and index.count >= self.quantize_min_vectors \
+                and index.count >= 2 * index.quantized_count:
+            kind = "pq" if self.pq_min_vectors and index.count >= self.pq_min_vectors else "int8"
+            index.quantize(kind, self.pq_subvectors)
+            logger.info(
+                f"Quantized {index.count} vectors ({kind}, {index.quantizer.bytes_per_vector} bytes each "
+                f"instead of {4 * index.dim})"
+            )
+
+    def add(self, user_id: str, row: Dict[str, Any]):
+        """Insert or replace one memory; no-op until the user's index has been built"""
+        vector = parse_embedding(row.get("embedding"))
+        if vector is None:
+            return
+        with self._lock:
+            self._record(user_id, "add", row)
+            index = self._load(user_id)
+            if index is None:
+                return
+            if len(vector) != index.dim:
+                # A row not yet re-embedded to the index's dimension; search reaches it through the RPC
+                return
+            with index.lock:
+                self._write_row(user_id, index, row, vector)
+                self._db.commit()
+                index.vectors.flush()
+                self._maybe_train(index)
+
+    def _write_row(self, user_id: str, index: _UserIndex, row: Dict[str, Any], vector: np.ndarray):
+        slot = index.upsert(row["id"], _unit(vector))
+        meta = {field: row.get(field) for field in META_FIELDS}
+        self._db.execute(
+            "INSERT OR REPLACE INTO rows (user_id, memory_id, slot, meta) VALUES (?, ?, ?, ?)",
+            (user_id, row["id"], slot, json.dumps(meta, default=str)),
+        )
+
+    def update(self, user_id: str, memory_id: str, fields: Dict[str, Any]):
+        """Apply a metadata update (title/summary/...) without touching the vector"""
+        with self._lock:
+            self._record(user_id, "update", memory_id, fields)
+            current = self._db.execute(
+                "SELECT meta FROM rows WHERE user_id = ? AND memory_id = ?", (user_id, memory_id)
+            ).fetchone()
+            if current is None:
+                return
+            meta = json.loads(current[0])
+            meta.update({k: v for k, v in fields.items() if k in META_FIELDS})
+            self._db.execute(
+                "UPDATE rows SET meta = ? WHERE user_id = ? AND memory_id = ?",
+                (json.dumps(meta, default=str), user_id, memory_id),
+            )
+            self._db.commit()
+
+    def remove(self, user_id: str, memory_id: str):
+        with self._lock:
+            self._record(user_id, "remove", memory_id)
+            index = self._load(user_id)
+            if index is None:
+                return
+            with index.lock:
+                moved = index.remove(memory_id)
+                if moved is None:
+                    return
+                index.vectors.flush()
+            self._db.execute("DELETE FROM rows WHERE user_id = ? AND memory_id = ?", (user_id, memory_id))
+            for moved_id, slot in moved.items():
+                self._db.execute(
+                    "UPDATE rows SET slot = ? WHERE user_id = ? AND memory_id = ?", (slot, user_id, moved_id)
+                )
+            self._db.commit()
+
+    def vectors_for(self, user_id: str, memory_ids: List[str]) -> Dict[str, np.ndarray]:
+        """Unit vectors for those of ``memory_ids`` present in the user's index"""
+        with self._lock:
+            index = self._load(user_id)
+            if index is None:
+                return {}
+            with index.lock:
+                return {
+                    memory_id: np.array(index.vectors[index.slots[memory_id]])
+                    for memory_id in memory_ids if memory_id in index.slots
+                }
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            loaded = list(self._loaded.values())
+            return {
+                "loaded_users": len(loaded),
+                "vectors": sum(index.count for index in loaded),
+                "quantized_users": sum(1 for index in loaded if index.quantizer is not None),
+                "code_bytes": sum(index.codes.nbytes for index in loaded if index.codes is not None),
+                "float_bytes": sum(4 * index.dim * index.count for index in loaded)
+            }
+
+    def invalidate(self, user_id: str):
+        """Forget a user's index so the next search rebuilds it from Supabase"""
+        with self._lock:
+            index = self._loaded.pop(user_id, None)
+            if index is not None:
+                # A search still holding this index finds it closed and returns nothing
+                with index.lock:
+                    index.vectors = None
+            self._db.execute("DELETE FROM rows WHERE user_id = ?", (user_id,))
+            self._db.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            self._db.commit()
+
+    def search(self, user_id: str, query_embedding: List[float], match_threshold: float,
+               match_count: int) -> List[Dict[str, Any]]:
+        """Cosine top-k; rows carry the similarity in ``distance`` like the RPC"""
+        query = _unit(np.asarray(query_embedding, dtype=np.float32))
+
+        with self._lock:
+            index = self._load(user_id)
+        if index is None or match_count <= 0:
+            return []
+
+        # Only this user's lock is held for the scan; the SQLite fetch below retakes the index-wide one
+        with index.lock:
+            if index.vectors is None or index.count == 0:
+                return []
+            if len(query) != index.dim:
+                raise ValueError(f"Query dimension {len(query)} does not match index dimension {index.dim}")
+
+            candidates = index.candidates(query, self.nprobe)
+            if candidates is not None and len(candidates) == 0:
+                # The probed IVF lists are empty (e.g. rows removed since training)
+                return []
+            slots = np.arange(index.count) if candidates is None else candidates
+            if index.quantizer is not None:
+                # Approximate scan over the codes, then exact scores for the shortlist only
+                codes = index.codes[:index.count] if candidates is None else index.codes[candidates]
+                approximate = index.quantizer.scores(codes, query)
+                rescore = self.pq_rescore if index.quantizer.kind == "pq" else self.rescore
+                shortlist = min(len(approximate), max(match_count * rescore, match_count))
+                slots = slots[np.argpartition(-approximate, shortlist - 1)[:shortlist]]
+            scores = index.vectors[slots] @ query
+
+            k = min(match_count, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            hits = [(index.ids[slots[i]], float(scores[i])) for i in top if scores[i] > match_threshold]
+        if not hits:
+            return []
+
+        placeholders = ",".join("?" * len(hits))
+        with self._lock:
+            metas = dict(self._db.execute(
+                f"SELECT memory_id, meta FROM rows WHERE user_id = ? AND memory_id IN ({placeholders})",
+                [user_id] + [memory_id for memory_id, _ in hits],
+            ).fetchall())
+
+        results = []
+        for memory_id, score in hits:
+            if memory_id not in metas:
+                # Removed between the scan and the fetch
+                continue
+            meta = json.loads(metas[memory_id])
+            meta["distance"] = score
+            results.append(meta)
+        return results
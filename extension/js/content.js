@@ -18,6 +18,8 @@ let conversationMonitor = {
     currentConversationId: null,
     lastMessageCount: 0,
     conversationHistory: [],
+    analysisCursor: null, // Messages the server has already seen for this conversation
+    analysisOffset: 0, // Older messages left out of the windowed full send, so history index = offset + cursor
     qualityMetrics: {
         averageFlow: 0,
         turnCount: 0,
@@ -1172,24 +1174,50 @@ async function analyzeConversationTurn() {
 // API call for conversation turn analysis
 async function analyzeConversationTurnAPI(userMessage, assistantMessage, conversationHistory) {
     try {
-        const response = await fetch(`${API_URL}/analyze_conversation_turn`, {
+        // Once the server holds state for this conversation, only send messages after its cursor
+        const cursor = conversationMonitor.analysisCursor;
+        const offset = conversationMonitor.analysisOffset;
+        const useDelta = cursor !== null && offset + cursor <= conversationHistory.length;
+        const userId = await getUserId();
+        
+        const postTurn = (payload) => fetch(`${API_URL}/analyze_conversation_turn`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                'X-User-ID': userId
             },
             body: JSON.stringify({
                 user_message: userMessage,
                 assistant_message: assistantMessage,
-                conversation_history: conversationHistory.slice(-10),
-                conversation_id: conversationMonitor.currentConversationId
+                conversation_id: conversationMonitor.currentConversationId,
+                ...payload
             })
         });
         
+        // Full sends (first call, resync) keep the old trailing window of 10 messages;
+        // the server's cursor then counts from the start of that window
+        const postWindow = () => {
+            const window = conversationHistory.slice(-10);
+            conversationMonitor.analysisOffset = conversationHistory.length - window.length;
+            return postTurn({ conversation_history: window });
+        };
+        
+        let response = useDelta
+            ? await postTurn({ conversation_history: conversationHistory.slice(offset + cursor), cursor: cursor })
+            : await postWindow();
+        
+        // Server lost or disagrees with our state: resend the window once
+        if (response.status === 409) {
+            conversationMonitor.analysisCursor = null;
+            response = await postWindow();
+        }
+        
         if (!response.ok) {
             throw new Error(`API returned ${response.status}`);
         }
         
         const analysis = await response.json();
+        conversationMonitor.analysisCursor = typeof analysis.cursor === 'number' ? analysis.cursor : null;
         console.log('✅ Conversation turn analysis:', analysis);
         
         return analysis;
@@ -7,6 +7,8 @@ import './App.css';
 console.log('APP VERSION 2.0 - USER ISOLATION ACTIVE');
 
 const API_URL = 'https://chatgpt-memory-manager-production.up.railway.app';
+// Memories per /get_all_memories page (the server caps a page at 1000)
+const MEMORY_PAGE_SIZE = 500;
 
 interface Memory {
   id: string;
@@ -93,12 +95,21 @@ function App() {
     try {
       setLoading(true);
       setError(null);
-      const response = await axios.get(`${API_URL}/get_all_memories`, {
-        headers: getHeaders()
-      });
-      setMemories(response.data.memories);
-      setTotalMemories(response.data.total);
-      calculateStats(response.data.memories);
+      // The list is paged server-side: follow next_cursor until the last page,
+      // showing what has arrived so far after each one
+      const loaded: Memory[] = [];
+      let cursor: string | null = null;
+      do {
+        const params: { limit: number; cursor?: string } = { limit: MEMORY_PAGE_SIZE };
+        if (cursor) params.cursor = cursor;
+        const response: { data: { memories: Memory[]; next_cursor: string | null } } =
+          await axios.get(`${API_URL}/get_all_memories`, { headers: getHeaders(), params });
+        loaded.push(...response.data.memories);
+        cursor = response.data.next_cursor;
+        setMemories([...loaded]);
+        setTotalMemories(loaded.length);
+      } while (cursor);
+      calculateStats(loaded);
     } catch (error: any) {
       console.error('Error loading memories:', error);
       if (error.response?.status === 429) {